@@ -30,6 +30,10 @@ from dateutil import parser
 from datetime import datetime
 from collections import Counter
 
+# The columnar result stores are read with the ResultStore of the feature scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Schemes', 'sensors'))
+from util import ResultStore
+
 # Sensor mapping: car experiment (12 sensors)
 SENSORS_CAR1 = ['01', '02', '03', '04', '05', '06']
 SENSORS_CAR2 = ['07', '08', '09', '10', '11', '12']
@@ -89,6 +93,105 @@ def include_result(time, incl_intervals):
     return False
 
 
+def store_location(json_path):
+    """
+    Map the path of a per-pair result file onto the columnar result store of its feature and parameters.
+
+    :param str json_path: Full path to a result json file (.../Sensor-xx/<feature>/.../Sensor-yy.json.gz)
+    :return tuple: Full path to the result store (.../all/<feature>/.../result.store) and the two sensors
+    (e.g. Sensor-01, Sensor-02), or None if the path does not match
+    """
+    match = re.search(r'^(.*)(Sensor-[^/\\]+)([/\\].*[/\\])(Sensor-[^/\\]+?)\.json(?:\.gz)?$', json_path)
+    if not match:
+        return None
+
+    return match.group(1) + 'all' + match.group(3) + 'result.store', match.group(2), match.group(4)
+
+
+def read_store_results(store_path, sensor1, sensor2):
+    """
+    Read the results of a sensor pair from a columnar result store (see ResultStore in Schemes/sensors/util.py).
+
+    :param str store_path: Full path to the result store
+    :param str sensor1: The first sensor (e.g. Sensor-01)
+    :param str sensor2: The second sensor (e.g. Sensor-02)
+    :return dict: The 'results' field as in the result json file, or None if the pair is not in the store
+    """
+    # The columns are memory mapped, so only the rows of the pair are read
+    store = ResultStore.load(store_path)
+
+    # Find the sensor pair
+    index = store.pair_index(sensor1, sensor2)
+    if index is None:
+        return None
+
+    return store.results(index)
+
+
+def store_pair_files(path):
+    """
+    List the result json files of the sensor pairs in the columnar result stores that match a path of result files,
+    for results that were only saved in a store (see load_results).
+
+    :param str path: Full path to the list of result json files (.../Sensor-*/<feature>/.../Sensor-*.json.gz)
+    :return list: Full paths to the result json files of all sensor pairs in the matching result stores
+    """
+    match = re.search(r'^(.*)Sensor-\*([/\\].*[/\\])Sensor-\*(\.json(?:\.gz)?)$', path)
+    if not match:
+        return []
+
+    file_list = []
+    for store_path in sorted(glob(match.group(1) + 'all' + match.group(2) + 'result.store', recursive=True)):
+        # Folders of the feature and parameters, e.g. /temp/temp_hum_press_shrestha/
+        folders = store_path[len(match.group(1)) + len('all'):-len('result.store')]
+
+        # The sensor pairs are listed in the index of the store
+        with open(os.path.join(store_path, 'index.json'), 'r') as f:
+            index = loads(f.read())
+
+        for pair in index['pairs']:
+            file_list.append(match.group(1) + pair['sensors'][0] + folders + pair['sensors'][1] + match.group(3))
+
+    return file_list
+
+
+def load_results(json_path):
+    """
+    Load the 'results' field of a gzipped result json file, or of its columnar result store if the file does not exist.
+
+    :param str json_path: Full path to a result json file (.../Sensor-xx/<feature>/.../Sensor-yy.json.gz)
+    :return dict: The results
+    """
+    if os.path.isfile(json_path):
+        with gzip.open(json_path, 'rt') as f:
+            return loads(f.read())['results']
+
+    location = store_location(json_path)
+    if location and os.path.isdir(location[0]):
+        results = read_store_results(*location)
+        if results is not None:
+            return results
+
+    raise FileNotFoundError('No result file or result store for ' + json_path)
+
+
+def results_exist(json_path):
+    """
+    Check if the results of a result json file exist, either as a file or in its columnar result store.
+
+    :param str json_path: Full path to a result json file
+    :return bool: True or False
+    """
+    if os.path.isfile(json_path):
+        return True
+
+    location = store_location(json_path)
+    if not location or not os.path.isdir(location[0]):
+        return False
+
+    return ResultStore.load(location[0]).pair_index(location[1], location[2]) is not None
+
+
 def parse_folders(path, feature):
     """
     Read the result files (Sensor-*.json.gz) of feature computations into a list.
@@ -103,8 +206,13 @@ def parse_folders(path, feature):
     file_list = []
     folder_list = []
 
+    # Match the result files, or the sensor pairs in the result stores if there are no result files
+    json_files = glob(path, recursive=True)
+    if not json_files:
+        json_files = store_pair_files(path)
+
     # Iterate over matched files
-    for json_file in glob(path, recursive=True):
+    for json_file in json_files:
         # Get the current folder, e.g. 10sec, 1min, etc.
         # (take different slashes into account: / or \)
         regex = re.escape(feature) + r'(?:/|\\)(.*)(?:/|\\)Sensor-'
@@ -333,10 +441,8 @@ def build_truong_dataset(json_file, ble_path, wifi_path, tmp_path, label, featur
         print('build_truong_dataset: json_file must be only of instance dict or str, exiting...')
         sys.exit(0)
 
-    # Read gzipped ble JSON
-    with gzip.open(ble_path, 'rt') as f:
-        ble_json = loads(f.read())
-        ble_json = ble_json['results']
+    # Read gzipped ble JSON (or the result store)
+    ble_json = load_results(ble_path)
 
     # Update ble_res (w.r.t. subscenario)
     ble_res = {}
@@ -351,11 +457,9 @@ def build_truong_dataset(json_file, ble_path, wifi_path, tmp_path, label, featur
         ble_res = ble_json
 
     # Wifi data can be completely missing ((
-    if os.path.isfile(wifi_path):
-        # Read gzipped wifi JSON
-        with gzip.open(wifi_path, 'rt') as f:
-            wifi_json = loads(f.read())
-            wifi_json = wifi_json['results']
+    if results_exist(wifi_path):
+        # Read gzipped wifi JSON (or the result store)
+        wifi_json = load_results(wifi_path)
 
         # Update wifi_res (w.r.t. subscenario)
         wifi_res = {}
@@ -659,10 +763,8 @@ def build_shrestha_dataset(json_file, hum_path, press_path, tmp_path, label, inc
     # List to store the results
     csv_list = []
 
-    # Read gzipped temperature JSON
-    with gzip.open(json_file, 'rt') as f:
-        temp_json = loads(f.read())
-        temp_json = temp_json['results']
+    # Read gzipped temperature JSON (or the result store)
+    temp_json = load_results(json_file)
 
     # Update temp_res (w.r.t. subscenario)
     temp_res = {}
@@ -676,10 +778,8 @@ def build_shrestha_dataset(json_file, hum_path, press_path, tmp_path, label, inc
     else:
         temp_res = temp_json
 
-    # Read gzipped humidity JSON
-    with gzip.open(hum_path, 'rt') as f:
-        hum_json = loads(f.read())
-        hum_json = hum_json['results']
+    # Read gzipped humidity JSON (or the result store)
+    hum_json = load_results(hum_path)
 
     # Update temp_res (w.r.t. subscenario)
     hum_res = {}
@@ -693,10 +793,8 @@ def build_shrestha_dataset(json_file, hum_path, press_path, tmp_path, label, inc
     else:
         hum_res = hum_json
 
-    # Read gzipped pressure JSON
-    with gzip.open(press_path, 'rt') as f:
-        press_json = loads(f.read())
-        press_json = press_json['results']
+    # Read gzipped pressure JSON (or the result store)
+    press_json = load_results(press_path)
 
     # Update temp_res (w.r.t. subscenario)
     press_res = {}
@@ -1044,14 +1142,10 @@ def infer_time_deltas(audio_path, time_interval):
 
     # Have to check because of missing wifi data
     # Load 1st wifi file
-    with gzip.open(wifi_path, 'rt') as f:
-        wifi_json = loads(f.read())
-        wifi_json = wifi_json['results']
+    wifi_json = load_results(wifi_path)
 
     # Load 1st ble file
-    with gzip.open(ble_path, 'rt') as f:
-        ble_json = loads(f.read())
-        ble_json = ble_json['results']
+    ble_json = load_results(ble_path)
 
     # Get 1st audio timestamp: we assume that audio starts after wifi and ble
     audio_start = next(iter(sorted(audio_json))).split('.')[0]
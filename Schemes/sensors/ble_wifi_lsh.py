@@ -0,0 +1,426 @@
+"""Candidate pair generation for BLE & WiFi evaluation
+
+Computing the features of Truong et al. (see ble_wifi_truong.py) for all
+pairs of devices is infeasible for large fleets. This script estimates the
+Jaccard similarity of the identifier sets of every device and timeslot with
+MinHash signatures, and uses locality-sensitive hashing (LSH) on bands of the
+signatures to find candidate pairs. Only candidates whose estimated
+similarity reaches a bound are evaluated with the full set of features.
+
+The quality of the candidate generation can be checked with a recall/cost
+report against the exhaustive all-pairs evaluation.
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+from glob import glob
+from itertools import combinations
+from json import dumps
+from ble_wifi_truong import read_results_columnar, slot_strings, \
+    sparse_features, ScanLog, SlotMatrix, WIFI_FEATURES, BLE_FEATURES
+from util import create_metadata, create_run_context, derive_result_path, \
+    init_run_context
+import numpy as np
+import sys
+import traceback
+
+
+SCRIPT = __file__[:-3]
+
+# Mersenne prime used as modulus of the hash functions
+PRIME = (1 << 61) - 1
+# Signature value of an empty set
+EMPTY = np.uint64(PRIME)
+
+# Default LSH parameters: 16 bands of 4 rows
+NUM_PERM = 64
+BANDS = 16
+# Minimum estimated Jaccard similarity of a candidate
+BOUND = 0.5
+# Number of candidates whose similarity is estimated at once
+SCORE_BLOCK = 1 << 16
+# Number of identifier entries hashed at once (bounds the temporary memory
+# to HASH_BLOCK x num_perm words)
+HASH_BLOCK = 1 << 14
+
+
+# ----------------
+# Helper functions
+# ----------------
+def hash_functions(num_perm=NUM_PERM, seed=0):
+    """Draw num_perm universal hash functions h(x) = (a * x + b) mod PRIME.
+
+    The coefficients are limited to 32 bits, so that the computation does not
+    overflow for identifiers below 2^31."""
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+    b = rng.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash_signatures(sm, num_perm=NUM_PERM, seed=0):
+    """Compute the MinHash signature of every timeslot of a SlotMatrix.
+
+    :return: An array (timeslots x num_perm) of signatures. Empty timeslots
+        have the signature EMPTY in every position.
+    """
+    a, b = hash_functions(num_perm, seed)
+    rv = np.full((len(sm.slots), num_perm), EMPTY, dtype=np.uint64)
+    # Minimum over every non-empty row of the CSR matrix, hashing the
+    # entries of a block of rows at once
+    filled = np.nonzero(np.diff(sm.indptr) > 0)[0]
+    ends = sm.indptr[filled + 1]
+    lo = 0
+    while lo < len(filled):
+        start = sm.indptr[filled[lo]]
+        # At least one row, otherwise the rows with up to HASH_BLOCK entries
+        hi = max(lo + 1, int(np.searchsorted(ends, start + HASH_BLOCK,
+                                             side="right")))
+        rows = filled[lo:hi]
+        idents = sm.indices[start:ends[hi - 1]].astype(np.uint64)
+        hashes = (idents[:, None] * a[None, :] + b[None, :]) % \
+            np.uint64(PRIME)
+        rv[rows] = np.minimum.reduceat(hashes, sm.indptr[rows] - start,
+                                       axis=0)
+        lo = hi
+    # Rows with repeated identifiers are not part of the CSR matrix
+    for row, population in sm.fallback.items():
+        idents = np.array([int(m.ident) for m in population], dtype=np.uint64)
+        rv[row] = ((idents[:, None] * a[None, :] + b[None, :]) %
+                   np.uint64(PRIME)).min(axis=0)
+    return rv
+
+
+def estimated_similarity(sig1, sig2):
+    """Estimate the Jaccard similarity from (rows of) MinHash signatures."""
+    return np.mean(sig1 == sig2, axis=-1)
+
+
+def bucket_pairs(start):
+    """Enumerate all pairs of positions within the buckets of a sorted array.
+
+    :param start: Mask of the first position of every bucket
+    :return: Two arrays (first, second) of positions with first < second
+        that are in the same bucket
+    """
+    n = len(start)
+    starts = np.nonzero(start)[0]
+    ends = np.append(starts[1:], n)
+    # Number of later positions in the same bucket
+    counts = ends[np.cumsum(start) - 1] - np.arange(n) - 1
+    first = np.repeat(np.arange(n), counts)
+    offsets = np.arange(counts.sum()) - \
+        np.repeat(np.cumsum(counts) - counts, counts)
+    return first, first + offsets + 1
+
+
+def lsh_candidates(slots, signatures, bands=BANDS, bound=BOUND):
+    """Find candidate pairs of sensors per timeslot.
+
+    Two sensors are a candidate pair in a timeslot if their signatures agree
+    in all rows of at least one band, and the similarity estimated from the
+    full signatures is at least bound. Timeslots with an error marker should
+    be excluded by the caller, empty timeslots are never candidates (they
+    carry no evidence of colocation, but would put all sensors into the same
+    bucket).
+    :param slots: A list (one entry per sensor) of arrays of slot starts
+    :param signatures: A list of the corresponding signature arrays
+    :param bands: The number of bands
+    :param bound: The minimum estimated Jaccard similarity
+    :return: A dictionary mapping index pairs (i, j) with i < j to an array
+        of slot starts in which they are candidates
+    """
+    num_perm = signatures[0].shape[1]
+    if num_perm % bands != 0:
+        raise ValueError("Number of permutations must be a multiple of bands")
+    width = num_perm // bands
+
+    # Flatten the non-empty timeslots of all sensors
+    sensor = np.concatenate([np.full(len(s), i) for i, s in enumerate(slots)])
+    slot = np.concatenate(slots)
+    sig = np.concatenate(signatures)
+    filled = sig[:, 0] != EMPTY
+    sensor, slot, sig = sensor[filled], slot[filled], sig[filled]
+    n = len(sig)
+
+    # Band keys of every row, and the candidates (pairs of rows)
+    keys = np.empty((n, bands), dtype=np.uint64)
+    xs = [np.zeros(0, dtype=np.int64)]
+    ys = [np.zeros(0, dtype=np.int64)]
+    for band in range(bands):
+        # Hash every band into a single 64 bit key (collisions only create
+        # additional candidates, which are checked below)
+        key = np.zeros(n, dtype=np.uint64)
+        for col in sig[:, band * width:(band + 1) * width].T:
+            key = key * np.uint64(1000003) ^ col
+        keys[:, band] = key
+        order = np.lexsort((sensor, key, slot))
+        s_slot, s_key = slot[order], key[order]
+        # Bucket boundaries: same timeslot and same band key
+        start = np.ones(n, dtype=bool)
+        start[1:] = (s_slot[1:] != s_slot[:-1]) | (s_key[1:] != s_key[:-1])
+        # Within a bucket, the rows are ordered by sensor
+        first, second = bucket_pairs(start)
+        first, second = order[first], order[second]
+        for lo in range(0, len(first), SCORE_BLOCK):
+            x, y = first[lo:lo + SCORE_BLOCK], second[lo:lo + SCORE_BLOCK]
+            # Skip the pairs that shared a bucket in an earlier band, and
+            # check the estimated similarity of the others
+            new = ~(keys[x, :band] == keys[y, :band]).any(axis=1)
+            x, y = x[new], y[new]
+            keep = estimated_similarity(sig[x], sig[y]) >= bound
+            xs.append(x[keep])
+            ys.append(y[keep])
+    x, y = np.concatenate(xs), np.concatenate(ys)
+
+    # Group the timeslots by pair of sensors
+    first, second, slot = sensor[x], sensor[y], slot[x]
+    order = np.lexsort((slot, second, first))
+    first, second, slot = first[order], second[order], slot[order]
+    start = np.ones(len(slot), dtype=bool)
+    start[1:] = (first[1:] != first[:-1]) | (second[1:] != second[:-1])
+    bounds = np.append(np.nonzero(start)[0], len(slot))
+    return {(int(first[lo]), int(second[lo])): slot[lo:hi]
+            for lo, hi in zip(bounds[:-1], bounds[1:])}
+
+
+def _signatures(sms, num_perm, seed):
+    """Compute slots and signatures of a list of SlotMatrix objects,
+    excluding timeslots with error markers and empty timeslots."""
+    slots = []
+    signatures = []
+    for sm in sms:
+        sig = minhash_signatures(sm, num_perm, seed)
+        ok = ~sm.broken & (sig[:, 0] != EMPTY)
+        slots.append(sm.slots[ok])
+        signatures.append(sig[ok])
+    return slots, signatures
+
+
+# ------------------------
+# Main evaluation function
+# ------------------------
+def compute(files, slotsize=10, num_perm=NUM_PERM, bands=BANDS, bound=BOUND,
+            default=-100, features=WIFI_FEATURES, seed=0):
+    """Compute the features for all candidate pairs of the given files.
+
+    :return: A dictionary mapping index pairs of files to result
+        dictionaries (see ble_wifi_truong.compute), which only contain the
+        timeslots in which the pair is a candidate.
+    """
+    sms = [SlotMatrix(read_results_columnar(f), slotsize) for f in files]
+    slots, signatures = _signatures(sms, num_perm, seed)
+    candidates = lsh_candidates(slots, signatures, bands, bound)
+    rv = {}
+    for (i, j), cand_slots in sorted(candidates.items()):
+        rv[(i, j)] = sparse_features(sms[i], sms[j], default, features,
+                                     slots=cand_slots)
+    return rv
+
+
+def report(files, slotsize=10, num_perm=NUM_PERM, bands=BANDS, bound=BOUND,
+           seed=0):
+    """Compare the LSH candidates with the exhaustive all-pairs evaluation.
+
+    A pair of sensors is relevant in a timeslot if the Jaccard similarity of
+    their identifier sets (1 - Jaccard distance) is at least bound. Only
+    timeslots in which both sensors observed identifiers are counted, see
+    lsh_candidates.
+    :return: A dictionary with recall and precision of the candidates, and
+        the cost (fraction of all pair-timeslots that need to be evaluated)
+    """
+    sms = [SlotMatrix(read_results_columnar(f), slotsize) for f in files]
+    slots, signatures = _signatures(sms, num_perm, seed)
+    candidates = lsh_candidates(slots, signatures, bands, bound)
+
+    total = 0
+    relevant = 0
+    n_candidates = 0
+    found = 0
+    for i, j in combinations(range(len(sms)), 2):
+        common = np.intersect1d(slots[i], slots[j])
+        total += len(common)
+        res = sparse_features(sms[i], sms[j], features=("jaccard",),
+                              slots=common)
+        truth = set(tstr for tstr in res
+                    if 1.0 - res[tstr]["jaccard"] >= bound)
+        cand = set(slot_strings(candidates.get((i, j),
+                                               np.array([], dtype=np.int64))))
+        relevant += len(truth)
+        n_candidates += len(cand)
+        found += len(truth & cand)
+
+    return {
+        "pair_slots": total,
+        "relevant": relevant,
+        "candidates": n_candidates,
+        "found": found,
+        "recall": found / float(relevant) if relevant else 1.0,
+        "precision": found / float(n_candidates) if n_candidates else 1.0,
+        "cost": n_candidates / float(total) if total else 0.0,
+    }
+
+
+def process_candidates(files, feature="wifi", slotsize=10, num_perm=NUM_PERM,
+                       bands=BANDS, bound=BOUND):
+    """Compute and save the features of all candidate pairs."""
+    params = {
+        "chunk_len": slotsize,
+        "lsh_bound": bound,
+        "lsh_bands": bands,
+        "lsh_perm": num_perm,
+    }
+    features = WIFI_FEATURES if feature == "wifi" else BLE_FEATURES
+    results = compute(files, slotsize, num_perm, bands, bound,
+                      features=features)
+    for (i, j), res in results.items():
+        try:
+            rv = {}
+            rv["metadata"] = create_metadata([files[i], files[j]], SCRIPT,
+                                             params=params)
+            rv["results"] = res
+            rv["metadata"]["processing_end"] = \
+                datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+            path = derive_result_path(files[i][0:9], feature, SCRIPT,
+                                      files[j][0:9], params=params)
+            with open(path, "w") as fo:
+                fo.write(dumps(rv, indent=4, sort_keys=True))
+        except Exception:
+            print("Exception on pair", (files[i], files[j]))
+            traceback.print_exc()
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(description="Compute the features of Truong "
+                                "et al. for candidate pairs found with "
+                                "MinHash/LSH.")
+    arg_parser.add_argument("--ble", action="store_true",
+                            help="use the BLE instead of the WiFi scans")
+    arg_parser.add_argument("--slotsize", type=int, default=10)
+    arg_parser.add_argument("--perm", type=int, default=NUM_PERM,
+                            help="number of MinHash permutations")
+    arg_parser.add_argument("--bands", type=int, default=BANDS,
+                            help="number of LSH bands")
+    arg_parser.add_argument("--bound", type=float, default=BOUND,
+                            help="minimum (estimated) Jaccard similarity")
+    arg_parser.add_argument("--report", action="store_true",
+                            help="only compare the candidates with the "
+                            "exhaustive all-pairs evaluation")
+    args = arg_parser.parse_args()
+
+    # Query the metadata shared by all results once for the whole run
+    init_run_context(create_run_context())
+
+    feature = "ble" if args.ble else "wifi"
+    if args.ble:
+        files = sorted(glob("Sensor-*/ble/ble.txt.blinded"))
+    else:
+        files = sorted(glob("Sensor-*/wifi/wifi.txt.blinded"))
+
+    if args.report:
+        rv = {}
+        params = {
+            "chunk_len": args.slotsize,
+            "lsh_bound": args.bound,
+            "lsh_bands": args.bands,
+            "lsh_perm": args.perm,
+        }
+        rv["metadata"] = create_metadata(files, SCRIPT, params=params)
+        rv["results"] = report(files, args.slotsize, args.perm, args.bands,
+                               args.bound)
+        print(dumps(rv["results"], indent=4, sort_keys=True))
+        # Cross-sensor results are saved under "all", like the result stores
+        path = derive_result_path("all", feature, SCRIPT, params=params)
+        with open(path, "w") as fo:
+            fo.write(dumps(rv, indent=4, sort_keys=True))
+        print("[INFO] Saved", path)
+    else:
+        process_candidates(files, feature, args.slotsize, args.perm,
+                           args.bands, args.bound)
+
+
+# ----------
+# Unit tests
+# ----------
+def _log(scans, start=1502402240):
+    """Create a ScanLog with one scan (list of identifiers) every 10 s."""
+    idents = [ident for scan in scans for ident in scan]
+    times = [(start + 10 * i) * 1000000 for i, scan in enumerate(scans)
+             for _ in scan]
+    return ScanLog(np.array(idents, dtype=np.int64),
+                   np.full(len(idents), -70, dtype=np.int8),
+                   np.array(times, dtype=np.int64),
+                   np.zeros(len(idents), dtype=bool))
+
+
+def test_minhash_signatures():
+    sm = SlotMatrix(_log([[1, 2, 3], [], [3, 2, 1], [7]]))
+    sig = minhash_signatures(sm, num_perm=32)
+    assert sig.shape == (4, 32)
+    assert (sig[0] == sig[2]).all()
+    assert (sig[1] == EMPTY).all()
+    assert estimated_similarity(sig[0], sig[3]) == 0.0
+    a, b = hash_functions(32)
+    assert (sig[3] == (a * np.uint64(7) + b) % np.uint64(PRIME)).all()
+
+
+def test_minhash_signatures_blocks(monkeypatch):
+    sm = SlotMatrix(_log([[1, 2, 3], [], [4, 5, 6, 7, 8], [9], [], [2, 9]]))
+    sig = minhash_signatures(sm, num_perm=16)
+    a, b = hash_functions(16)
+    for row in range(len(sm.slots)):
+        idents = sm.indices[sm.indptr[row]:sm.indptr[row + 1]]
+        if len(idents) == 0:
+            continue
+        expected = ((idents.astype(np.uint64)[:, None] * a + b) %
+                    np.uint64(PRIME)).min(axis=0)
+        assert (sig[row] == expected).all()
+    # Blocks of a single row, and of rows larger than a block
+    for block in [1, 4]:
+        monkeypatch.setattr(sys.modules[__name__], "HASH_BLOCK", block)
+        assert (minhash_signatures(sm, num_perm=16) == sig).all()
+
+
+def test_lsh_candidates():
+    sms = [SlotMatrix(_log([list(range(20)), [1, 2]])),
+           SlotMatrix(_log([list(range(19)), [5, 6]])),
+           SlotMatrix(_log([list(range(100, 120)), [1, 2]]))]
+    slots, signatures = _signatures(sms, 64, 0)
+    candidates = lsh_candidates(slots, signatures, bands=16, bound=0.5)
+    # Sensors 0 and 1 share the first slot, 0 and 2 the second one
+    assert list(candidates[(0, 1)]) == [sms[0].slots[0]]
+    assert list(candidates[(0, 2)]) == [sms[0].slots[1]]
+    assert (1, 2) not in candidates
+
+
+def test_lsh_candidates_buckets():
+    rng = np.random.RandomState(3)
+    scans = [[sorted(rng.choice(30, rng.randint(0, 6), replace=False))
+              for _ in range(40)] for _ in range(12)]
+    # Identical and empty sets of all sensors in some timeslots
+    for scan in scans:
+        scan[5] = [1, 2, 3]
+        scan[6] = []
+    sms = [SlotMatrix(_log(scan)) for scan in scans]
+    slots, signatures = _signatures(sms, 32, 0)
+    candidates = lsh_candidates(slots, signatures, bands=8, bound=0.3)
+    assert len(candidates[(0, 11)]) >= 1
+    assert all(sms[0].slots[6] not in cand for cand in candidates.values())
+
+    # Compare with the pairs of every bucket
+    expected = {}
+    for i, j in combinations(range(len(sms)), 2):
+        for t in np.intersect1d(slots[i], slots[j]):
+            sig1 = signatures[i][np.searchsorted(slots[i], t)]
+            sig2 = signatures[j][np.searchsorted(slots[j], t)]
+            bands = (sig1 == sig2).reshape(8, 4).all(axis=1)
+            if bands.any() and estimated_similarity(sig1, sig2) >= 0.3:
+                expected.setdefault((i, j), []).append(t)
+    assert sorted(candidates) == sorted(expected)
+    for pair in expected:
+        assert list(candidates[pair]) == expected[pair]
+
+    # Bucket pairs of sorted positions
+    first, second = bucket_pairs(np.array([True, False, False, True, True,
+                                           False]))
+    assert list(zip(first, second)) == [(0, 1), (0, 2), (1, 2), (4, 5)]
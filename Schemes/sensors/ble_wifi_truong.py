@@ -20,22 +20,58 @@ Uses ML
 
 from dateutil import parser
 from datetime import datetime, timedelta
-from math import sqrt, exp
+from math import sqrt, exp, isclose
 from multiprocessing import Pool, cpu_count
+from argparse import ArgumentParser
+from queue import Queue, Empty
+from collections import deque
+from threading import Thread
+from time import sleep
 from functools import partial
 from glob import glob
 from itertools import combinations
 from json import dumps
-from util import create_metadata, derive_result_path
+from os import SEEK_END
+from util import create_metadata, create_run_context, derive_result_path, \
+    export_stores, init_run_context, parse_timestamps, popcount, result_dir, \
+    result_path, save_stores, select_tasks, slot_strings, store_result, \
+    to_epoch_us, ResultStore
 from statistics import mean
+from tempfile import NamedTemporaryFile
+from scipy.sparse import csr_matrix
+import numpy as np
+import sys
 import traceback
 
 
 MODE_WIFI = 0
 MODE_BLE = 1
 
+# Evaluation engines: per-timeslot lists of Measurements, sparse matrices, or
+# sparse matrices with set cardinalities computed on packed bitsets
+ENGINE_LIST = 0
+ENGINE_SPARSE = 1
+ENGINE_BITSET = 2
+
+# Features computed per timeslot in the two modes
+WIFI_FEATURES = ("jaccard", "euclidean", "mean_hamming", "mean_exp",
+                 "sum_squared_ranks")
+BLE_FEATURES = ("jaccard", "euclidean")
+
 SCRIPT = __file__[:-3]
 
+# Slot sizes (in seconds) to compute the features for
+SLOT_SIZES = [10, 30]
+
+# Minimum length (in seconds) of sliding windows: repeated identifiers in a
+# window are represented by their mean RSSI, which as per sect. IV.B of the
+# paper only applies to timeslots of at least 20 seconds
+MIN_WINDOW = 20
+
+# Maximum number of set levels of the unary code built at once by
+# _l1_distances (bounds the temporary memory)
+UNARY_BLOCK = 1 << 22
+
 
 class Measurement:
     """Measurement class - contains individual measurements."""
@@ -77,65 +113,109 @@ class MeasurementPair:
         return not self.__eq__(other)
 
 
+class ScanSet:
+    """Scan set - the measurements of one timeslot, keyed by identifier.
+
+    The measurements are kept in their original order (including repeated
+    identifiers), and the RSSI of the first occurrence of every identifier
+    is indexed in a dictionary. This allows building intersections and
+    unions in linear time while keeping the exact semantics (and summation
+    order) of the list-based implementation."""
+
+    def __init__(self, population=()):
+        """Initialize the scan set from an iterable of Measurements."""
+        self.idents = []
+        self.rssis = []
+        self.index = {}
+        for element in population:
+            self.add(element.ident, element.rssi)
+
+    def add(self, ident, rssi):
+        """Add an observation of identifier ident with signal strength rssi."""
+        self.idents.append(ident)
+        self.rssis.append(rssi)
+        if ident not in self.index:
+            self.index[ident] = rssi
+
+    def __len__(self):
+        return len(self.idents)
+
+    def __iter__(self):
+        for ident, rssi in zip(self.idents, self.rssis):
+            yield Measurement(ident, rssi, None)
+
+
+class ScanLog:
+    """Columnar scan log - all observations of one sensor as NumPy arrays.
+
+    ident: The (blinded) identifier, -1 for error markers
+    rssi: The signal strength (int8), 0 for error markers
+    time: The timestamp in microseconds since the epoch (int64)
+    broken: Mask of error markers (scans that failed on the device)
+    """
+
+    def __init__(self, ident, rssi, time, broken):
+        """Initialize the scan log with four equally long arrays."""
+        self.ident = ident
+        self.rssi = rssi
+        self.time = time
+        self.broken = broken
+
+    def __len__(self):
+        return len(self.ident)
+
+
+def scan_set(population):
+    """Return the population as a ScanSet, converting it if required."""
+    if isinstance(population, ScanSet):
+        return population
+    return ScanSet(population)
+
+
 # ----------------
 # Helper functions
 # ----------------
 def intersection(population1, population2):
     """Compute the intersection of two populations, disregarding timestamps
     and rssi."""
+    s1 = scan_set(population1)
+    s2 = scan_set(population2)
     rv = []
-    for p1 in population1:
-        for p2 in population2:
-            if p1.ident == p2.ident:
-                rv.append(MeasurementPair(p1.ident, p1.rssi, p2.rssi))
-                break
+    for ident, rssi in zip(s1.idents, s1.rssis):
+        if ident in s2.index:
+            rv.append(MeasurementPair(ident, rssi, s2.index[ident]))
 
     # Return
-    return list(rv)
+    return rv
 
 
 def union(population1, population2, default=-100):
     """Compute the union of two populations, disregarding timestamps
     and rssi"""
+    s1 = scan_set(population1)
+    s2 = scan_set(population2)
     rv = []
-    # Seen and processed identifiers
-    seen_idents = []
-
-    # For every Measurement in population 1...
-    for p1 in population1:
-        found = False
-        # ...look for an equivalent measurement in pop2
-        seen_idents.append(p1.ident)
-        for p2 in population2:
-            if p1.ident == p2.ident:
-                # Measurement found, add MeasurementPair to union
-                rv.append(MeasurementPair(p1.ident, p1.rssi, p2.rssi))
-                found = True
-                break
-        if not found:
-            # No equivalent measurement detected, create Measurement pair
-            # to reflect this
-            rv.append(MeasurementPair(p1.ident, p1.rssi, default))
+
+    # For every Measurement in population 1, look up the equivalent
+    # measurement in pop2 - if there is none, use the default value
+    for ident, rssi in zip(s1.idents, s1.rssis):
+        rv.append(MeasurementPair(ident, rssi, s2.index.get(ident, default)))
 
     # Process remaining entries of population 2
-    for p2 in population2:
+    for ident, rssi in zip(s2.idents, s2.rssis):
         # If we have not seen this identifier before...
-        if p2.ident not in seen_idents:
+        if ident not in s1.index:
             # ...create a measurement to reflect it.
-            rv.append(MeasurementPair(p2.ident, default, p2.rssi))
+            rv.append(MeasurementPair(ident, default, rssi))
 
     # Return
-    return list(rv)
+    return rv
 
 
 def sorted_list(population, intersection):
     """Convert the population into a sorted list."""
-    pop2 = []
-    for element in population:
-        for template in intersection:
-            if template.ident == element.ident:
-                pop2.append(element)
-                break
+    idents = set(template.ident for template in intersection)
+    pop2 = [element for element in population if element.ident in idents]
 
     return sorted(pop2, key=lambda x: x.rssi, reverse=True)
 
@@ -228,8 +308,78 @@ def read_results(filename):
     return rv
 
 
+class ScanLineParser:
+    """Incremental parser for the lines of a scan log.
+
+    Handles the error markers in the same way as read_results, but can be
+    fed one line at a time (e.g. from a file that is still being written)."""
+
+    def __init__(self, filename=""):
+        """Initialize the parser, filename is only used for warnings."""
+        self.filename = filename
+        self.broken_sample = 0
+
+    def parse(self, line):
+        """Parse a single line.
+
+        :return: A tuple (ident, rssi, timestring, broken) of strings (and a
+            bool), or None if the line contains no sample. Error markers are
+            returned with identifier "-1" and rssi "0".
+        """
+        # See read_results for a description of the broken sample handling
+        if self.broken_sample == 1:
+            self.broken_sample = 2
+            return None
+        if self.broken_sample == 2:
+            self.broken_sample = 0
+            return ("-1", "0", line.strip(), True)
+        # Parse out identifier, rssi and timestamp
+        fields = line.strip().split(" ")
+        if len(fields) != 3:
+            if "Interface doesn't support scanning" in line:
+                self.broken_sample = 1
+            elif "Sizes of BSSID and RSSI lists do not match" in line:
+                return ("-1", "0", line.strip().split()[9], True)
+            else:
+                print("[WARN] Unhandled problem with sample %s, skipping" %
+                      self.filename)
+                print(line)
+            return None
+        # Strip the dBm suffix from the RSSI
+        return (fields[0], fields[1][:-3], fields[2], False)
+
+
+def read_results_columnar(filename):
+    """Read in the results from a data file into a ScanLog.
+
+    This is equivalent to read_results, but requires integer (i.e. blinded)
+    identifiers and avoids creating a Measurement object and parsing a
+    timestamp with dateutil for every line. Error markers are handled the
+    same way as in read_results."""
+    idents = []
+    rssis = []
+    times = []
+    broken = []
+    line_parser = ScanLineParser(filename)
+    with open(filename, 'r') as fo:
+        for line in fo:
+            sample = line_parser.parse(line)
+            if sample is None:
+                continue
+            idents.append(sample[0])
+            rssis.append(sample[1])
+            times.append(sample[2])
+            broken.append(sample[3])
+    return ScanLog(np.array(idents).astype(np.int64),
+                   np.array(rssis).astype(np.int8),
+                   parse_timestamps(times),
+                   np.array(broken, dtype=bool))
+
+
 def population_ok(pop):
     """Check if a population contains an error marker or not."""
+    if isinstance(pop, ScanSet):
+        return "-1" not in pop.index
     for e in pop:
         if e.ident == "-1":
             return False
@@ -242,6 +392,8 @@ def jaccard_dist(pop1, pop2, default=-100):
     """Compute the jaccard distance of the two populations.
 
     The Jaccard distance is defined as 1 - |intersection| / |union|."""
+    pop1 = scan_set(pop1)
+    pop2 = scan_set(pop2)
     if len(pop1) == 0 and len(pop2) == 0:
         return 0.0
     return 1.0 - len(intersection(pop1, pop2)) / \
@@ -255,6 +407,8 @@ def mean_hamming_dist(pop1, pop2, default=-100):
     strength for all elements of the union of the populations, divided by
     the number of elements in the union.
     """
+    pop1 = scan_set(pop1)
+    pop2 = scan_set(pop2)
     if len(pop1) == 0 and len(pop2) == 0:
         return 0.0
     s = 0.0
@@ -273,6 +427,8 @@ def euclidean_distance(pop1, pop2, default=-100):
     differences ((a-b)^2) between the signal strengths in the union of
     values in the population.
     """
+    pop1 = scan_set(pop1)
+    pop2 = scan_set(pop2)
     if len(pop1) == 0 and len(pop2) == 0:
         return 0.0
     s = 0.0
@@ -291,6 +447,8 @@ def mean_exp_difference(pop1, pop2, default=-100):
     power of the absolute difference between values in the populations,
     divided by the cardinality of the union of the populations.
     """
+    pop1 = scan_set(pop1)
+    pop2 = scan_set(pop2)
     if len(pop1) == 0 and len(pop2) == 0:
         return 0.0
     s = 0.0
@@ -312,189 +470,1499 @@ def sum_squared_ranks(pop1, pop2):
 
     Note: I am not 100% sure if this is correct, we should confirm our
     interpretation with the original authors."""
+    pop1 = scan_set(pop1)
+    pop2 = scan_set(pop2)
     if len(pop1) == 0 and len(pop2) == 0:
         return 0.0
-    i = intersection(pop1, pop2)
-    if len(i) == 0:
+    common = [ident for ident in pop1.idents if ident in pop2.index]
+    if len(common) == 0:
         # Empty intersection
         return None
-    s_pop1 = sorted_list(pop1, i)
-    s_pop2 = sorted_list(pop2, i)
+    ranks1 = _first_ranks(pop1, pop2.index)
+    ranks2 = _first_ranks(pop2, pop1.index)
 
     s = 0.0
+    for ident in common:
+        s += abs(ranks1[ident] - ranks2[ident]) ** 2.0
+    return s
 
-    for element in i:
-        rank1 = -1
-        rank2 = -1
-        # Determine first rank
-        for c, e in enumerate(s_pop1):
-            if e.ident == element.ident:
-                rank1 = float(c) + 1
-                break
-        # Determine second rank
-        for c, e in enumerate(s_pop2):
-            if e.ident == element.ident:
-                rank2 = float(c) + 1
-                break
-        # Sanity check
-        assert rank1 >= 0
-        assert rank2 >= 0
 
-        s += abs(rank1 - rank2) ** 2.0
-    return s
+def slot_features(pop1, pop2, default=-100, features=WIFI_FEATURES):
+    """Compute several features for one timeslot in a single pass.
+
+    The union of the populations is built only once and the aligned RSSI
+    pairs are shared between all requested features. The results are
+    identical to calling the individual statistical functions.
+    :param pop1: The first population (list of Measurements or ScanSet)
+    :param pop2: The second population (list of Measurements or ScanSet)
+    :param default: The default rssi value for the union
+    :param features: The names of the features to compute, see WIFI_FEATURES
+    :return: A dictionary mapping feature names to their values
+    """
+    pop1 = scan_set(pop1)
+    pop2 = scan_set(pop2)
+    if len(pop1) == 0 and len(pop2) == 0:
+        return {feature: 0.0 for feature in features}
+
+    # Aligned rssi values of the union, first the entries of population 1...
+    rssi1 = list(pop1.rssis)
+    rssi2 = [pop2.index.get(ident, default) for ident in pop1.idents]
+    # ...followed by the entries only seen in population 2
+    for ident, rssi in zip(pop2.idents, pop2.rssis):
+        if ident not in pop1.index:
+            rssi1.append(default)
+            rssi2.append(rssi)
+    n_union = len(rssi1)
+    # The intersection consists of all entries of population 1 with a
+    # counterpart in population 2
+    common = [ident for ident in pop1.idents if ident in pop2.index]
+
+    rv = {}
+    if "jaccard" in features:
+        rv["jaccard"] = 1.0 - len(common) / float(n_union)
+    if "euclidean" in features:
+        s = 0.0
+        for r1, r2 in zip(rssi1, rssi2):
+            s += (r1 - r2) ** 2
+        rv["euclidean"] = sqrt(s)
+    if "mean_hamming" in features:
+        s = 0.0
+        for r1, r2 in zip(rssi1, rssi2):
+            s += abs(r1 - r2)
+        rv["mean_hamming"] = s / n_union
+    if "mean_exp" in features:
+        s = 0.0
+        for r1, r2 in zip(rssi1, rssi2):
+            s += exp(abs(r1 - r2))
+        rv["mean_exp"] = s / float(n_union)
+    if "sum_squared_ranks" in features:
+        if len(common) == 0:
+            rv["sum_squared_ranks"] = None
+        else:
+            ranks1 = _first_ranks(pop1, pop2.index)
+            ranks2 = _first_ranks(pop2, pop1.index)
+            s = 0.0
+            for ident in common:
+                s += abs(ranks1[ident] - ranks2[ident]) ** 2.0
+            rv["sum_squared_ranks"] = s
+    return rv
+
+
+def _first_ranks(pop, other_index):
+    """Rank the entries of pop that also appear in other_index by descending
+    rssi (ties keep their original order), and map every identifier to the
+    rank of its first occurrence."""
+    idents = []
+    rssis = []
+    for ident, rssi in zip(pop.idents, pop.rssis):
+        if ident in other_index:
+            idents.append(ident)
+            rssis.append(rssi)
+    # The inverse of the sorting permutation is the rank of every entry
+    perm = np.argsort(-np.asarray(rssis, dtype=np.float64), kind="mergesort")
+    ranks = np.empty(len(perm))
+    ranks[perm] = np.arange(1, len(perm) + 1)
+    rv = {}
+    for ident, rank in zip(idents, ranks.tolist()):
+        if ident not in rv or rank < rv[ident]:
+            rv[ident] = rank
+    return rv
+
+
+def batch_features(populations, default=-100):
+    """Compute Jaccard, Euclidean and mean Hamming distance between all pairs
+    of populations of the same timeslot.
+
+    The populations are arranged in a sensor x identifier matrix (presence
+    and RSSI, using the default value for missing identifiers), and the
+    pairwise distances are derived from Gram matrices:
+    - |A n B| is the inner product of the presence vectors
+    - the squared euclidean distance is |a|^2 + |b|^2 - 2 a.b
+    - the sum of absolute differences of integer values is the Hamming
+      distance of their unary (thermometer) codes, which is again computed
+      with an inner product.
+    For integer RSSI values, the results are identical to the per-pair
+    functions. The populations may not contain repeated identifiers.
+    :param populations: A list of N populations (lists of Measurements or
+        ScanSets)
+    :param default: The default rssi value for the union
+    :return: A dictionary mapping "jaccard", "euclidean" and "mean_hamming"
+        to NxN arrays
+    """
+    sets = [scan_set(pop) for pop in populations]
+    columns = {}
+    for s in sets:
+        if len(s.index) != len(s):
+            raise ValueError("Repeated identifiers in population")
+        for ident in s.idents:
+            columns.setdefault(ident, len(columns))
+
+    # Presence and RSSI matrix, the RSSI is shifted by the default value so
+    # that missing identifiers are zero
+    presence = np.zeros((len(sets), len(columns)))
+    values = np.zeros((len(sets), len(columns)))
+    for i, s in enumerate(sets):
+        cols = [columns[ident] for ident in s.idents]
+        presence[i, cols] = 1.0
+        values[i, cols] = np.array(s.rssis, dtype=np.float64) - default
+
+    # Cardinality of the intersections and unions
+    n_inter = presence.dot(presence.T)
+    sizes = np.diag(n_inter)
+    n_union = sizes[:, None] + sizes[None, :] - n_inter
+    empty = n_union == 0
+    denom = np.where(empty, 1.0, n_union)
+
+    # Squared euclidean distances
+    gram = values.dot(values.T)
+    norms = np.diag(gram)
+    squared = np.maximum(norms[:, None] + norms[None, :] - 2.0 * gram, 0.0)
+
+    rv = {
+        "jaccard": np.where(empty, 0.0, 1.0 - n_inter / denom),
+        "euclidean": np.sqrt(squared),
+        "mean_hamming": np.where(empty, 0.0, _l1_distances(values) / denom),
+    }
+    return rv
+
+
+def _l1_distances(values):
+    """Compute the pairwise sum of absolute differences of the rows."""
+    if not np.array_equal(values, np.round(values)):
+        # Non-integer values (i.e. averaged RSSIs) have no unary code
+        return np.array([np.abs(values - row).sum(axis=1) for row in values])
+    values = values.astype(np.int64)
+    if values.size == 0:
+        return np.zeros((len(values), len(values)))
+    low = min(values.min(), 0)
+    levels = max(values.max(), 0) - low
+    # Unary code: level t of a value v is set if v - low > t
+    counts = values - low
+    n_rows, n_cols = values.shape
+
+    # The gram matrix is accumulated over blocks of columns, so that at most
+    # UNARY_BLOCK levels (plus those of a single column) are set at once
+    ends = np.cumsum(counts.sum(axis=0))
+    gram = np.zeros((n_rows, n_rows))
+    lo = 0
+    while lo < n_cols:
+        offset = ends[lo - 1] if lo > 0 else 0
+        hi = max(lo + 1, int(np.searchsorted(ends, offset + UNARY_BLOCK,
+                                             side="right")))
+        block = counts[:, lo:hi]
+        n_block = block.shape[1]
+        block = block.ravel()
+        rows = np.repeat(np.repeat(np.arange(n_rows), n_block), block)
+        starts = np.repeat(np.tile(np.arange(n_block) * levels, n_rows),
+                           block)
+        offsets = np.arange(block.sum()) - \
+            np.repeat(np.cumsum(block) - block, block)
+        unary = csr_matrix((np.ones(len(rows)), (rows, starts + offsets)),
+                           shape=(n_rows, n_block * levels))
+        gram += unary.dot(unary.T).toarray()
+        lo = hi
+    norms = np.diag(gram)
+    return norms[:, None] + norms[None, :] - 2.0 * gram
+
+
+# -----------------------
+# Sparse evaluation engine
+# -----------------------
+def slot_starts(time, slotsize=10):
+    """Compute the timeslot of every timestamp (microseconds since epoch).
+
+    This is the integer equivalent of the rounding in timeslot_list: the
+    seconds are rounded down to the nearest multiple of slotsize within the
+    minute."""
+    seconds = time // 1000000
+    second = seconds % 60
+    return (seconds - second % slotsize) * 1000000
+
+
+class SlotMatrix:
+    """Sparse timeslot x identifier matrix of the scans of one sensor.
+
+    This is the columnar counterpart of the dictionary returned by
+    timeslot_list. Row i of the CSR matrix holds the RSSI values observed in
+    timeslot slots[i], the column is the (blinded) identifier. Empty slots
+    between the first and last observation are included as empty rows.
+
+    slots: Start of every timeslot in microseconds since the epoch
+    indptr, indices, data: The CSR representation of the RSSI values
+    order: The position of every stored value in its timeslot, as it would be
+        in the population returned by timeslot_list (used to break ties
+        when ranking)
+    broken: Mask of timeslots that contain an error marker
+    fallback: Maps rows with repeated identifiers (only possible if the
+        slotsize is smaller than 20) to their ScanSet, as they can not be
+        represented in the matrix
+    sums, counts: The sum and number of the observed RSSI values of every
+        stored value (used to merge timeslots, see merged)
+    """
+
+    def __init__(self, log, slotsize=10, keys=None):
+        """Initialize the slot matrix from a ScanLog.
+
+        keys may contain the precomputed timeslot of every observation."""
+        if keys is None:
+            keys = slot_starts(log.time, slotsize)
+        if len(keys) == 0:
+            raise ValueError("Empty scan log")
+        # Fill in empty timeslots, see timeslot_list
+        self._set_slots(np.unique(keys), slotsize)
+        rows = np.searchsorted(self.slots, keys)
+
+        self.broken = np.zeros(len(self.slots), dtype=bool)
+        self.broken[rows[log.broken]] = True
+
+        pos = np.nonzero(~log.broken)[0]
+        self._fill(log, slotsize, rows[pos], log.ident[pos],
+                   log.rssi[pos].astype(np.float64),
+                   np.ones(len(pos), dtype=np.int64), pos)
+
+    @classmethod
+    def merged(cls, base, log, slotsize):
+        """Derive the SlotMatrix of a slotsize that is a multiple of the
+        slotsize of base, by merging its timeslots.
+
+        Only the stored values of base (and the observations of its fallback
+        rows) are regrouped, the result is identical to
+        SlotMatrix(log, slotsize).
+        :param base: The SlotMatrix of a finer slotsize
+        :param log: The ScanLog base was built from
+        :param slotsize: The slotsize in seconds
+        """
+        rv = cls.__new__(cls)
+        # Timeslot of every row of base
+        coarse = slot_starts(base.slots, slotsize)
+        fallback = sorted(base.fallback)
+        observed = (np.diff(base.indptr) > 0) | base.broken
+        observed[fallback] = True
+        rv._set_slots(np.unique(coarse[observed]), slotsize)
+        rows = np.searchsorted(rv.slots, coarse)
+
+        rv.broken = np.zeros(len(rv.slots), dtype=bool)
+        rv.broken[rows[base.broken]] = True
+
+        # The fallback rows of base hold single observations
+        pos = [base.fallback_pos[row] for row in fallback]
+        lengths = [len(p) for p in pos]
+        pos = np.concatenate(pos) if pos else np.zeros(0, dtype=np.int64)
+        rv._fill(log, slotsize,
+                 np.concatenate([np.repeat(rows, np.diff(base.indptr)),
+                                 np.repeat(rows[fallback], lengths)]),
+                 np.concatenate([base.indices, log.ident[pos]]),
+                 np.concatenate([base.sums, log.rssi[pos]]),
+                 np.concatenate([base.counts,
+                                 np.ones(len(pos), dtype=np.int64)]),
+                 np.concatenate([base.order, pos]))
+        return rv
+
+    def _set_slots(self, observed, slotsize):
+        # Include the empty timeslots between the observed ones
+        step = slotsize * 1000000
+        self.slots = np.union1d(observed,
+                                np.arange(observed[0], observed[-1], step))
+
+    def _fill(self, log, slotsize, rows, cols, sums, counts, pos):
+        # Build the CSR arrays from (partial) sums of the RSSI values per
+        # row, identifier and (first) position in the log
+
+        # Sort the observations by slot, identifier and position in the log
+        perm = np.lexsort((pos, cols, rows))
+        pos, rows, cols = pos[perm], rows[perm], cols[perm]
+        sums, counts = sums[perm], counts[perm]
+
+        # Find runs of repeated identifiers within a timeslot
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+        starts = np.nonzero(first)[0]
+
+        self.fallback = {}
+        self.fallback_pos = {}
+        if slotsize >= 20:
+            # As per sect. IV.B of the paper, if a single BSSID is found more
+            # than once in the timeslot, its RSSI is set to the mean of all
+            # observed values.
+            if len(sums) > 0:
+                sums = np.add.reduceat(sums, starts)
+                counts = np.add.reduceat(counts, starts)
+            rows, cols, pos = rows[starts], cols[starts], pos[starts]
+            rssi = sums / counts
+        else:
+            if len(starts) < len(rows):
+                for row in np.unique(rows[~first]):
+                    sel = np.sort(pos[rows == row])
+                    self.fallback[row] = ScanSet(
+                        Measurement(str(ident), int(value), None)
+                        for ident, value in zip(log.ident[sel],
+                                                log.rssi[sel]))
+                    self.fallback_pos[row] = sel
+                keep = ~np.isin(rows, list(self.fallback))
+                rows, cols, pos = rows[keep], cols[keep], pos[keep]
+                sums, counts = sums[keep], counts[keep]
+            # Every value is a single observation
+            rssi = sums
+
+        self.indptr = np.searchsorted(rows, np.arange(len(self.slots) + 1))
+        self.indices = cols
+        self.data = rssi
+        self.sums = sums
+        self.counts = counts
+        # The position in the log orders the values within their slot
+        self.order = pos
+        self.n_idents = int(cols.max()) + 1 if len(cols) > 0 else 0
+
+    def matrix(self, rows, n_idents):
+        """Return the CSR matrix of the given rows with n_idents columns."""
+        m = csr_matrix((self.data, self.indices, self.indptr),
+                       shape=(len(self.slots), n_idents))
+        return m[rows]
+
+    def scan_set(self, row):
+        """Return the population of a single timeslot as a ScanSet."""
+        if row in self.fallback:
+            return self.fallback[row]
+        lo, hi = self.indptr[row], self.indptr[row + 1]
+        sel = lo + np.argsort(self.order[lo:hi], kind="mergesort")
+        rv = ScanSet()
+        for ident, rssi in zip(self.indices[sel], self.data[sel]):
+            rv.add(str(ident), rssi)
+        return rv
+
+
+def slot_matrices(log, slotsizes, matrices=None):
+    """Build the SlotMatrix of a ScanLog for several slotsizes.
+
+    Whenever a slotsize is a multiple of a smaller one, its SlotMatrix is
+    derived by merging the timeslots of the largest such SlotMatrix instead
+    of bucketing the scan log again (see SlotMatrix.merged).
+    :param matrices: An optional dictionary of SlotMatrix objects of the log
+        that were built before and may be merged
+    :return: A dictionary mapping every slotsize to its SlotMatrix
+    """
+    available = dict(matrices or {})
+    rv = {}
+    for slotsize in sorted(set(slotsizes)):
+        finer = [size for size in available if slotsize % size == 0]
+        if slotsize in available:
+            rv[slotsize] = available[slotsize]
+        elif finer:
+            rv[slotsize] = SlotMatrix.merged(available[max(finer)], log,
+                                             slotsize)
+        else:
+            rv[slotsize] = SlotMatrix(log, slotsize)
+        available[slotsize] = rv[slotsize]
+    return rv
+
+
+def intersect_positions(keys1, keys2):
+    """Return the positions of the common values of two arrays of unique
+    values, like np.intersect1d(..., return_indices=True) (NumPy 1.15+).
+
+    :return: A tuple (i1, i2) of the positions in both arrays, ordered by
+        the common values
+    """
+    order1 = np.argsort(keys1, kind="mergesort")
+    order2 = np.argsort(keys2, kind="mergesort")
+    sorted1 = np.asarray(keys1)[order1]
+    sorted2 = np.asarray(keys2)[order2]
+    pos = np.searchsorted(sorted2, sorted1)
+    found = pos < len(sorted2)
+    found[found] = sorted2[pos[found]] == sorted1[found]
+    return order1[found], order2[pos[found]]
+
+
+def sparse_features(sm1, sm2, default=-100, features=WIFI_FEATURES,
+                    slots=None, bitsets=False):
+    """Compute the features for all timeslots of two SlotMatrix objects.
+
+    This is the vectorized equivalent of the timeslot loop in compute, and
+    returns a result dictionary of the same shape. Jaccard distance, mean
+    Hamming and Euclidean distance are identical for integer RSSI values;
+    the remaining features may differ in the last bits due to a different
+    summation order.
+    If slots (an array of slot starts) is given, only these timeslots are
+    evaluated and returned. If bitsets is True, the set cardinalities are
+    computed with popcount on packed bitsets (see bitset_cardinalities).
+    """
+    rv = {}
+    strings1 = slot_strings(sm1.slots)
+    if slots is None:
+        for tstr in strings1:
+            rv[tstr] = {}
+    else:
+        for row in np.nonzero(np.isin(sm1.slots, slots))[0]:
+            rv[strings1[row]] = {}
+
+    # Align the timeslots of both sensors
+    rows1, rows2 = intersect_positions(sm1.slots, sm2.slots)
+    if slots is not None:
+        selected = np.isin(sm1.slots[rows1], slots)
+        rows1, rows2 = rows1[selected], rows2[selected]
+    error = sm1.broken[rows1] | sm2.broken[rows2]
+    for row in rows1[error]:
+        rv[strings1[row]]["error"] = "Scan error in sample, no feature computed"
+    rows1, rows2 = rows1[~error], rows2[~error]
+
+    # Slots with repeated identifiers are handled by the list implementation
+    fallback = np.array([r1 in sm1.fallback or r2 in sm2.fallback
+                         for r1, r2 in zip(rows1, rows2)], dtype=bool)
+    for r1, r2 in zip(rows1[fallback], rows2[fallback]):
+        rv[strings1[r1]].update(slot_features(
+            sm1.scan_set(r1), sm2.scan_set(r2), default, features))
+    rows1, rows2 = rows1[~fallback], rows2[~fallback]
+
+    n_idents = max(sm1.n_idents, sm2.n_idents)
+    m1 = sm1.matrix(rows1, n_idents)
+    m2 = sm2.matrix(rows2, n_idents)
+
+    # Set cardinalities
+    if bitsets:
+        n1, n2, n_inter = bitset_cardinalities(m1, m2)
+    else:
+        n1 = np.diff(m1.indptr)
+        n2 = np.diff(m2.indptr)
+        p1 = m1.copy()
+        p1.data = np.ones_like(p1.data)
+        p2 = m2.copy()
+        p2.data = np.ones_like(p2.data)
+        n_inter = np.asarray(p1.multiply(p2).sum(axis=1)).ravel()
+    n_union = n1 + n2 - n_inter
+    # Avoid dividing by zero for slots without observations on both sides
+    empty = n_union == 0
+    denom = np.where(empty, 1, n_union).astype(np.float64)
+
+    # Differences of the RSSI values in the union, with the default value for
+    # identifiers that were only observed by one of the sensors
+    shifted1 = m1.copy()
+    shifted1.data = shifted1.data - default
+    shifted2 = m2.copy()
+    shifted2.data = shifted2.data - default
+    diff = (shifted1 - shifted2).tocsr()
+    absdiff = abs(diff)
+
+    values = {}
+    if "jaccard" in features:
+        values["jaccard"] = 1.0 - n_inter / denom
+    if "euclidean" in features:
+        values["euclidean"] = np.sqrt(_row_sums(diff.multiply(diff)))
+    if "mean_hamming" in features:
+        values["mean_hamming"] = _row_sums(absdiff) / denom
+    if "mean_exp" in features:
+        # exp(0) = 1 for every element of the union which is not stored
+        expdiff = absdiff.copy()
+        expdiff.data = np.expm1(expdiff.data)
+        values["mean_exp"] = (_row_sums(expdiff) + n_union) / denom
+    if "sum_squared_ranks" in features:
+        values["sum_squared_ranks"] = _sparse_squared_ranks(
+            sm1, sm2, rows1, rows2)
+
+    for i, row in enumerate(rows1):
+        res = rv[strings1[row]]
+        for feature in features:
+            if empty[i]:
+                res[feature] = 0.0
+            elif feature == "sum_squared_ranks" and n_inter[i] == 0:
+                res[feature] = None
+            else:
+                res[feature] = float(values[feature][i])
+    return rv
+
+
+def bitsets(m, positions, n_words):
+    """Pack the sparsity pattern of a CSR matrix into bitsets.
+
+    :param m: The CSR matrix (one set per row)
+    :param positions: The bit position of every stored entry of m
+    :param n_words: The number of uint64 words of a bitset
+    :return: An array (rows x n_words) of uint64 words
+    """
+    rv = np.zeros(m.shape[0] * n_words, dtype=np.uint64)
+    rows = np.repeat(np.arange(m.shape[0]), np.diff(m.indptr))
+    # Identifiers are unique within a row, so adding the bits sets them
+    np.add.at(rv, rows * n_words + positions // 64,
+              np.left_shift(np.uint64(1), (positions % 64).astype(np.uint64)))
+    return rv.reshape(m.shape[0], n_words)
+
+
+def row_positions(m1, m2):
+    """Number the identifiers of the union of every pair of aligned rows of
+    two CSR matrices, in ascending order of the identifiers.
+
+    :return: A tuple (positions1, positions2, width) of the position of
+        every stored entry of both matrices within the union of its row, and
+        the size of the largest union
+    """
+    n_rows = m1.shape[0]
+    n_cols = max(m1.shape[1], m2.shape[1], 1)
+    keys = np.concatenate([
+        np.repeat(np.arange(n_rows, dtype=np.int64), np.diff(m.indptr)) *
+        n_cols + m.indices for m in (m1, m2)])
+    unique, inverse = np.unique(keys, return_inverse=True)
+    rows = unique // n_cols
+    starts = np.searchsorted(rows, np.arange(n_rows + 1))
+    local = np.arange(len(unique)) - starts[rows]
+    positions = local[inverse.ravel()]
+    width = int(np.diff(starts).max()) if n_rows > 0 else 0
+    return positions[:m1.nnz], positions[m1.nnz:], width
+
+
+def bitset_cardinalities(m1, m2):
+    """Compute the set sizes and the intersection size of the aligned rows
+    of two CSR matrices with packed bitsets.
+
+    The bit positions are numbered per pair of aligned rows (see
+    row_positions), so a bitset only has as many bits as the largest union
+    of the identifiers of a single timeslot, independent of the number of
+    identifiers of the whole deployment.
+    :return: The tuple (n1, n2, n_inter) of arrays
+    """
+    positions1, positions2, width = row_positions(m1, m2)
+    n_words = max(1, (width + 63) // 64)
+    b1 = bitsets(m1, positions1, n_words)
+    b2 = bitsets(m2, positions2, n_words)
+    return popcount(b1), popcount(b2), popcount(b1 & b2)
+
+
+def _row_sums(m):
+    """Sum up the rows of a sparse matrix into a flat array."""
+    return np.asarray(m.sum(axis=1), dtype=np.float64).ravel()
+
+
+def _sparse_squared_ranks(sm1, sm2, rows1, rows2):
+    """Compute the sum of squared ranks for aligned rows of two SlotMatrix
+    objects, see sum_squared_ranks.
+
+    All timeslots are ranked at once: the entries of the intersection are
+    sorted by (timeslot, descending rssi, order) and the inverse of that
+    permutation yields the rank within every timeslot."""
+    n_idents = max(sm1.n_idents, sm2.n_idents)
+    slot1, entries1 = _row_entries(sm1, rows1)
+    slot2, entries2 = _row_entries(sm2, rows2)
+    # Identifiers are unique within a row, so (slot, identifier) is a key
+    keys1 = slot1 * n_idents + sm1.indices[entries1]
+    keys2 = slot2 * n_idents + sm2.indices[entries2]
+    i1, i2 = intersect_positions(keys1, keys2)
+    slot = slot1[i1]
+    ranks1 = _ranks(slot, sm1.data[entries1[i1]], sm1.order[entries1[i1]])
+    ranks2 = _ranks(slot, sm2.data[entries2[i2]], sm2.order[entries2[i2]])
+    return np.bincount(slot, weights=(ranks1 - ranks2) ** 2.0,
+                       minlength=len(rows1))
+
+
+def _row_entries(sm, rows):
+    """Return the position (in rows) and the index into the CSR arrays of
+    every entry of the given rows of a SlotMatrix."""
+    starts = sm.indptr[rows]
+    counts = sm.indptr[rows + 1] - starts
+    slot = np.repeat(np.arange(len(rows)), counts)
+    offsets = np.cumsum(counts) - counts
+    return slot, np.arange(counts.sum()) + np.repeat(starts - offsets, counts)
+
+
+def _ranks(slot, rssi, order):
+    """Rank values within their slot by descending rssi, ties broken by
+    their order."""
+    perm = np.lexsort((order, -rssi, slot))
+    # The first position of every slot in the sorted entries
+    first = np.searchsorted(slot[perm], slot[perm])
+    ranks = np.empty(len(perm))
+    ranks[perm] = np.arange(1, len(perm) + 1) - first
+    return ranks
+
+
+# ---------------
+# Sliding windows
+# ---------------
+class WindowState:
+    """Observations of one sensor within a sliding window.
+
+    The RSSI values of every identifier are kept as a running sum and count,
+    so that its mean RSSI (see sect. IV.B of the paper) can be updated in
+    constant time when a scan enters or leaves the window. The positions of
+    the observations of every identifier are queued, as observations leave
+    the window in the order in which they entered it."""
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = {}
+        self.positions = {}
+        self.broken = 0
+
+    def add(self, ident, rssi, pos=0):
+        """Add an observation (at position pos in the log) to the window."""
+        self.sums[ident] = self.sums.get(ident, 0) + rssi
+        self.counts[ident] = self.counts.get(ident, 0) + 1
+        self.positions.setdefault(ident, deque()).append(pos)
+
+    def remove(self, ident, rssi):
+        """Remove the oldest observation of an identifier from the window."""
+        count = self.counts[ident] - 1
+        if count == 0:
+            del self.sums[ident]
+            del self.counts[ident]
+            del self.positions[ident]
+        else:
+            self.sums[ident] -= rssi
+            self.counts[ident] = count
+            self.positions[ident].popleft()
+
+    def first(self, ident):
+        """Return the position of the first observation of an identifier."""
+        return self.positions[ident][0]
+
+    def mean(self, ident, default=None):
+        """Return the mean RSSI of an identifier, or default if it is not
+        in the window."""
+        if ident not in self.counts:
+            return default
+        return self.sums[ident] / float(self.counts[ident])
+
+
+class SlidingWindow:
+    """Running set statistics of two sensors over a sliding window.
+
+    Every identifier of the union contributes its squared, absolute and
+    exponential RSSI difference to running totals, which are updated
+    whenever its mean RSSI changes on one of the sides. Moving the window
+    thus costs time proportional to the number of scans entering and
+    leaving it. Only the sum of squared ranks is computed from scratch for
+    every window.
+    """
+
+    def __init__(self, default=-100):
+        self.default = default
+        self.states = (WindowState(), WindowState())
+        # Maps identifiers of the union to (squared, absolute, exponential
+        # difference, in intersection)
+        self.contrib = {}
+        self.totals = [0.0, 0.0, 0.0]
+        self.n_inter = 0
+
+    def add(self, side, ident, rssi, broken=False, pos=0):
+        """Add an observation of sensor side (0 or 1) to the window."""
+        if broken:
+            self.states[side].broken += 1
+        else:
+            self.states[side].add(ident, rssi, pos)
+            self._update(ident)
+
+    def remove(self, side, ident, rssi, broken=False):
+        """Remove an observation of sensor side (0 or 1) from the window."""
+        if broken:
+            self.states[side].broken -= 1
+        else:
+            self.states[side].remove(ident, rssi)
+            self._update(ident)
+
+    @property
+    def broken(self):
+        """True if one of the windows contains an error marker."""
+        return self.states[0].broken > 0 or self.states[1].broken > 0
+
+    def _update(self, ident):
+        """Replace the contribution of an identifier to the totals."""
+        old = self.contrib.pop(ident, None)
+        if old is not None:
+            # Subtracting a term that dominates its total loses precision,
+            # so the total is summed up again instead
+            if any(old[k] > 0.5 * self.totals[k] for k in range(3)):
+                self.totals = [sum(c[k] for c in self.contrib.values())
+                               for k in range(3)]
+            else:
+                for k in range(3):
+                    self.totals[k] -= old[k]
+            self.n_inter -= old[3]
+
+        s1, s2 = self.states
+        if ident in s1.counts or ident in s2.counts:
+            d = abs(s1.mean(ident, self.default) -
+                    s2.mean(ident, self.default))
+            new = (d * d, d, exp(d),
+                   int(ident in s1.counts and ident in s2.counts))
+            self.contrib[ident] = new
+            for k in range(3):
+                self.totals[k] += new[k]
+            self.n_inter += new[3]
+
+    def features(self, features=WIFI_FEATURES):
+        """Compute the features of the current window, see slot_features."""
+        n_union = len(self.contrib)
+        if n_union == 0:
+            return {feature: 0.0 for feature in features}
+        rv = {}
+        if "jaccard" in features:
+            rv["jaccard"] = 1.0 - self.n_inter / float(n_union)
+        if "euclidean" in features:
+            rv["euclidean"] = sqrt(max(self.totals[0], 0.0))
+        if "mean_hamming" in features:
+            rv["mean_hamming"] = self.totals[1] / n_union
+        if "mean_exp" in features:
+            rv["mean_exp"] = self.totals[2] / float(n_union)
+        if "sum_squared_ranks" in features:
+            if self.n_inter == 0:
+                rv["sum_squared_ranks"] = None
+            else:
+                ranks1 = self._ranks(0)
+                ranks2 = self._ranks(1)
+                s = 0.0
+                for ident in ranks1:
+                    s += abs(ranks1[ident] - ranks2[ident]) ** 2.0
+                rv["sum_squared_ranks"] = s
+        return rv
+
+    def _ranks(self, side):
+        """Rank the identifiers of the intersection by descending mean RSSI,
+        ties broken by their first observation in the window."""
+        state = self.states[side]
+        other = self.states[1 - side]
+        idents = [ident for ident in state.counts if ident in other.counts]
+        means = np.array([state.mean(ident) for ident in idents])
+        first = np.array([state.first(ident) for ident in idents])
+        perm = np.lexsort((first, -means))
+        ranks = np.empty(len(perm))
+        ranks[perm] = np.arange(1, len(perm) + 1)
+        return dict(zip(idents, ranks.tolist()))
+
+
+def sliding_features(log1, log2, window=30, step=5, default=-100,
+                     features=WIFI_FEATURES):
+    """Compute the features for overlapping windows of two ScanLogs.
+
+    Windows of window seconds start every step seconds (at multiples of
+    step since the epoch) between the first and the last observation of
+    log1. Repeated identifiers within a window are represented by their
+    mean RSSI, so the window must be at least MIN_WINDOW seconds long. For
+    window == step, this yields the timeslots of compute for slotsizes of 20
+    seconds and more that divide a minute.
+    :return: A result dictionary of the same shape as compute, keyed by
+        the start of every window
+    """
+    if window < MIN_WINDOW:
+        raise ValueError("Sliding windows must be at least {} seconds "
+                         "long".format(MIN_WINDOW))
+    if step < 1:
+        raise ValueError("The step of sliding windows must be positive")
+    width = window * 1000000
+    stride = step * 1000000
+    starts = np.arange(log1.time.min() // stride * stride,
+                       log1.time.max() + 1, stride)
+    first2, last2 = log2.time.min(), log2.time.max()
+
+    # The observations of both sensors in chronological order
+    columns = []
+    for log in (log1, log2):
+        perm = np.argsort(log.time, kind="mergesort")
+        columns.append((log.time[perm].tolist(), log.ident[perm].tolist(),
+                        log.rssi[perm].tolist(), log.broken[perm].tolist()))
+    heads = [0, 0]
+    tails = [0, 0]
+
+    sw = SlidingWindow(default)
+    rv = {}
+    for start, tstr in zip(starts.tolist(), slot_strings(starts)):
+        for side, (time, ident, rssi, broken) in enumerate(columns):
+            # Scans leaving the window...
+            while tails[side] < heads[side] and time[tails[side]] < start:
+                i = tails[side]
+                sw.remove(side, ident[i], rssi[i], broken[i])
+                tails[side] += 1
+            # ...scans between two windows (if step exceeds window)...
+            if tails[side] == heads[side]:
+                while heads[side] < len(time) and time[heads[side]] < start:
+                    heads[side] += 1
+                tails[side] = heads[side]
+            # ...and scans entering it
+            while heads[side] < len(time) and \
+                    time[heads[side]] < start + width:
+                i = heads[side]
+                sw.add(side, ident[i], rssi[i], broken[i], i)
+                heads[side] += 1
+
+        rv[tstr] = {}
+        if start + width <= first2 or start > last2:
+            # No observations of the second sensor for this window
+            continue
+        if sw.broken:
+            rv[tstr]["error"] = "Scan error in sample, no feature computed"
+            continue
+        rv[tstr].update(sw.features(features))
+    return rv
 
 
 # ------------------------
 # Main evaluation function
 # ------------------------
-def compute(file1, file2, default=-100, slotsize=10, mode=MODE_WIFI):
+def list_features(ts_pop1, ts_pop2, default=-100, features=WIFI_FEATURES):
+    """Compute the features for all timeslots of two populations, as
+    returned by timeslot_list."""
+    # Index every timeslot by identifier once, so that the individual
+    # features do not have to rebuild it
+    ts_pop1 = {ts: ScanSet(ts_pop1[ts]) for ts in ts_pop1}
+    ts_pop2 = {ts: ScanSet(ts_pop2[ts]) for ts in ts_pop2}
+
+    rv = {}
+    for ts in ts_pop1:
+        tstr = ts.strftime("%Y-%m-%d %H:%M:%S")
+        rv[tstr] = {}
+        pop1 = ts_pop1[ts]
+        # Find matching pop from pop2
+        if ts not in ts_pop2:
+            # print("[WARN] Timeslot " + tstr + " not in population 2, skipping")
+            # pop2 = []
+            continue
+        else:
+            pop2 = ts_pop2[ts]
+
+        if not (population_ok(pop1) and population_ok(pop2)):
+            rv[tstr]["error"] = "Scan error in sample, no feature computed"
+            continue
+
+        # Compute features
+        rv[tstr].update(slot_features(pop1, pop2, default, features))
+
+    # Compute features for left-over values from population 2
+    for ts in ts_pop2:
+        tstr = ts.strftime("%Y-%m-%d %H:%M:%S")
+        if tstr in rv:
+            # We have already evaluated this timestamp from the "other side"
+            continue
+        # Unmatched timestamp (i.e. no values with that timestamp on other end)
+        # print("[WARN] Timeslot " + tstr + " not in population 1, skipping")
+        # rv[tstr] = {}
+        # pop1 = []
+        # pop2 = ts_pop2[ts]
+        # rv[tstr]["jaccard"] = jaccard_dist(pop1, pop2, default)
+        # rv[tstr]["euclidean"] = euclidean_distance(pop1, pop2, default)
+        # if mode == MODE_WIFI:
+        #     rv[tstr]["mean_hamming"] = mean_hamming_dist(pop1, pop2, default)
+        #     rv[tstr]["mean_exp"] = mean_exp_difference(pop1, pop2, default)
+        #     rv[tstr]["sum_squared_ranks"] = sum_squared_ranks(pop1, pop2)
+
+    # Return
+    return rv
+
+
+def compute(file1, file2, default=-100, slotsize=10, mode=MODE_WIFI,
+            engine=ENGINE_LIST, step=None):
     """Compute features for results saved in two files
 
     The parameters are:
     file1: The first file
     file2: The second file
     default: The default rssi value for the union function
-    slotsize: The slotsize to divide measurements into
+    slotsize: The slotsize to divide measurements into, or a list of
+        slotsizes. For a list, the files are read only once and a dictionary
+        mapping every slotsize to its results is returned.
     mode: MODE_WIFI or MODE_BLE
+    engine: ENGINE_LIST, ENGINE_SPARSE or ENGINE_BITSET (both require blinded
+        identifiers)
+    step: If given, the features are computed for sliding windows of
+        slotsize seconds every step seconds (see sliding_features, requires
+        blinded identifiers) instead of disjoint timeslots
     """
     try:
-        # Read in result files
-        pop1 = read_results(file1)
-        pop2 = read_results(file2)
-        assert pop1 is not None
-        assert pop2 is not None
-
-        # Split into timeslots
-        ts_pop1 = timeslot_list(pop1, slotsize)
-        ts_pop2 = timeslot_list(pop2, slotsize)
-        assert ts_pop1 is not None
-        assert ts_pop2 is not None
+        # The WiFi-only features are skipped for BLE
+        features = WIFI_FEATURES if mode == MODE_WIFI else BLE_FEATURES
+        multiple = isinstance(slotsize, (list, tuple))
+        slotsizes = slotsize if multiple else [slotsize]
 
         rv = {}
-        for ts in ts_pop1:
-            tstr = ts.strftime("%Y-%m-%d %H:%M:%S")
-            rv[tstr] = {}
-            pop1 = ts_pop1[ts]
-            # Find matching pop from pop2
-            if ts not in ts_pop2:
-                # print("[WARN] Timeslot " + tstr + " not in population 2, skipping")
-                # pop2 = []
-                continue
-            else:
-                pop2 = ts_pop2[ts]
+        if step is not None:
+            log1 = read_results_columnar(file1)
+            log2 = read_results_columnar(file2)
+            for size in slotsizes:
+                rv[size] = sliding_features(log1, log2, size, step, default,
+                                            features)
+        elif engine in (ENGINE_SPARSE, ENGINE_BITSET):
+            sms1 = slot_matrices(read_results_columnar(file1), slotsizes)
+            sms2 = slot_matrices(read_results_columnar(file2), slotsizes)
+            for size in slotsizes:
+                rv[size] = sparse_features(sms1[size], sms2[size], default,
+                                           features,
+                                           bitsets=engine == ENGINE_BITSET)
+        else:
+            # Read in result files
+            pop1 = read_results(file1)
+            pop2 = read_results(file2)
+            assert pop1 is not None
+            assert pop2 is not None
 
-            if not (population_ok(pop1) and population_ok(pop2)):
-                rv[tstr]["error"] = "Scan error in sample, no feature computed"
-                continue
+            for size in slotsizes:
+                # Split into timeslots
+                ts_pop1 = timeslot_list(pop1, size)
+                ts_pop2 = timeslot_list(pop2, size)
+                assert ts_pop1 is not None
+                assert ts_pop2 is not None
 
-            # Compute features
-            rv[tstr]["jaccard"] = jaccard_dist(pop1, pop2, default)
-            rv[tstr]["euclidean"] = euclidean_distance(pop1, pop2, default)
-            if mode == MODE_WIFI:
-                rv[tstr]["mean_hamming"] = mean_hamming_dist(pop1, pop2, default)
-                rv[tstr]["mean_exp"] = mean_exp_difference(pop1, pop2, default)
-                rv[tstr]["sum_squared_ranks"] = sum_squared_ranks(pop1, pop2)
-
-        # Compute features for left-over values from population 2
-        for ts in ts_pop2:
-            tstr = ts.strftime("%Y-%m-%d %H:%M:%S")
-            if tstr in rv:
-                # We have already evaluated this timestamp from the "other side"
-                continue
-            # Unmatched timestamp (i.e. no values with that timestamp on other end)
-            # print("[WARN] Timeslot " + tstr + " not in population 1, skipping")
-            # rv[tstr] = {}
-            # pop1 = []
-            # pop2 = ts_pop2[ts]
-            # rv[tstr]["jaccard"] = jaccard_dist(pop1, pop2, default)
-            # rv[tstr]["euclidean"] = euclidean_distance(pop1, pop2, default)
-            # if mode == MODE_WIFI:
-            #     rv[tstr]["mean_hamming"] = mean_hamming_dist(pop1, pop2, default)
-            #     rv[tstr]["mean_exp"] = mean_exp_difference(pop1, pop2, default)
-            #     rv[tstr]["sum_squared_ranks"] = sum_squared_ranks(pop1, pop2)
+                rv[size] = list_features(ts_pop1, ts_pop2, default, features)
 
         # Return
-        return rv
+        return rv if multiple else rv[slotsize]
     except Exception:
         traceback.print_exc()
 
 
-def process_wifi(file_tuple, slotsize=10, default=-100):
-    try:
-        pop1, pop2 = file_tuple
-        # Get sensor ID from path
-        no1 = pop1[0:9]
-        no2 = pop2[0:9]
+def save_results(file_tuple, feature, slotsizes, metadata, results,
+                 step=None, store=False):
+    """Save the results for a pair of files, one file per slotsize.
+
+    :param file_tuple: The two input files
+    :param feature: The feature name ("wifi" or "ble")
+    :param slotsizes: The list of slotsizes
+    :param metadata: The metadata, as returned by create_metadata
+    :param results: A dictionary mapping every slotsize to its results
+    :param step: The step of sliding windows, if any (saved as a separate
+        parameter)
+    :param store: If True, the results are written as chunks of a
+        ResultStore instead, and their entries are returned (see
+        store_result)
+    """
+    # Get sensor ID from path
+    no1 = file_tuple[0][0:9]
+    no2 = file_tuple[1][0:9]
 
+    # Save timestamp of finished processing
+    processing_end = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    outputs = []
+    for slotsize in slotsizes:
         params = {
             "chunk_len": slotsize,
         }
+        if step is not None:
+            params["step"] = step
 
         # Prepare results dictionary
         rv = {}
-        rv["metadata"] = create_metadata([pop1, pop2], SCRIPT, params=params)
-
-        # Compute and save the features
-        # print("[WIFI] Computing features for Sensors", no1, "and", no2)
-        rv["results"] = compute(pop1, pop2, default=default, slotsize=slotsize,
-                                mode=MODE_WIFI)
-
-        # Save timestamp of finished processing
-        rv["metadata"]["processing_end"] = \
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        rv["metadata"] = dict(metadata, parameters=params,
+                              processing_end=processing_end)
+        rv["results"] = results[slotsize] if results is not None else None
+        if store:
+            outputs.append(store_result(feature, SCRIPT, no1, no2, rv,
+                                        params))
+            continue
 
         # Save result json to file
-        path = derive_result_path(no1, "wifi", SCRIPT, no2, params=params)
+        path = derive_result_path(no1, feature, SCRIPT, no2, params=params)
         with open(path, "w") as fo:
             fo.write(dumps(rv, indent=4, sort_keys=True))
 
         # Redundant save for the other direction (Sensor2 -> Sensor1)
-        # path = derive_result_path(no2, "wifi", SCRIPT, no1, params=params)
+        # path = derive_result_path(no2, feature, SCRIPT, no1, params=params)
         # with open(path, "w") as fo:
         #     fo.write(dumps(rv, indent=4, sort_keys=True))
-    except Exception:
-        print("Exception on WIFI pair", file_tuple)
-        traceback.print_exc()
+    return outputs
 
 
-def process_ble(file_tuple, slotsize=10, default=-100):
+def process_wifi(file_tuple, slotsize=10, default=-100, engine=ENGINE_LIST,
+                 step=None, store=False):
     try:
-        # Get Sensor ID from path
         pop1, pop2 = file_tuple
-        no1 = pop1[0:9]
-        no2 = pop2[0:9]
+        # A single task can compute several slotsizes
+        slotsizes = list(slotsize) if isinstance(slotsize, (list, tuple)) \
+            else [slotsize]
 
-        params = {
-            "chunk_len": slotsize,
-        }
+        # Prepare metadata
+        metadata = create_metadata([pop1, pop2], SCRIPT)
 
-        # Prepare results dictionary
-        rv = {}
-        rv["metadata"] = create_metadata([pop1, pop2], SCRIPT, params=params)
+        # Compute and save the features
+        # print("[WIFI] Computing features for Sensors", pop1, "and", pop2)
+        results = compute(pop1, pop2, default=default, slotsize=slotsizes,
+                          mode=MODE_WIFI, engine=engine, step=step)
+        return save_results(file_tuple, "wifi", slotsizes, metadata, results,
+                            step, store)
+    except Exception:
+        print("Exception on WIFI pair", file_tuple)
+        traceback.print_exc()
+        return []
 
-        # Compute results
-        rv["results"] = compute(pop1, pop2, default=-100, slotsize=slotsize,
-                                mode=MODE_BLE)
 
-        # Save timestamp of finished processing
-        rv["metadata"]["processing_end"] = \
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+def process_ble(file_tuple, slotsize=10, default=-100, engine=ENGINE_LIST,
+                step=None, store=False):
+    try:
+        pop1, pop2 = file_tuple
+        # A single task can compute several slotsizes
+        slotsizes = list(slotsize) if isinstance(slotsize, (list, tuple)) \
+            else [slotsize]
 
-        # Save result json to file
-        path = derive_result_path(no1, "ble", SCRIPT, no2, params=params)
-        with open(path, "w") as fo:
-            fo.write(dumps(rv, indent=4, sort_keys=True))
+        # Prepare metadata
+        metadata = create_metadata([pop1, pop2], SCRIPT)
 
-        # Redundant save for the other direction (Sensor2 -> Sensor1)
-        # path = derive_result_path(no2, "ble", SCRIPT, no1, params=params)
-        # with open(path, "w") as fo:
-        #     fo.write(dumps(rv, indent=4, sort_keys=True))
+        # Compute results
+        results = compute(pop1, pop2, default=-100, slotsize=slotsizes,
+                          mode=MODE_BLE, engine=engine, step=step)
+        return save_results(file_tuple, "ble", slotsizes, metadata, results,
+                            step, store)
     except Exception:
         print("Exception on BLE pair", file_tuple)
         traceback.print_exc()
+        return []
+
+
+# --------------
+# All-pairs mode
+# --------------
+# Columns of a ScanLog that are shared between the worker processes
+SHARED_COLUMNS = ("ident", "rssi", "time", "broken")
+
+# Worker state of the all-pairs mode: the shared scan logs, their file names
+# and the slot matrices derived from them
+_SHARED = {"blocks": [], "files": [], "logs": [], "matrices": {}}
+
+
+def publish_logs(files, logs):
+    """Copy the scan logs of several sensors into shared memory.
+
+    :param files: The names of the files the logs were read from
+    :param logs: A list of ScanLogs
+    :return: The list of SharedMemory blocks (to be closed and unlinked by
+        the caller), and a picklable descriptor for attach_logs.
+    """
+    # Shared memory requires Python 3.8+, only the all-pairs mode uses it
+    from multiprocessing.shared_memory import SharedMemory
+    blocks = []
+    columns = {}
+    for column in SHARED_COLUMNS:
+        data = np.concatenate([getattr(log, column) for log in logs])
+        block = SharedMemory(create=True, size=max(data.nbytes, 1))
+        np.ndarray(data.shape, dtype=data.dtype, buffer=block.buf)[:] = data
+        blocks.append(block)
+        columns[column] = (block.name, data.dtype.str, len(data))
+    offsets = np.cumsum([0] + [len(log) for log in logs]).tolist()
+    return blocks, {"files": list(files), "columns": columns,
+                    "offsets": offsets}
+
+
+def release_logs(blocks):
+    """Close and unlink the SharedMemory blocks returned by publish_logs."""
+    from multiprocessing import resource_tracker
+    for block in blocks:
+        block.close()
+        # Attaching workers may have removed the block from a resource
+        # tracker shared with this process, see _attach_block
+        if sys.version_info < (3, 13):
+            resource_tracker.register(block._name, "shared_memory")
+        block.unlink()
+
+
+def _attach_block(name):
+    # Attach to a SharedMemory block owned by another process. Before Python
+    # 3.13, attaching registers the block with the resource tracker, which
+    # then warns about a leaked segment and unlinks it when the worker exits
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    block = SharedMemory(name=name)
+    resource_tracker.unregister(block._name, "shared_memory")
+    return block
+
+
+def attach_logs(descriptor):
+    """Attach to scan logs published by publish_logs (Pool initializer)."""
+    arrays = {}
+    _SHARED["blocks"] = []
+    for column, (name, dtype, length) in descriptor["columns"].items():
+        block = _attach_block(name)
+        # Keep a reference, the arrays are only valid while the block is open
+        _SHARED["blocks"].append(block)
+        arrays[column] = np.ndarray((length,), dtype=dtype, buffer=block.buf)
+    offsets = descriptor["offsets"]
+    _SHARED["files"] = descriptor["files"]
+    _SHARED["logs"] = [
+        ScanLog(*[arrays[column][lo:hi] for column in SHARED_COLUMNS])
+        for lo, hi in zip(offsets[:-1], offsets[1:])]
+    _SHARED["matrices"] = {}
+
+
+def _shared_matrices(index, slotsizes):
+    """Return the (cached) SlotMatrix objects of a shared scan log."""
+    if index not in _SHARED["matrices"]:
+        _SHARED["matrices"][index] = {}
+    cache = _SHARED["matrices"][index]
+    missing = [slotsize for slotsize in slotsizes if slotsize not in cache]
+    if missing:
+        cache.update(slot_matrices(_SHARED["logs"][index], missing, cache))
+    return cache
+
+
+def process_pair_block(pairs, slotsizes=(10,), default=-100, mode=MODE_WIFI,
+                       bitsets=False, step=None, store=False):
+    """Compute and save the features for a block of sensor pairs.
+
+    :param pairs: A list of index tuples into the shared scan logs
+    :param step: If given, the features are computed for sliding windows
+        (see sliding_features)
+    :param store: If True, the results are written as chunks of a
+        ResultStore instead, see save_results
+    """
+    feature = "wifi" if mode == MODE_WIFI else "ble"
+    features = WIFI_FEATURES if mode == MODE_WIFI else BLE_FEATURES
+    outputs = []
+    for i, j in pairs:
+        file_tuple = (_SHARED["files"][i], _SHARED["files"][j])
+        try:
+            # Prepare metadata
+            metadata = create_metadata(list(file_tuple), SCRIPT)
+
+            # Compute and save the features
+            results = {}
+            if step is not None:
+                for slotsize in slotsizes:
+                    results[slotsize] = sliding_features(
+                        _SHARED["logs"][i], _SHARED["logs"][j], slotsize,
+                        step, default, features)
+            else:
+                sms1 = _shared_matrices(i, slotsizes)
+                sms2 = _shared_matrices(j, slotsizes)
+                for slotsize in slotsizes:
+                    results[slotsize] = sparse_features(
+                        sms1[slotsize], sms2[slotsize], default, features,
+                        bitsets=bitsets)
+            outputs += save_results(file_tuple, feature, slotsizes, metadata,
+                                    results, step, store)
+        except Exception:
+            print("Exception on", feature.upper(), "pair", file_tuple)
+            traceback.print_exc()
+    return outputs
+
+
+def _init_pair_worker(descriptor, context):
+    # Pool initializer of the all-pairs mode
+    init_run_context(context)
+    attach_logs(descriptor)
+
+
+def _result_params(slotsizes, step=None):
+    for slotsize in slotsizes:
+        params = {"chunk_len": slotsize}
+        if step is not None:
+            params["step"] = step
+        yield params
+
+
+def result_dirs(files, feature, slotsizes, step=None):
+    """Return the result folders of all pairs of the given files."""
+    for pop in files[:-1]:
+        for params in _result_params(slotsizes, step):
+            yield result_dir(pop[0:9], feature, SCRIPT, params)
+
+
+def pair_outputs(file_tuple, feature, slotsizes, step=None):
+    """Return the result files of a pair of files, see select_tasks."""
+    return [(result_path(file_tuple[0][0:9], feature, SCRIPT,
+                         file_tuple[1][0:9], params), list(file_tuple), params)
+            for params in _result_params(slotsizes, step)]
+
+
+def process_all_pairs(files, mode=MODE_WIFI, slotsizes=(10,), default=-100,
+                      processes=None, bitsets=False, force=True, store=False,
+                      step=None):
+    """Compute the features for all pairs of the given files.
+
+    Every file is parsed only once. The parsed scan logs are published to
+    the worker processes through shared memory, and each worker processes
+    blocks of pairs, so that a SlotMatrix is built at most once per worker
+    and sensor. Unless force is set, pairs whose results are up to date are
+    skipped (see select_tasks). With store, the results are saved in one
+    ResultStore per slot size instead of per-pair json files. With step,
+    sliding windows are computed from the shared scan logs instead.
+    """
+    if len(files) < 2:
+        return
+    processes = processes or cpu_count()
+    feature = "wifi" if mode == MODE_WIFI else "ble"
+    context = create_run_context(result_dirs(files, feature, slotsizes,
+                                             step))
+    init_run_context(context)
+    pairs = select_tasks(
+        combinations(range(len(files)), 2),
+        lambda pair: pair_outputs((files[pair[0]], files[pair[1]]), feature,
+                                  slotsizes, step),
+        force=force, name=feature + " pairs")
+    if not pairs:
+        return
+
+    # Parse every file exactly once
+    with Pool(processes=processes) as pool:
+        logs = pool.map(read_results_columnar, files)
+
+    blocks, descriptor = publish_logs(files, logs)
+    del logs
+    try:
+        size = max(1, len(pairs) // (processes * 4))
+        chunks = [pairs[i:i + size] for i in range(0, len(pairs), size)]
+        with Pool(processes=processes, initializer=_init_pair_worker,
+                  initargs=(descriptor, context)) as pool:
+            func = partial(process_pair_block, slotsizes=list(slotsizes),
+                           default=default, mode=mode, bitsets=bitsets,
+                           step=step, store=store)
+            outputs = [output for block in pool.imap_unordered(func, chunks)
+                       for output in block]
+        if store:
+            for path in save_stores(outputs, SCRIPT):
+                print("[INFO] Saved", path)
+    finally:
+        release_logs(blocks)
+
+
+# --------------
+# Streaming mode
+# --------------
+class StreamingEvaluator:
+    """Compute the features for timeslots of live scan logs.
+
+    Samples of several sources (sensors) are added as they arrive. Once a
+    timeslot has ended and an additional grace period has passed, the slot is
+    closed: the features are computed for all pairs of sources, and the
+    samples of the slot are discarded. Samples arriving for a closed slot are
+    dropped, so the memory use is bounded by the number of open slots.
+    """
+
+    def __init__(self, sources, slotsize=10, grace=1.0, default=-100,
+                 mode=MODE_WIFI, emit=None):
+        """Initialize the evaluator.
+
+        :param sources: The names of the sources
+        :param slotsize: The slotsize in seconds
+        :param grace: Time (in seconds) to wait for late samples after the end
+            of a timeslot
+        :param default: The default rssi value for the union
+        :param mode: MODE_WIFI or MODE_BLE
+        :param emit: Function called with a result dictionary for every pair
+            and closed timeslot (default: print it as JSON)
+        """
+        self.sources = list(sources)
+        self.slotsize = slotsize
+        self.step = slotsize * 1000000
+        self.grace = int(grace * 1000000)
+        self.default = default
+        self.features = WIFI_FEATURES if mode == MODE_WIFI else BLE_FEATURES
+        self.emit = emit or (lambda result: print(dumps(result, sort_keys=True),
+                                                  flush=True))
+        # Open timeslots: slot start -> source -> list of (ident, rssi)
+        self.slots = {}
+        # Time of the first and latest sample of every source
+        self.first_seen = {source: None for source in self.sources}
+        self.last_seen = {source: None for source in self.sources}
+        # Start of the next timeslot to close
+        self.next_slot = None
+        # Number of samples that arrived after their slot was closed
+        self.dropped = 0
+
+    def add(self, source, ident, rssi, time):
+        """Add a sample (time in microseconds since the epoch)."""
+        slot = int(slot_starts(time, self.slotsize))
+        if self.next_slot is not None and slot < self.next_slot:
+            self.dropped += 1
+            return
+        if self.first_seen[source] is None or time < self.first_seen[source]:
+            self.first_seen[source] = time
+        if self.last_seen[source] is None or time > self.last_seen[source]:
+            self.last_seen[source] = time
+        samples = self.slots.setdefault(slot, {})
+        samples.setdefault(source, []).append((ident.lower(), rssi))
+
+    def add_line(self, source, line_parser, line):
+        """Parse a line of a scan log and add the contained sample."""
+        sample = line_parser.parse(line)
+        if sample is None:
+            return
+        ident, rssi, timestring, _ = sample
+        self.add(source, ident, int(rssi), int(parse_timestamps([timestring])[0]))
+
+    def close(self, now):
+        """Close all timeslots that ended more than the grace period before
+        now (in microseconds since the epoch), and emit their results."""
+        if self.next_slot is None:
+            if not self.slots:
+                return
+            self.next_slot = min(self.slots)
+        while self.next_slot + self.step + self.grace <= now:
+            self._close_slot(self.next_slot)
+            self.next_slot = int(slot_starts(self.next_slot + self.step,
+                                             self.slotsize))
+
+    def _close_slot(self, slot):
+        samples = self.slots.pop(slot, {})
+        tstr = slot_strings(np.array([slot]))[0]
+        pops = {}
+        for source in self.sources:
+            # Skip sources that were not running during this slot
+            if self.first_seen[source] is None or \
+                    self.first_seen[source] >= slot + self.step or \
+                    self.last_seen[source] < slot:
+                continue
+            pop = ScanSet()
+            if self.slotsize >= 20:
+                # Average repeated identifiers, see timeslot_list
+                observed = {}
+                for ident, rssi in samples.get(source, []):
+                    observed.setdefault(ident, []).append(rssi)
+                for ident in observed:
+                    pop.add(ident, mean(observed[ident]))
+            else:
+                for ident, rssi in samples.get(source, []):
+                    pop.add(ident, rssi)
+            pops[source] = pop
+        for source1, source2 in combinations(self.sources, 2):
+            if source1 not in pops or source2 not in pops:
+                continue
+            result = {"time": tstr, "sensors": [source1, source2]}
+            if not (population_ok(pops[source1]) and
+                    population_ok(pops[source2])):
+                result["error"] = "Scan error in sample, no feature computed"
+            else:
+                result.update(slot_features(pops[source1], pops[source2],
+                                            self.default, self.features))
+            self.emit(result)
+
+
+def follow(filename, poll=0.2, offset=None):
+    """Yield the lines of a file as they are appended (like tail -f).
+
+    Regular files are read from offset, by default from their current end,
+    so that only lines appended afterwards are yielded. Pipes and other
+    non-seekable files are simply read until they end."""
+    with open(filename, "r") as fo:
+        if fo.seekable():
+            if offset is None:
+                fo.seek(0, SEEK_END)
+            else:
+                fo.seek(offset)
+        buf = ""
+        while True:
+            line = fo.readline()
+            if not line:
+                if not fo.seekable():
+                    break
+                sleep(poll)
+                continue
+            buf += line
+            # Only yield complete lines
+            if buf.endswith("\n"):
+                yield buf
+                buf = ""
+
+
+def replay(filename, evaluator, line_parser):
+    """Add the complete lines of a regular file to a StreamingEvaluator.
+
+    :return: The offset after the last complete line (to continue with
+        follow), or None if the file is not seekable
+    """
+    with open(filename, "r") as fo:
+        if not fo.seekable():
+            return None
+        offset = 0
+        for line in iter(fo.readline, ""):
+            if not line.endswith("\n"):
+                break
+            evaluator.add_line(filename, line_parser, line)
+            offset = fo.tell()
+    return offset
+
+
+def stream(filenames, slotsize=10, grace=1.0, default=-100, mode=MODE_WIFI,
+           from_start=False):
+    """Compute features for live scan logs (or pipes) until interrupted.
+
+    Every file is read in its own thread, and the timeslots are closed based
+    on the local wall clock time, which is used by the capture scripts for
+    their timestamps as well. Only lines appended to regular files after the
+    start are evaluated, unless from_start is set: then the complete lines
+    already in the files are added first, before any timeslot is closed."""
+    evaluator = StreamingEvaluator(filenames, slotsize, grace, default, mode)
+    lines = Queue()
+
+    def reader(filename, offset):
+        for line in follow(filename, offset=offset):
+            lines.put((filename, line))
+
+    parsers = {}
+    offsets = {}
+    for filename in filenames:
+        parsers[filename] = ScanLineParser(filename)
+        if from_start:
+            offsets[filename] = replay(filename, evaluator, parsers[filename])
+    for filename in filenames:
+        Thread(target=reader, args=(filename, offsets.get(filename)),
+               daemon=True).start()
+
+    while True:
+        try:
+            filename, line = lines.get(timeout=0.1)
+            evaluator.add_line(filename, parsers[filename], line)
+        except Empty:
+            pass
+        evaluator.close(to_epoch_us(datetime.now()))
 
 
 if __name__ == "__main__":
+    arg_parser = ArgumentParser(description="Compute the features of Truong "
+                                "et al. for all pairs of sensors.")
+    arg_parser.add_argument("--all-pairs", action="store_true",
+                            help="parse every sensor file only once and "
+                            "share it with the workers (sparse engine)")
+    arg_parser.add_argument("--stream", nargs="+", metavar="FILE",
+                            help="compute the features of live scan logs or "
+                            "pipes, printing one JSON line per pair and slot")
+    arg_parser.add_argument("--slotsize", type=int, default=10,
+                            help="slot size for --stream (default: 10)")
+    arg_parser.add_argument("--grace", type=float, default=1.0,
+                            help="seconds to wait for late samples for "
+                            "--stream (default: 1)")
+    arg_parser.add_argument("--ble", action="store_true",
+                            help="the --stream files contain BLE scans")
+    arg_parser.add_argument("--from-start", action="store_true",
+                            help="also evaluate the lines already in the "
+                            "--stream files (default: only appended lines)")
+    arg_parser.add_argument("--step", type=int,
+                            help="compute sliding windows of every slot size "
+                            "of at least {} seconds, starting every STEP "
+                            "seconds".format(MIN_WINDOW))
+    arg_parser.add_argument("--bitsets", action="store_true",
+                            help="compute set cardinalities with popcount "
+                            "on packed bitsets (blinded identifiers only)")
+    arg_parser.add_argument("--force", action="store_true",
+                            help="also recompute results that are up to "
+                            "date")
+    arg_parser.add_argument("--store", action="store_true",
+                            help="save the results of all pairs in one "
+                            "columnar result store per feature and slot size")
+    arg_parser.add_argument("--export-store", action="store_true",
+                            help="export all result stores to per-pair json "
+                            "files")
+    args = arg_parser.parse_args()
+
+    if args.export_store:
+        export_stores(SCRIPT)
+        sys.exit(0)
+
+    if args.stream:
+        stream(args.stream, slotsize=args.slotsize, grace=args.grace,
+               mode=MODE_BLE if args.ble else MODE_WIFI,
+               from_start=args.from_start)
+        sys.exit(0)
+
+    # Sliding windows are only computed for the longer slot sizes, and
+    # should overlap
+    slotsizes = SLOT_SIZES
+    if args.step is not None:
+        slotsizes = [size for size in SLOT_SIZES if size >= MIN_WINDOW]
+        skipped = [size for size in SLOT_SIZES if size < MIN_WINDOW]
+        if not slotsizes or not 1 <= args.step <= min(slotsizes):
+            arg_parser.error("--step must be between 1 and the shortest "
+                             "sliding window ({} seconds)".format(
+                                 min(slotsizes or [MIN_WINDOW])))
+        if args.bitsets:
+            arg_parser.error("--bitsets can not be used with --step")
+        if skipped:
+            print("[INFO] Sliding windows need at least", MIN_WINDOW,
+                  "seconds, skipping slot sizes", skipped)
+
     # Prepare variables to hold stuff
     wifi_files = []
     ble_files = []
@@ -507,21 +1975,63 @@ if __name__ == "__main__":
     wifi_files.sort()
     ble_files.sort()
 
-    pool = Pool(processes=cpu_count(), maxtasksperchild=1)
-
-    # Compute results for different slot sizes
-    for slotsize in [10, 30]:
-        # Compute features for all combinations of WiFi files.
-        # If files 1, 2, 3 are available, this will compute features for:
-        # 1-2, 1-3, 2-3
-        pool.imap(partial(process_wifi, slotsize=slotsize),
-                  combinations(wifi_files, 2))
-
-        # Do the same for the BLE results
-        pool.imap(partial(process_ble, slotsize=slotsize),
-                  combinations(ble_files, 2))
+    if args.all_pairs:
+        process_all_pairs(wifi_files, MODE_WIFI, slotsizes=slotsizes,
+                          bitsets=args.bitsets, force=args.force or args.store,
+                          store=args.store, step=args.step)
+        process_all_pairs(ble_files, MODE_BLE, slotsizes=slotsizes,
+                          bitsets=args.bitsets, force=args.force or args.store,
+                          store=args.store, step=args.step)
+        sys.exit(0)
+
+    engine = ENGINE_BITSET if args.bitsets else ENGINE_LIST
+    # Query the metadata shared by all results and create the result folders
+    # once for the whole run
+    context = create_run_context(
+        list(result_dirs(wifi_files, "wifi", slotsizes, args.step)) +
+        list(result_dirs(ble_files, "ble", slotsizes, args.step)))
+    init_run_context(context)
+
+    # Skip the pairs whose results are up to date
+    wifi_pairs = select_tasks(
+        combinations(wifi_files, 2),
+        partial(pair_outputs, feature="wifi", slotsizes=slotsizes,
+                step=args.step), force=args.force or args.store,
+        name="wifi pairs")
+    ble_pairs = select_tasks(
+        combinations(ble_files, 2),
+        partial(pair_outputs, feature="ble", slotsizes=slotsizes,
+                step=args.step), force=args.force or args.store,
+        name="ble pairs")
+
+    pool = Pool(processes=cpu_count(), initializer=init_run_context,
+                initargs=(context,))
+
+    # Compute results for different slot sizes. Every task computes all slot
+    # sizes for one pair of files, so that they are only read once.
+    # Compute features for all combinations of WiFi files.
+    # If files 1, 2, 3 are available, this will compute features for:
+    # 1-2, 1-3, 2-3
+    wifi_outputs = pool.imap(partial(process_wifi, slotsize=slotsizes,
+                                     engine=engine, step=args.step,
+                                     store=args.store),
+                             wifi_pairs)
+
+    # Do the same for the BLE results
+    ble_outputs = pool.imap(partial(process_ble, slotsize=slotsizes,
+                                    engine=engine, step=args.step,
+                                    store=args.store),
+                            ble_pairs)
     # Close the pool to new tasks
     pool.close()
+
+    # With --store, the tasks return the entries of the result store chunks
+    if args.store:
+        outputs = [output for outputs in (wifi_outputs, ble_outputs)
+                   for block in outputs for output in block]
+        for path in save_stores(outputs, SCRIPT):
+            print("[INFO] Saved", path)
+
     # Wait for all processes to terminate
     pool.join()
 
@@ -594,6 +2104,113 @@ def test_union():
             assert False, "This statement should be unreachable"
 
 
+def test_scan_set_duplicates():
+    # Repeated identifiers are kept, lookups use the first occurrence
+    pop1 = [Measurement("Eduroam", -80, datetime.now()),
+            Measurement("Hans", -76, datetime.now()),
+            Measurement("Eduroam", -70, datetime.now())]
+    pop2 = [Measurement("Eduroam", -90, datetime.now()),
+            Measurement("Eduroam", -60, datetime.now()),
+            Measurement("Freifunk", -93, datetime.now())]
+    s1 = ScanSet(pop1)
+    assert len(s1) == 3
+    assert s1.index == {"eduroam": -80, "hans": -76}
+    intersect = intersection(s1, ScanSet(pop2))
+    assert [(e.ident, e.rssi1, e.rssi2) for e in intersect] == \
+        [("eduroam", -80, -90), ("eduroam", -70, -90)]
+    set_union = union(pop1, ScanSet(pop2))
+    assert [(e.ident, e.rssi1, e.rssi2) for e in set_union] == \
+        [("eduroam", -80, -90), ("hans", -76, -100), ("eduroam", -70, -90),
+         ("freifunk", -100, -93)]
+
+
+def test_scan_set_features():
+    pop1 = [Measurement("Eduroam", -80, datetime.now()),
+            Measurement("Hans", -76, datetime.now()),
+            Measurement("TalonTestbed", -60, datetime.now())]
+    pop2 = [Measurement("Eduroam", -50, datetime.now()),
+            Measurement("Hans", -80, datetime.now())]
+    s1 = ScanSet(pop1)
+    s2 = ScanSet(pop2)
+    assert jaccard_dist(s1, s2) == jaccard_dist(pop1, pop2)
+    assert mean_hamming_dist(s1, s2) == mean_hamming_dist(pop1, pop2)
+    assert euclidean_distance(s1, s2) == euclidean_distance(pop1, pop2)
+    assert mean_exp_difference(s1, s2) == mean_exp_difference(pop1, pop2)
+    assert sum_squared_ranks(s1, s2) == sum_squared_ranks(pop1, pop2) == 2.0
+    assert population_ok(s1)
+    assert not population_ok(ScanSet([Measurement("-1", 0, None)]))
+
+
+def test_slot_features():
+    pop1 = [Measurement("Eduroam", -80, datetime.now()),
+            Measurement("Hans", -76, datetime.now()),
+            Measurement("TalonTestbed", -60, datetime.now())]
+    pop2 = [Measurement("Eduroam", -50, datetime.now()),
+            Measurement("Hans", -80, datetime.now()),
+            Measurement("Freifunk", -93, datetime.now())]
+    res = slot_features(pop1, pop2, default=-150)
+    assert sorted(res.keys()) == sorted(WIFI_FEATURES)
+    assert res["jaccard"] == jaccard_dist(pop1, pop2, -150)
+    assert res["euclidean"] == euclidean_distance(pop1, pop2, -150)
+    assert res["mean_hamming"] == mean_hamming_dist(pop1, pop2, -150)
+    assert res["mean_exp"] == mean_exp_difference(pop1, pop2, -150)
+    assert res["sum_squared_ranks"] == sum_squared_ranks(pop1, pop2)
+
+
+def test_slot_features_subset():
+    pop1 = [Measurement("Eduroam", -80, datetime.now())]
+    pop2 = [Measurement("Asgard", -90, datetime.now())]
+    res = slot_features(pop1, pop2, features=BLE_FEATURES)
+    assert sorted(res.keys()) == ["euclidean", "jaccard"]
+    assert res["jaccard"] == 1.0
+    res = slot_features(pop1, pop2, features=("sum_squared_ranks",))
+    assert res == {"sum_squared_ranks": None}
+    res = slot_features([], [])
+    assert res == {feature: 0.0 for feature in WIFI_FEATURES}
+
+
+def test_batch_features():
+    pops = [[Measurement("Eduroam", -80, datetime.now()),
+             Measurement("Hans", -76, datetime.now()),
+             Measurement("TalonTestbed", -60, datetime.now())],
+            [Measurement("Eduroam", -90, datetime.now()),
+             Measurement("Hans", -50, datetime.now())],
+            [Measurement("Asgard", -90, datetime.now()),
+             Measurement("Sterne", -105, datetime.now())],
+            []]
+    res = batch_features(pops)
+    for feature, func in (("jaccard", jaccard_dist),
+                          ("euclidean", euclidean_distance),
+                          ("mean_hamming", mean_hamming_dist)):
+        assert res[feature].shape == (4, 4)
+        for i in range(4):
+            for j in range(4):
+                assert res[feature][i, j] == func(pops[i], pops[j])
+
+
+def test_l1_distances_blocks(monkeypatch):
+    rng = np.random.RandomState(0)
+    values = rng.randint(-20, 60, size=(7, 40)).astype(np.float64)
+    values[rng.random_sample(values.shape) < 0.5] = 0.0
+    expected = np.abs(values[:, None, :] - values[None, :, :]).sum(axis=2)
+    assert np.array_equal(_l1_distances(values), expected)
+    assert _l1_distances(np.zeros((3, 0))).shape == (3, 3)
+    # A block is at least one column
+    monkeypatch.setattr(sys.modules[__name__], "UNARY_BLOCK", 100)
+    assert np.array_equal(_l1_distances(values), expected)
+
+
+def test_batch_features_mean_rssi():
+    pops = [[Measurement("Eduroam", -80.5, datetime.now())],
+            [Measurement("Eduroam", -90.25, datetime.now()),
+             Measurement("Hans", -50, datetime.now())]]
+    res = batch_features(pops, default=-150)
+    assert isclose(res["mean_hamming"][0, 1],
+                   mean_hamming_dist(pops[0], pops[1], -150))
+    assert isclose(res["euclidean"][1, 0],
+                   euclidean_distance(pops[0], pops[1], -150))
+
+
 def test_sorted_list():
     pop1 = [Measurement("Eduroam", -80, datetime.now()),
             Measurement("TalonTestbed", -60, datetime.now()),
@@ -651,6 +2268,365 @@ def test_read_data():
     assert data[0].time == datetime(2017, 8, 10, 21, 57, 25, 716306)
 
 
+def test_read_data_columnar():
+    data = read_results("test-wifi.txt")
+    log = read_results_columnar("test-wifi.txt")
+    assert len(log) == len(data)
+    assert log.rssi.dtype == np.int8
+    assert log.time.dtype == np.int64
+    assert list(log.ident) == [int(m.ident) for m in data]
+    assert list(log.rssi) == [m.rssi for m in data]
+    assert list(log.time) == [to_epoch_us(m.time) for m in data]
+    assert not log.broken.any()
+
+
+def test_read_data_columnar_errors():
+    lines = ["0 -71dBm 2017-08-10T21:57:25.716306\n",
+             "wlan0     Interface doesn't support scanning.\n",
+             "\n",
+             "2017-08-10T21:57:36.313662\n",
+             "Sizes of BSSID and RSSI lists do not match "
+             "2017-08-10T21:57:46.896028\n",
+             "ERROR: Scan error while scanning for BLE devices.\n",
+             "1 -87dBm 2017-08-10T21:57:57.479202\n"]
+    with NamedTemporaryFile("w", suffix=".txt") as fo:
+        fo.writelines(lines)
+        fo.flush()
+        data = read_results(fo.name)
+        log = read_results_columnar(fo.name)
+    assert [str(i) for i in log.ident] == [m.ident for m in data]
+    assert list(log.rssi) == [m.rssi for m in data]
+    assert list(log.time) == [to_epoch_us(m.time) for m in data]
+    assert list(log.broken) == [False, True, True, False]
+
+
+def test_slot_starts():
+    times = np.array([to_epoch_us(datetime(2017, 8, 13, 12, 12, 12, 5)),
+                      to_epoch_us(datetime(2017, 8, 13, 12, 12, 59))])
+    assert list(slot_starts(times, 10)) == \
+        [to_epoch_us(datetime(2017, 8, 13, 12, 12, 10)),
+         to_epoch_us(datetime(2017, 8, 13, 12, 12, 50))]
+    assert list(slot_strings(slot_starts(times, 30))) == \
+        ["2017-08-13 12:12:00", "2017-08-13 12:12:30"]
+
+
+def test_slot_matrix():
+    t = [datetime(2017, 8, 13, 12, 12, 12), datetime(2017, 8, 13, 12, 12, 22),
+         datetime(2017, 8, 13, 12, 12, 42), datetime(2017, 8, 13, 12, 13, 2)]
+    log = ScanLog(np.array([3, 1, 3, 1, -1, 2]),
+                  np.array([-80, -60, -70, -71, 0, -50], dtype=np.int8),
+                  np.array([to_epoch_us(t[0]), to_epoch_us(t[0]),
+                            to_epoch_us(t[1]), to_epoch_us(t[1]),
+                            to_epoch_us(t[2]), to_epoch_us(t[3])]),
+                  np.array([False, False, False, False, True, False]))
+    sm = SlotMatrix(log, 10)
+    # Includes the empty slots at 12:12:30 and 12:12:50
+    assert slot_strings(sm.slots) == \
+        ["2017-08-13 12:12:10", "2017-08-13 12:12:20", "2017-08-13 12:12:30",
+         "2017-08-13 12:12:40", "2017-08-13 12:12:50", "2017-08-13 12:13:00"]
+    assert list(sm.broken) == [False, False, False, True, False, False]
+    assert list(sm.indptr) == [0, 2, 4, 4, 4, 4, 5]
+    assert list(sm.indices[:2]) == [1, 3]
+    # The order of the first slot is the order in the log (3 before 1)
+    assert [(m.ident, m.rssi) for m in sm.scan_set(0)] == \
+        [("3", -80), ("1", -60)]
+    # With 30 second slots, repeated identifiers are averaged
+    sm = SlotMatrix(log, 30)
+    assert slot_strings(sm.slots) == \
+        ["2017-08-13 12:12:00", "2017-08-13 12:12:30", "2017-08-13 12:13:00"]
+    assert list(sm.data[:2]) == [-65.5, -75.0]
+
+
+def test_compute_sparse_engine():
+    lines1 = ["0 -71dBm 2017-08-10T21:57:25.716306\n",
+              "1 -87dBm 2017-08-10T21:57:25.725382\n",
+              "2 -75dBm 2017-08-10T21:57:25.725934\n",
+              "0 -79dBm 2017-08-10T21:57:36.313662\n",
+              "4 -49dBm 2017-08-10T21:57:36.316271\n",
+              "Sizes of BSSID and RSSI lists do not match "
+              "2017-08-10T21:57:46.896028\n",
+              "2 -73dBm 2017-08-10T21:58:06.896724\n",
+              "2 -76dBm 2017-08-10T21:58:08.896724\n"]
+    with NamedTemporaryFile("w", suffix=".txt") as fo:
+        fo.writelines(lines1)
+        fo.flush()
+        for slotsize in [10, 30]:
+            for mode in [MODE_WIFI, MODE_BLE]:
+                expected = compute("test-wifi.txt", fo.name, slotsize=slotsize,
+                                   mode=mode)
+                res = compute("test-wifi.txt", fo.name, slotsize=slotsize,
+                              mode=mode, engine=ENGINE_SPARSE)
+                assert sorted(res.keys()) == sorted(expected.keys())
+                for tstr in expected:
+                    assert sorted(res[tstr].keys()) == \
+                        sorted(expected[tstr].keys())
+                    for feature in expected[tstr]:
+                        if isinstance(expected[tstr][feature], float):
+                            assert isclose(res[tstr][feature],
+                                           expected[tstr][feature])
+                        else:
+                            assert res[tstr][feature] == \
+                                expected[tstr][feature]
+
+
+def test_publish_logs():
+    log = read_results_columnar("test-wifi.txt")
+    blocks, descriptor = publish_logs(["a", "b"], [log, log])
+    try:
+        attach_logs(descriptor)
+        assert _SHARED["files"] == ["a", "b"]
+        assert len(_SHARED["logs"]) == 2
+        for shared in _SHARED["logs"]:
+            for column in SHARED_COLUMNS:
+                assert np.array_equal(getattr(shared, column),
+                                      getattr(log, column))
+        sms = _shared_matrices(1, [10, 30])
+        assert sms[10] is _shared_matrices(1, [10])[10]
+        assert sorted(sms.keys()) == [10, 30]
+    finally:
+        attached = _SHARED["blocks"]
+        _SHARED.update(blocks=[], files=[], logs=[], matrices={})
+        for block in attached:
+            block.close()
+        release_logs(blocks)
+
+
+def test_slot_matrices():
+    rng = np.random.RandomState(1)
+    n = 3000
+    time = 1502402240000000 + np.sort(rng.randint(0, 3600, n)) * 1000000
+    # Leave a gap of empty timeslots
+    time[time > 1502403240000000] += 600000000
+    broken = rng.random_sample(n) < 0.02
+    logs = [read_results_columnar("test-wifi.txt"),
+            ScanLog(np.where(broken, -1, rng.randint(0, 40, n)),
+                    np.where(broken, 0, rng.randint(-95, -30, n)).astype(
+                        np.int8), time, broken)]
+    for log in logs:
+        sms = slot_matrices(log, [30, 10, 5, 15, 20, 60, 40])
+        for slotsize in [5, 10, 15, 20, 30, 40, 60]:
+            expected = SlotMatrix(log, slotsize)
+            for attr in ["slots", "broken", "indptr", "indices", "data",
+                         "order"]:
+                assert np.array_equal(getattr(sms[slotsize], attr),
+                                      getattr(expected, attr))
+            assert sorted(sms[slotsize].fallback) == sorted(expected.fallback)
+            for row in expected.fallback:
+                assert list(sms[slotsize].fallback[row]) == \
+                    list(expected.fallback[row])
+
+
+def test_bitset_cardinalities():
+    m1 = csr_matrix(([1, 1, 1, 1], ([0, 0, 1, 2], [3, 200, 3, 70])),
+                    shape=(3, 201))
+    m2 = csr_matrix(([1, 1, 1], ([0, 0, 2], [200, 5, 71])), shape=(3, 201))
+    positions1, positions2, width = row_positions(m1, m2)
+    # Row 0 has the union {3, 5, 200}, row 2 the union {70, 71}
+    assert list(positions1) == [0, 2, 0, 0]
+    assert list(positions2) == [1, 2, 1]
+    assert width == 3
+    b1 = bitsets(m1, positions1, 1)
+    assert b1.shape == (3, 1)
+    assert list(b1[:, 0]) == [0b101, 0b1, 0b1]
+    n1, n2, n_inter = bitset_cardinalities(m1, m2)
+    assert list(n1) == [2, 1, 1]
+    assert list(n2) == [2, 0, 1]
+    assert list(n_inter) == [1, 0, 0]
+
+    # Rows with more than 64 identifiers, out of many more in total
+    rng = np.random.RandomState(0)
+    sets = [[set(rng.choice(5000, rng.randint(0, 150), replace=False))
+             for _ in range(20)] for _ in range(2)]
+    m1, m2 = [csr_matrix((np.ones(sum(len(s) for s in rows)),
+                          ([r for r, s in enumerate(rows) for _ in s],
+                           [i for s in rows for i in s])), shape=(20, 5000))
+              for rows in sets]
+    n1, n2, n_inter = bitset_cardinalities(m1, m2)
+    assert list(n1) == [len(s) for s in sets[0]]
+    assert list(n2) == [len(s) for s in sets[1]]
+    assert list(n_inter) == [len(s1 & s2) for s1, s2 in zip(*sets)]
+
+
+def test_compute_bitset_engine():
+    for mode in [MODE_WIFI, MODE_BLE]:
+        assert compute("test-wifi.txt", "test-wifi.txt", slotsize=[10, 30],
+                       mode=mode, engine=ENGINE_BITSET) == \
+            compute("test-wifi.txt", "test-wifi.txt", slotsize=[10, 30],
+                    mode=mode, engine=ENGINE_SPARSE)
+
+
+def test_sliding_window():
+    sw = SlidingWindow()
+    sw.add(0, 1, -70)
+    sw.add(0, 1, -60)
+    sw.add(1, 1, -65)
+    sw.add(1, 2, -90)
+    assert sw.features() == slot_features([Measurement("1", -65, None)],
+                                          [Measurement("1", -65, None),
+                                           Measurement("2", -90, None)])
+    sw.remove(0, 1, -70)
+    sw.remove(1, 2, -90)
+    assert sw.features()["euclidean"] == 5.0
+    assert sw.features()["jaccard"] == 0.0
+    sw.remove(0, 1, -60)
+    sw.remove(1, 1, -65)
+    assert sw.contrib == {}
+    assert sw.totals == [0.0, 0.0, 0.0]
+    assert sw.features(BLE_FEATURES) == {"jaccard": 0.0, "euclidean": 0.0}
+    sw.add(1, -1, 0, broken=True)
+    assert sw.broken
+
+
+def test_compute_sliding_windows():
+    # Non-overlapping windows are the timeslots of the sparse engine
+    for slotsize in [20, 30]:
+        expected = compute("test-wifi.txt", "test-wifi.txt", slotsize=slotsize,
+                           engine=ENGINE_SPARSE)
+        res = compute("test-wifi.txt", "test-wifi.txt", slotsize=slotsize,
+                      step=slotsize)
+        assert sorted(res.keys()) == sorted(expected.keys())
+        for tstr in expected:
+            for feature in expected[tstr]:
+                if isinstance(expected[tstr][feature], float):
+                    assert isclose(res[tstr][feature],
+                                   expected[tstr][feature])
+                else:
+                    assert res[tstr][feature] == expected[tstr][feature]
+    res = compute("test-wifi.txt", "test-wifi.txt", slotsize=30, step=5)
+    assert len(res) > len(expected)
+    log = read_results_columnar("test-wifi.txt")
+    try:
+        sliding_features(log, log, window=10, step=5)
+        assert False, "Windows shorter than MIN_WINDOW are not supported"
+    except ValueError:
+        pass
+
+
+def test_process_pair_block_sliding_windows(tmpdir, monkeypatch):
+    log = read_results_columnar("test-wifi.txt")
+    with open("test-wifi.txt", "r") as fo:
+        lines = fo.read()
+    # The workers query the git revision through the run context
+    context = create_run_context()
+    monkeypatch.chdir(tmpdir)
+    files = []
+    for sensor in ["Sensor-01", "Sensor-02"]:
+        tmpdir.mkdir(sensor).mkdir("wifi").join("wifi.txt").write(lines)
+        files.append(sensor + "/wifi/wifi.txt")
+    blocks, descriptor = publish_logs(files, [log, log])
+    try:
+        _init_pair_worker(descriptor, context)
+        outputs = process_pair_block([(0, 1)], slotsizes=[30], step=5,
+                                     store=True)
+        assert len(outputs) == 1
+        feature, params, entry = outputs[0]
+        assert params == {"chunk_len": 30, "step": 5}
+        assert entry["sensors"] == ["Sensor-01", "Sensor-02"]
+        store = ResultStore(feature, SCRIPT, params)
+        store.add_entry(entry)
+        assert store.results(0) == sliding_features(log, log, 30, 5)
+    finally:
+        init_run_context({})
+        attached = _SHARED["blocks"]
+        _SHARED.update(blocks=[], files=[], logs=[], matrices={})
+        for block in attached:
+            block.close()
+        release_logs(blocks)
+
+
+def test_intersect_positions():
+    keys1 = np.array([7, 3, 9, 1])
+    keys2 = np.array([9, 4, 1, 8, 3])
+    i1, i2 = intersect_positions(keys1, keys2)
+    assert list(keys1[i1]) == [1, 3, 9]
+    assert list(keys2[i2]) == [1, 3, 9]
+    i1, i2 = intersect_positions(keys1, np.zeros(0, dtype=np.int64))
+    assert len(i1) == len(i2) == 0
+
+
+def test_compute_multiple_slotsizes():
+    for engine in [ENGINE_LIST, ENGINE_SPARSE, ENGINE_BITSET]:
+        res = compute("test-wifi.txt", "test-wifi.txt", slotsize=[10, 30],
+                      engine=engine)
+        assert sorted(res.keys()) == [10, 30]
+        for slotsize in [10, 30]:
+            assert res[slotsize] == compute("test-wifi.txt", "test-wifi.txt",
+                                            slotsize=slotsize, engine=engine)
+
+
+def test_streaming_evaluator():
+    results = []
+    evaluator = StreamingEvaluator(["a", "b"], slotsize=10, grace=2.0,
+                                   emit=results.append)
+    base = to_epoch_us(datetime(2017, 8, 10, 21, 57, 20))
+    evaluator.add("a", "Eduroam", -80, base + 1000000)
+    evaluator.add("a", "Hans", -76, base + 1000000)
+    evaluator.add("b", "Eduroam", -90, base + 2000000)
+    evaluator.add("b", "Eduroam", -70, base + 12000000)
+    evaluator.add("a", "Eduroam", -70, base + 13000000)
+    # Slot has not ended yet, or is still in its grace period
+    evaluator.close(base + 11000000)
+    assert results == []
+    evaluator.close(base + 12000000)
+    assert len(results) == 1
+    assert results[0]["time"] == "2017-08-10 21:57:20"
+    assert results[0]["sensors"] == ["a", "b"]
+    assert results[0]["jaccard"] == 1 - 1 / 2.0
+    assert results[0]["sum_squared_ranks"] == 0.0
+    # Late samples for the closed slot are dropped
+    evaluator.add("b", "Hans", -50, base + 3000000)
+    assert evaluator.dropped == 1
+    assert base not in evaluator.slots
+    evaluator.close(base + 22000000)
+    assert len(results) == 2
+    assert results[1]["euclidean"] == 0.0
+
+
+def test_streaming_evaluator_lines():
+    results = []
+    evaluator = StreamingEvaluator(["a", "b"], slotsize=30,
+                                   emit=results.append, mode=MODE_BLE)
+    parsers = {"a": ScanLineParser(), "b": ScanLineParser()}
+    with open("test-wifi.txt", "r") as fo:
+        for line in fo:
+            evaluator.add_line("a", parsers["a"], line)
+    evaluator.add_line("b", parsers["b"],
+                       "Sizes of BSSID and RSSI lists do not match "
+                       "2017-08-10T21:57:46.896028\n")
+    evaluator.close(to_epoch_us(datetime(2017, 8, 10, 21, 59)))
+    # Sensor b only came online in the second slot, with an error
+    assert len(results) == 1
+    assert results[0]["time"] == "2017-08-10 21:57:30"
+    assert results[0]["error"] == "Scan error in sample, no feature computed"
+
+
+def test_follow():
+    lines = ["0 -71dBm 2017-08-10T21:57:25.716306\n",
+             "1 -87dBm 2017-08-10T21:57:25.725382\n",
+             "2 -75dBm 2017-08-10T21:57:25.725934\n"]
+    with NamedTemporaryFile("w", suffix=".txt") as fo:
+        def append(text):
+            sleep(0.1)
+            fo.write(text)
+            fo.flush()
+
+        fo.write(lines[0])
+        fo.flush()
+        # Only lines appended after the start are yielded
+        Thread(target=append, args=(lines[1],), daemon=True).start()
+        assert next(follow(fo.name, poll=0.01)) == lines[1]
+
+        # The complete lines are replayed, the incomplete one is followed
+        fo.write(lines[2][:10])
+        fo.flush()
+        evaluator = StreamingEvaluator([fo.name, "b"], emit=None)
+        offset = replay(fo.name, evaluator, ScanLineParser(fo.name))
+        assert [len(slot[fo.name]) for slot in evaluator.slots.values()] == \
+            [2]
+        Thread(target=append, args=(lines[2][10:],), daemon=True).start()
+        assert next(follow(fo.name, poll=0.01, offset=offset)) == lines[2]
+
+
 def test_jaccard_dist_1():
     pop1 = [Measurement("Eduroam", -80, datetime.now()),
             Measurement("Hans", -76, datetime.now()),
@@ -835,3 +2811,21 @@ def test_sum_squared_ranks_empty():
     pop2 = []
     assert sum_squared_ranks(pop1, pop2) == 0.0, \
         str(sum_squared_ranks(pop1, pop2)) + " != 0.0"
+
+
+def test_sum_squared_ranks_ties():
+    # Ties keep their original order, repeated identifiers use the rank of
+    # their first occurrence
+    pop1 = [Measurement("a", -70, None), Measurement("b", -70, None),
+            Measurement("a", -50, None), Measurement("c", -60, None)]
+    pop2 = [Measurement("b", -70, None), Measurement("a", -70, None),
+            Measurement("c", -70, None)]
+    # Ranks: a 1/2, b 4/1, c 2/3 (a counted twice)
+    assert sum_squared_ranks(pop1, pop2) == 1.0 + 9.0 + 1.0 + 1.0
+
+
+def test_ranks_per_slot():
+    slot = np.array([1, 0, 1, 0, 1])
+    rssi = np.array([-70.0, -50.0, -70.0, -60.0, -40.0])
+    order = np.array([5, 1, 3, 0, 9])
+    assert list(_ranks(slot, rssi, order)) == [3.0, 1.0, 2.0, 2.0, 1.0]
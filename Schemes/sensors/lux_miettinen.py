@@ -6,14 +6,22 @@ Personal Devices"
 """
 
 
+from argparse import ArgumentParser
+from base64 import b64decode, b64encode
 from datetime import datetime
 from dateutil import parser
 from multiprocessing import Pool, cpu_count
 from glob import glob
-from json import dumps
-from util import create_metadata, derive_result_path
+from json import dumps, load
+from util import create_metadata, create_run_context, derive_result_path, \
+    init_run_context, parse_timestamps, result_dir, result_path, \
+    select_tasks, slot_strings, to_epoch_us
 from functools import partial
 from numpy import average
+from numpy.lib.stride_tricks import as_strided
+from tempfile import NamedTemporaryFile
+import numpy as np
+import sys
 import traceback
 
 SCRIPT = __file__[:-3]
@@ -22,11 +30,20 @@ SCRIPT = __file__[:-3]
 ### Parameters of the algorithm
 # Slot size
 SLOT_SIZES = [5, 10, 15, 30, 60, 120]
+# Fingerprint lengths (in bits)
+FP_LENS = [64, 128, 256, 512, 1024]
 # Relative change threshold
 THRES_REL = 0.1
 # Absolute change threshold
 THRES_ABS = 10.0
 
+# Number of fingerprints packed at once (bounds the temporary memory)
+PACK_BLOCK = 8192
+
+# File extension and format name of the compact result files
+COMPACT_EXTENSION = ".bits.json"
+COMPACT_FORMAT = "fingerprint-bits"
+
 
 class Measurement:
     """Measurement class - contains individual measurements."""
@@ -96,6 +113,97 @@ def read_results(filename):
     return rv
 
 
+def read_results_columnar(filename):
+    """Read in results like read_results, but into numpy arrays.
+
+    :return: A tuple (values, time) of the values (float64) and their
+        timestamps in microseconds since the epoch (int64)
+    """
+    values = []
+    times = []
+    with open(filename, 'r') as fo:
+        for line in fo:
+            # Parse out data
+            try:
+                value, timestring = line.strip().split(" ")
+            except ValueError:
+                print("[WARN] Error while parsing line, skipping")
+                continue
+            values.append(float(value))
+            times.append(timestring)
+    return np.array(values, dtype=np.float64), parse_timestamps(times)
+
+
+def slot_starts(time, slotsize=10):
+    """Compute the timeslot of every timestamp (microseconds since epoch).
+
+    This is the integer equivalent of the rounding in timeslot_list."""
+    seconds = time // 1000000
+    if slotsize < 60:
+        return (seconds - seconds % 60 % slotsize) * 1000000
+    elif (slotsize % 60) == 0:
+        minutes = seconds // 60
+        return (minutes - minutes % 60 % (slotsize // 60)) * 60000000
+    else:
+        print("Slotsize not supported")
+        raise Exception("nope.")
+
+
+def segment_sums(values, starts, counts):
+    """Sum up consecutive segments of an array, exactly like numpy.sum of
+    every segment.
+
+    numpy sums contiguous arrays pairwise, np.add.reduceat does not. The
+    segments of equal length are therefore stacked into the rows of a
+    matrix and summed up together.
+    :param values: The values (float64)
+    :param starts: The start index of every segment
+    :param counts: The length of every segment
+    :return: The sum of every segment
+    """
+    rv = np.empty(len(starts))
+    order = np.argsort(counts, kind="mergesort")
+    lengths, firsts = np.unique(counts[order], return_index=True)
+    for n, lo, hi in zip(lengths, firsts, np.append(firsts[1:], len(order))):
+        sel = order[lo:hi]
+        rv[sel] = np.add.reduce(values[starts[sel, None] + np.arange(n)],
+                                axis=1)
+    return rv
+
+
+def slot_averages(values, time, slotsize=10):
+    """Average the values of every timeslot that contains measurements.
+
+    The values of a timeslot are summed up in the order of the file, so the
+    averages are identical to avg.
+    :return: A tuple (slots, avgs) of the timeslot starts (microseconds since
+        the epoch) in ascending order and their average values
+    """
+    if len(values) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+    keys = slot_starts(time, slotsize)
+    if (keys[1:] < keys[:-1]).any():
+        perm = np.argsort(keys, kind="mergesort")
+        keys, values = keys[perm], values[perm]
+    starts = np.nonzero(np.append(True, keys[1:] != keys[:-1]))[0]
+    counts = np.diff(np.append(starts, len(keys)))
+    return keys[starts], segment_sums(values, starts, counts) / counts
+
+
+def multi_slot_averages(values, time, slotsizes):
+    """Average the values of every timeslot for several slotsizes at once.
+
+    The values are parsed only once and the timeslots of every slotsize are
+    summed up directly with slot_averages (without sorting, if the file is in
+    chronological order), so the averages are identical to slot_averages and
+    avg.
+    :return: A dictionary mapping every slotsize to the tuple (slots, avgs),
+        see slot_averages
+    """
+    return {size: slot_averages(values, time, size)
+            for size in set(slotsizes)}
+
+
 # ---------------------
 # Statistical functions
 # ---------------------
@@ -122,43 +230,319 @@ def fp_bit(avg1, avg2, delta_rel, delta_abs):
     return "0"
 
 
+def fp_bits(avgs, delta_rel, delta_abs):
+    """Compute the fingerprint bits of all consecutive timeslots at once.
+
+    Vectorized version of fp_bit: bit i compares avgs[i + 1] to avgs[i].
+    :return: A boolean array with one element less than avgs
+    """
+    this = avgs[1:]
+    prev = avgs[:-1]
+    prev = np.where(prev == 0, 0.000001, prev)
+    return (np.abs(this / prev - 1) > delta_rel) & \
+        (np.abs(this - prev) > delta_abs)
+
+
+def sweep_bits(avgs, rel_grid, abs_grid):
+    """Compute the fingerprint bits for every combination of thresholds.
+
+    The relative and absolute changes between consecutive timeslots are
+    computed once and compared to all thresholds in one broadcast.
+    :param avgs: The averages of all timeslots
+    :param rel_grid: A list of relative change thresholds
+    :param abs_grid: A list of absolute change thresholds
+    :return: A boolean array (len(rel_grid) x len(abs_grid) x
+        len(avgs) - 1), see fp_bits
+    """
+    this = avgs[1:]
+    prev = avgs[:-1]
+    prev = np.where(prev == 0, 0.000001, prev)
+    rel_change = np.abs(this / prev - 1)
+    abs_change = np.abs(this - prev)
+    rel_grid = np.asarray(rel_grid, dtype=np.float64)
+    abs_grid = np.asarray(abs_grid, dtype=np.float64)
+    return (rel_change[None, None, :] > rel_grid[:, None, None]) & \
+        (abs_change[None, None, :] > abs_grid[None, :, None])
+
+
+def pack_fingerprints(bits, fp_len):
+    """Pack the rolling fingerprints of a bit stream into uint64 words.
+
+    Fingerprint i consists of bits[i], bits[i - 1], ..., bits[i - fp_len + 1],
+    i.e. the newest bit comes first (see compute). The fingerprints of the
+    first fp_len - 1 slots are shorter and padded with zeros.
+    :return: An array (len(bits) x words) of uint64, the first bit of a
+        fingerprint is the most significant bit of the first word
+    """
+    n_words = (fp_len + 63) // 64
+    padded = np.concatenate([np.zeros(fp_len - 1, dtype=np.uint8),
+                             np.asarray(bits, dtype=np.uint8)])
+    # Row i is a read-only view on padded[i:i + fp_len], reversed
+    windows = as_strided(padded, shape=(len(bits), fp_len),
+                         strides=padded.strides * 2, writeable=False)[:, ::-1]
+    rv = np.zeros((len(bits), n_words * 8), dtype=np.uint8)
+    for lo in range(0, len(bits), PACK_BLOCK):
+        block = np.packbits(windows[lo:lo + PACK_BLOCK], axis=1)
+        rv[lo:lo + PACK_BLOCK, :block.shape[1]] = block
+    return rv.view(">u8").astype(np.uint64)
+
+
+def fingerprint_strings(bits, fp_len):
+    """Format the rolling fingerprints of a bit stream as strings of "0"
+    and "1", see pack_fingerprints.
+
+    Every fingerprint is a slice of a single string of all bits in reverse
+    order, so strings are only built when they are written out."""
+    n = len(bits)
+    chars = (np.asarray(bits, dtype=np.uint8)[::-1] + ord("0")).tobytes() \
+        .decode("ascii")
+    return [chars[n - 1 - i:n - 1 - i + min(i + 1, fp_len)] for i in range(n)]
+
+
+# ----------------------
+# Compact result storage
+# ----------------------
+class FingerprintStream:
+    """The fingerprints of one sensor, stored as the stream of change bits.
+
+    Consecutive fingerprints only differ by one shifted-in bit, so all
+    fingerprints (of any length) can be reconstructed from the change bits
+    and their timeslots. Fingerprints are only built when they are accessed.
+
+    slots: The timeslot of every bit in microseconds since the epoch
+    bits: The change bit of every timeslot (bool)
+    """
+
+    def __init__(self, slots, bits):
+        """Initialize the stream from two equally long arrays."""
+        self.slots = np.asarray(slots, dtype=np.int64)
+        self.bits = np.asarray(bits, dtype=bool)
+
+    def __len__(self):
+        return len(self.bits)
+
+    def index(self, tstr):
+        """Return the index of a timeslot string, or None if the timeslot
+        has no fingerprint."""
+        slot = to_epoch_us(datetime.strptime(tstr, "%Y-%m-%d %H:%M:%S"))
+        i = np.searchsorted(self.slots, slot)
+        if i < len(self.slots) and self.slots[i] == slot:
+            return int(i)
+        return None
+
+    def packed(self, i, fp_len):
+        """Return the fingerprint of slot i as uint64 words, see
+        pack_fingerprints."""
+        window = self.bits[max(0, i - fp_len + 1):i + 1][::-1]
+        rv = np.zeros((fp_len + 63) // 64 * 8, dtype=np.uint8)
+        block = np.packbits(window)
+        rv[:len(block)] = block
+        return rv.view(">u8").astype(np.uint64)
+
+    def fingerprint(self, i, fp_len):
+        """Return the fingerprint of slot i as a string of "0" and "1"."""
+        window = self.bits[max(0, i - fp_len + 1):i + 1][::-1]
+        return (window.astype(np.uint8) + ord("0")).tobytes().decode("ascii")
+
+    def packed_all(self, fp_len):
+        """Return the fingerprints of all slots as uint64 words."""
+        return pack_fingerprints(self.bits, fp_len)
+
+    def export(self, fp_len):
+        """Return the results in the format of compute, i.e. a dictionary
+        mapping timeslots to fingerprint strings."""
+        return dict(zip(slot_strings(self.slots),
+                        fingerprint_strings(self.bits, fp_len)))
+
+    def to_json(self):
+        """Encode the stream as a JSON serializable dictionary.
+
+        The timeslots are stored as runs of equal gaps (in seconds) after the
+        first timeslot, the bits are packed and base64 encoded."""
+        rv = {
+            "format": COMPACT_FORMAT,
+            "n_bits": len(self.bits),
+            "bits": b64encode(np.packbits(self.bits)).decode("ascii"),
+            "first_slot": None,
+            "slot_gaps": [],
+        }
+        if len(self.slots) > 0:
+            rv["first_slot"] = slot_strings(self.slots[:1])[0]
+            gaps = np.diff(self.slots) // 1000000
+            if len(gaps) > 0:
+                starts = np.nonzero(np.append(True, gaps[1:] != gaps[:-1]))[0]
+                counts = np.diff(np.append(starts, len(gaps)))
+                rv["slot_gaps"] = [[int(gap), int(count)] for gap, count
+                                   in zip(gaps[starts], counts)]
+        return rv
+
+    @classmethod
+    def from_json(cls, results):
+        """Decode a stream encoded with to_json."""
+        if results.get("format") != COMPACT_FORMAT:
+            raise ValueError("Not a compact fingerprint result")
+        n_bits = results["n_bits"]
+        bits = np.unpackbits(np.frombuffer(b64decode(results["bits"]),
+                                           dtype=np.uint8))[:n_bits]
+        if results["first_slot"] is None:
+            return cls(np.zeros(0, dtype=np.int64), bits)
+        first = to_epoch_us(datetime.strptime(results["first_slot"],
+                                              "%Y-%m-%d %H:%M:%S"))
+        gaps = np.repeat([gap for gap, _ in results["slot_gaps"]],
+                         [count for _, count in results["slot_gaps"]])
+        slots = first + np.concatenate([[0], np.cumsum(gaps)]) * 1000000
+        return cls(slots.astype(np.int64), bits)
+
+
+def load_compact(path):
+    """Load a compact result file.
+
+    :return: A tuple (metadata, stream) of the metadata dictionary and the
+        FingerprintStream
+    """
+    with open(path, "r") as fo:
+        rv = load(fo)
+    return rv["metadata"], FingerprintStream.from_json(rv["results"])
+
+
+def export_compact(path, fp_lens=FP_LENS):
+    """Export a compact result file into one result file per fingerprint
+    length, in the format written by process_lux."""
+    metadata, stream = load_compact(path)
+    params = metadata["parameters"]
+    sensor = path.split("/")[1]
+    for fp_len in fp_lens:
+        rv = {}
+        rv["metadata"] = dict(metadata, parameters=dict(params, fp_len=fp_len))
+        rv["results"] = stream.export(fp_len)
+        out = derive_result_path(sensor, "lux", metadata["generator_script"],
+                                 params=rv["metadata"]["parameters"])
+        with open(out, "w") as fo:
+            fo.write(dumps(rv, indent=4, sort_keys=True))
+
+
 # ------------------------
 # Main evaluation function
 # ------------------------
 def compute(file1, slotsize, fp_len, delta_rel, delta_abs):
+    """Compute the fingerprint of every timeslot (except the first one).
+
+    :return: A dictionary mapping timeslots to fingerprint strings
+    """
     try:
         # Read results
-        pop = read_results(file1)
-        assert pop is not None
+        values, time = read_results_columnar(file1)
 
-        # Split into timeslots
-        ts_pop = timeslot_list(pop, slotsize)
-        assert ts_pop is not None
+        # Average every timeslot and derive all fingerprint bits at once
+        slots, avgs = slot_averages(values, time, slotsize)
+        bits = fp_bits(avgs, delta_rel, delta_abs)
 
-        avgs = {}
-        rv = {}
+        # Strings are only built for the JSON output
+        return dict(zip(slot_strings(slots[1:]),
+                        fingerprint_strings(bits, fp_len)))
+    except Exception:
+        traceback.print_exc()
 
-        # Process results
-        for ts in ts_pop:
-            tstr = ts.strftime("%Y-%m-%d %H:%M:%S")
-            avgs[tstr] = avg(ts_pop[ts])
 
-        fp = ""
-        tstrings = sorted(avgs.keys())
-        for i in range(1, len(tstrings)):
-            this = avgs[tstrings[i]]
-            prev = avgs[tstrings[i - 1]]
+def process_lux_all(pop, slotsizes=SLOT_SIZES, fp_lens=FP_LENS,
+                    delta_rel=THRES_REL, delta_abs=THRES_ABS, compact=False):
+    """Compute and save the fingerprints of one sensor for all combinations
+    of slotsizes and fingerprint lengths, parsing the file only once.
 
-            if len(fp) == fp_len:
-                fp = fp_bit(this, prev, delta_rel, delta_abs) + fp[:fp_len - 1]
-            else:
-                fp = fp_bit(this, prev, delta_rel, delta_abs) + fp
-
-            rv[tstrings[i]] = fp
+    The results are saved in the same locations as by process_lux. If
+    compact is set, a single compact result file (see FingerprintStream) is
+    saved per slotsize instead, which holds the fingerprints of all
+    lengths. delta_rel and delta_abs may also be lists of thresholds, in
+    which case the results of every combination are computed (see
+    sweep_bits) and saved under their parameters."""
+    # Get sensor number from path
+    sensor = pop[0:9]
 
-        return rv
+    print("[Acc] Computing features for Sensor", sensor)
+    metadata = create_metadata([pop], SCRIPT)
+    try:
+        values, time = read_results_columnar(pop)
+        averages = multi_slot_averages(values, time, slotsizes)
     except Exception:
         traceback.print_exc()
+        return
+
+    rel_grid = np.atleast_1d(delta_rel).tolist()
+    abs_grid = np.atleast_1d(delta_abs).tolist()
+    for slotsize in slotsizes:
+        slots, avgs = averages[slotsize]
+        grid = sweep_bits(avgs, rel_grid, abs_grid)
+        for i, rel in enumerate(rel_grid):
+            for j, abs_ in enumerate(abs_grid):
+                save_fingerprints(sensor, metadata, slotsize, slots[1:],
+                                  grid[i, j], fp_lens, rel, abs_, compact)
+
+
+def save_fingerprints(sensor, metadata, slotsize, slots, bits, fp_lens,
+                      delta_rel, delta_abs, compact=False):
+    """Save the fingerprints of one sensor for several fingerprint lengths,
+    or as a single compact result file."""
+    if compact:
+        save_compact(sensor, metadata, slotsize, slots, bits, delta_rel,
+                     delta_abs)
+        return
+    tstrings = slot_strings(slots)
+    for fp_len in fp_lens:
+        params = {
+            "chunk_len": slotsize,
+            "fp_len": fp_len,
+            "delta_rel": delta_rel,
+            "delta_abs": delta_abs
+        }
+        rv = {}
+        rv["metadata"] = dict(metadata, parameters=params)
+        rv["results"] = dict(zip(tstrings, fingerprint_strings(bits, fp_len)))
+        rv["metadata"]["processing_end"] = \
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+        # Save result json to file
+        path = derive_result_path(sensor, "lux", SCRIPT, params=params)
+        with open(path, "w") as fo:
+            fo.write(dumps(rv, indent=4, sort_keys=True))
+
+
+def save_compact(sensor, metadata, slotsize, slots, bits, delta_rel,
+                 delta_abs):
+    """Save the change bits of one sensor as a compact result file."""
+    params = {
+        "chunk_len": slotsize,
+        "delta_rel": delta_rel,
+        "delta_abs": delta_abs
+    }
+    rv = {}
+    rv["metadata"] = dict(metadata, parameters=params)
+    rv["results"] = FingerprintStream(slots, bits).to_json()
+    rv["metadata"]["processing_end"] = \
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    path = derive_result_path(sensor, "lux", SCRIPT, params=params,
+                              extension=COMPACT_EXTENSION)
+    with open(path, "w") as fo:
+        fo.write(dumps(rv, indent=4, sort_keys=True))
+
+
+def result_params(slotsizes=SLOT_SIZES, fp_lens=FP_LENS,
+                  delta_rel=(THRES_REL,), delta_abs=(THRES_ABS,)):
+    """Return the parameters of the results of one sensor for all
+    combinations of the given values (fp_lens=None for compact results)."""
+    for slotsize in slotsizes:
+        for rel in delta_rel:
+            for abs_ in delta_abs:
+                params = {
+                    "chunk_len": slotsize,
+                    "delta_rel": rel,
+                    "delta_abs": abs_
+                }
+                if fp_lens is None:
+                    yield params
+                    continue
+                for fp_len in fp_lens:
+                    yield dict(params, fp_len=fp_len)
 
 
 def process_lux(pop, slotsize=60, fp_len=128, delta_rel=THRES_REL, delta_abs=THRES_ABS):
@@ -195,6 +579,36 @@ def process_lux(pop, slotsize=60, fp_len=128, delta_rel=THRES_REL, delta_abs=THR
 
 
 if __name__ == "__main__":
+    arg_parser = ArgumentParser(description="Compute the luminosity "
+                                "fingerprints of Miettinen et al.")
+    arg_parser.add_argument("--multi", action="store_true",
+                            help="compute all slot sizes and fingerprint "
+                            "lengths in one task per sensor")
+    arg_parser.add_argument("--compact", action="store_true",
+                            help="with --multi, save the change bits once "
+                            "per slot size instead of every fingerprint")
+    arg_parser.add_argument("--delta-rel", type=float, nargs="+",
+                            default=[THRES_REL],
+                            help="with --multi, relative change thresholds "
+                            "(every combination with --delta-abs is "
+                            "computed)")
+    arg_parser.add_argument("--delta-abs", type=float, nargs="+",
+                            default=[THRES_ABS],
+                            help="with --multi, absolute change thresholds")
+    arg_parser.add_argument("--export", action="store_true",
+                            help="export all compact results to the "
+                            "per-fingerprint format")
+    arg_parser.add_argument("--force", action="store_true",
+                            help="also recompute results that are up to "
+                            "date")
+    args = arg_parser.parse_args()
+
+    if args.export:
+        for path in sorted(glob("results/Sensor-*/lux/**/*" +
+                                COMPACT_EXTENSION, recursive=True)):
+            export_compact(path)
+        sys.exit(0)
+
     # Prepare variables to hold stuff
     lux_files = []
 
@@ -202,12 +616,43 @@ if __name__ == "__main__":
     for lux_file in glob("Sensor-*/sensors/luxData.*clean"):
         lux_files.append(lux_file)
 
-    pool = Pool(processes=cpu_count(), maxtasksperchild=1)
-
-    for slotsize in SLOT_SIZES:
-        func = partial(process_lux, slotsize=slotsize)
-        # Compute features for luminosity data
-        pool.imap(func, lux_files)
+    if args.multi:
+        fp_lens = None if args.compact else FP_LENS
+        params_list = list(result_params(fp_lens=fp_lens,
+                                         delta_rel=args.delta_rel,
+                                         delta_abs=args.delta_abs))
+    else:
+        params_list = list(result_params(fp_lens=[128]))
+    extension = COMPACT_EXTENSION if args.multi and args.compact else ".json"
+
+    # Query the metadata shared by all results and create the result folders
+    # once for the whole run
+    context = create_run_context(
+        result_dir(pop[0:9], "lux", SCRIPT, params)
+        for pop in lux_files for params in params_list)
+    init_run_context(context)
+
+    # Skip the sensors whose results are up to date
+    lux_files = select_tasks(
+        lux_files, lambda pop: [(result_path(pop[0:9], "lux", SCRIPT,
+                                             params=params,
+                                             extension=extension),
+                                 [pop], params) for params in params_list],
+        force=args.force, name="sensors")
+
+    pool = Pool(processes=cpu_count(), initializer=init_run_context,
+                initargs=(context,))
+
+    if args.multi:
+        # Every file is parsed once for all slot sizes and fp lengths
+        pool.imap(partial(process_lux_all, delta_rel=args.delta_rel,
+                          delta_abs=args.delta_abs, compact=args.compact),
+                  lux_files)
+    else:
+        for slotsize in SLOT_SIZES:
+            func = partial(process_lux, slotsize=slotsize)
+            # Compute features for luminosity data
+            pool.imap(func, lux_files)
 
     # Wait for processes to terminate
     pool.close()
@@ -224,3 +669,127 @@ def test_fingerprint_bit_generator():
     assert fp_bit(0.0, 0.1, 0.1, 0.1) == "0"  # Exactly not enough change
     assert fp_bit(0.0, 0.1, 0.1, 0.09) == "1"  # Above abs and rel thresh.
     assert fp_bit(1000.0, 1000.2, 0.1, 0.09) == "0"  # Above abs, below rel
+
+
+def test_fp_bits():
+    avgs = np.array([33.0, 3.0, 3.0, 0.09, 0.0001, 0.0, 0.1])
+    bits = fp_bits(avgs, 0.1, 0.1)
+    assert list(bits) == [fp_bit(avgs[i + 1], avgs[i], 0.1, 0.1) == "1"
+                          for i in range(len(avgs) - 1)]
+
+
+def test_fingerprints():
+    bits = np.array([1, 0, 1, 1, 0], dtype=bool)
+    assert fingerprint_strings(bits, 3) == ["1", "01", "101", "110", "011"]
+    packed = pack_fingerprints(bits, 3)
+    assert packed.shape == (5, 1)
+    assert list(packed[:, 0] >> np.uint64(61)) == [4, 2, 5, 6, 3]
+    packed = pack_fingerprints(np.ones(70, dtype=bool), 70)
+    assert packed.shape == (70, 2)
+    assert packed[-1, 0] == 2 ** 64 - 1
+    assert packed[-1, 1] == np.uint64(0b111111) << np.uint64(58)
+
+
+def test_compute():
+    lines = ["%.1f 2017-08-10T21:%02d:%02d.%06d\n" %
+             (v, 57 + s // 60, s % 60, 1000 * v)
+             for s, v in [(0, 10.0), (3, 50.0), (7, 80.0), (18, 15.0),
+                          (23, 0.0), (29, 200.0), (61, 210.0), (75, 5.0),
+                          (76, 30.0)]]
+    with NamedTemporaryFile("w") as fo:
+        fo.writelines(lines)
+        fo.flush()
+        for slotsize in [5, 10, 60]:
+            # Reference implementation: timeslots, averages and strings
+            ts_pop = timeslot_list(read_results(fo.name), slotsize)
+            tstrings = sorted(ts.strftime("%Y-%m-%d %H:%M:%S")
+                              for ts in ts_pop)
+            avgs = dict((ts.strftime("%Y-%m-%d %H:%M:%S"), avg(ts_pop[ts]))
+                        for ts in ts_pop)
+            expected = {}
+            fp = ""
+            for i in range(1, len(tstrings)):
+                fp = (fp_bit(avgs[tstrings[i]], avgs[tstrings[i - 1]],
+                             THRES_REL, THRES_ABS) + fp)[:2]
+                expected[tstrings[i]] = fp
+            assert compute(fo.name, slotsize, 2, THRES_REL, THRES_ABS) == \
+                expected
+
+
+def test_slot_averages():
+    rng = np.random.RandomState(1)
+    time = np.sort(rng.randint(0, 3000, 2000)) * 1000000 + 1502402000000000
+    # Some measurements are out of order
+    time[100:110] = time[100:110][::-1]
+    values = rng.rand(2000) * 1000
+    population = [Measurement(v, datetime.fromtimestamp(t / 1e6))
+                  for v, t in zip(values, time)]
+    for slotsize in [5, 30, 60, 120]:
+        slots, avgs = slot_averages(values, time, slotsize)
+        ts_pop = timeslot_list(population, slotsize)
+        assert [avg(ts_pop[ts]) for ts in sorted(ts_pop)] == list(avgs)
+
+
+def test_compute_long_fingerprints():
+    rng = np.random.RandomState(2)
+    seconds = np.cumsum(rng.randint(0, 3, 3000))
+    lines = ["%.3f %s\n" % (v, datetime.utcfromtimestamp(
+        1502402000 + s).strftime("%Y-%m-%dT%H:%M:%S.000000"))
+             for v, s in zip(rng.rand(3000) * 200, seconds)]
+    with NamedTemporaryFile("w") as fo:
+        fo.writelines(lines)
+        fo.flush()
+        ts_pop = timeslot_list(read_results(fo.name), 5)
+        tstrings = sorted(ts_pop)
+        expected = {}
+        fp = ""
+        for prev, ts in zip(tstrings[:-1], tstrings[1:]):
+            fp = (fp_bit(avg(ts_pop[ts]), avg(ts_pop[prev]), THRES_REL,
+                         THRES_ABS) + fp)[:128]
+            expected[ts.strftime("%Y-%m-%d %H:%M:%S")] = fp
+        assert len(expected) > 128
+        assert compute(fo.name, 5, 128, THRES_REL, THRES_ABS) == expected
+
+
+def test_multi_slot_averages():
+    rng = np.random.RandomState(0)
+    time = np.sort(rng.randint(0, 3000, 500)) * 1000000 + 1502402000000000
+    values = rng.rand(500) * 100
+    population = [Measurement(v, datetime.fromtimestamp(t / 1e6))
+                  for v, t in zip(values, time)]
+    res = multi_slot_averages(values, time, [5, 7, 10, 60, 120])
+    for slotsize in [5, 7, 10, 60, 120]:
+        slots, avgs = slot_averages(values, time, slotsize)
+        assert np.array_equal(res[slotsize][0], slots)
+        assert np.array_equal(res[slotsize][1], avgs)
+        ts_pop = timeslot_list(population, slotsize)
+        assert [avg(ts_pop[ts]) for ts in sorted(ts_pop)] == list(avgs)
+
+
+def test_fingerprint_stream():
+    bits = np.array([1, 0, 1, 1, 0, 0, 1], dtype=bool)
+    slots = np.array([0, 5, 10, 15, 30, 35, 40]) * 1000000 + 1502402000000000
+    stream = FingerprintStream.from_json(
+        FingerprintStream(slots, bits).to_json())
+    assert np.array_equal(stream.slots, slots)
+    assert np.array_equal(stream.bits, bits)
+    assert stream.export(3) == dict(zip(slot_strings(slots),
+                                        fingerprint_strings(bits, 3)))
+    packed = pack_fingerprints(bits, 70)
+    for i in range(len(bits)):
+        assert np.array_equal(stream.packed(i, 70), packed[i])
+        assert stream.fingerprint(i, 4) == fingerprint_strings(bits, 4)[i]
+    assert stream.index(slot_strings(slots[4:5])[0]) == 4
+    assert stream.index("2017-08-10 21:00:00") is None
+    empty = FingerprintStream.from_json(FingerprintStream([], []).to_json())
+    assert len(empty) == 0
+
+
+def test_sweep_bits():
+    rng = np.random.RandomState(0)
+    avgs = np.append(rng.rand(50) * 100, [0.0, 0.0, 5.0])
+    grid = sweep_bits(avgs, [0.05, 0.1, 0.5], [1.0, 10.0])
+    assert grid.shape == (3, 2, 52)
+    for i, rel in enumerate([0.05, 0.1, 0.5]):
+        for j, abs_ in enumerate([1.0, 10.0]):
+            assert np.array_equal(grid[i, j], fp_bits(avgs, rel, abs_))
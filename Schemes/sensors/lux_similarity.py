@@ -0,0 +1,257 @@
+"""Pairwise similarity of luminosity fingerprints
+
+Compares the luminosity fingerprints of Miettinen et al. (see
+lux_miettinen.py) between all sensors at once. The fingerprints of every
+sensor are packed into uint64 words and aligned on common timeslots, and the
+number of agreeing bits of every pair of sensors is computed per timeslot
+with XOR and popcount. The resulting N x N matrices can be split into
+colocated and non-colocated values for computing FAR and FRR, without
+loading per-pair fingerprint strings.
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+from dateutil import parser
+from glob import glob
+from json import dumps
+from os.path import isfile
+from lux_miettinen import read_results_columnar, slot_averages, fp_bits, \
+    load_compact, save_compact, FingerprintStream, COMPACT_EXTENSION, \
+    THRES_REL, THRES_ABS, SCRIPT as LUX_SCRIPT
+from util import create_metadata, derive_result_path, is_colocated_interval, \
+    popcount, result_path, to_epoch_us
+import numpy as np
+
+SCRIPT = __file__[:-3]
+
+# Number of timeslots for which the pairwise XOR is computed at once
+# (bounds the temporary memory)
+SLOT_BLOCK = 256
+
+
+# ----------------
+# Helper functions
+# ----------------
+def stream_from_lux(filename, slotsize, delta_rel=THRES_REL,
+                    delta_abs=THRES_ABS):
+    """Compute the FingerprintStream of a luminosity data file."""
+    values, time = read_results_columnar(filename)
+    slots, avgs = slot_averages(values, time, slotsize)
+    return FingerprintStream(slots[1:], fp_bits(avgs, delta_rel, delta_abs))
+
+
+def compact_path(sensor, slotsize, delta_rel=THRES_REL, delta_abs=THRES_ABS):
+    """Return the path of the compact result file of a sensor, as saved by
+    lux_miettinen.py with --compact."""
+    params = {
+        "chunk_len": slotsize,
+        "delta_rel": delta_rel,
+        "delta_abs": delta_abs
+    }
+    return result_path(sensor, "lux", LUX_SCRIPT, params=params,
+                       extension=COMPACT_EXTENSION)
+
+
+def align(streams, fp_len, ranges=None):
+    """Align the packed fingerprints of several sensors on their timeslots.
+
+    Only complete fingerprints (i.e. at least fp_len bits after the start of
+    the recording) are used, as in the evaluation of the paper.
+    :param streams: A list of FingerprintStream objects
+    :param fp_len: The fingerprint length
+    :param ranges: An optional list of (start, end) datetime tuples. If
+        given, only timeslots within one of the ranges are used.
+    :return: A tuple (slots, packed, present) of the timeslots (T), the
+        fingerprints (T x N x words, uint64), and a mask (T x N) of the
+        sensors that have a fingerprint in every timeslot
+    """
+    complete = [stream.slots[fp_len - 1:] for stream in streams]
+    slots = np.unique(np.concatenate(complete)) if complete else \
+        np.zeros(0, dtype=np.int64)
+    if ranges:
+        selected = np.zeros(len(slots), dtype=bool)
+        for start, end in ranges:
+            selected |= (slots >= to_epoch_us(start)) & \
+                (slots <= to_epoch_us(end))
+        slots = slots[selected]
+
+    n_words = (fp_len + 63) // 64
+    packed = np.zeros((len(slots), len(streams), n_words), dtype=np.uint64)
+    present = np.zeros((len(slots), len(streams)), dtype=bool)
+    for n, stream in enumerate(streams):
+        idx = np.searchsorted(slots, stream.slots)
+        found = (idx < len(slots)) & \
+            (slots[np.minimum(idx, len(slots) - 1)] == stream.slots)
+        found[:fp_len - 1] = False
+        if not found.any():
+            continue
+        packed[idx[found], n] = stream.packed_all(fp_len)[found]
+        present[idx[found], n] = True
+    return slots, packed, present
+
+
+# ---------------------
+# Statistical functions
+# ---------------------
+def agreement_matrices(packed, present, fp_len):
+    """Count the agreeing bits of all pairs of sensors in every timeslot.
+
+    :param packed: The aligned fingerprints (T x N x words), see align
+    :param present: The mask (T x N) of available fingerprints
+    :param fp_len: The fingerprint length
+    :return: An array (T x N x N, int16) of the number of agreeing bits, -1
+        where one of the sensors has no fingerprint
+    """
+    n_slots, n_sensors = present.shape
+    rv = np.empty((n_slots, n_sensors, n_sensors), dtype=np.int16)
+    for lo in range(0, n_slots, SLOT_BLOCK):
+        block = packed[lo:lo + SLOT_BLOCK]
+        diff = popcount(block[:, :, None, :] ^ block[:, None, :, :])
+        rv[lo:lo + SLOT_BLOCK] = fp_len - diff
+    valid = present[:, :, None] & present[:, None, :]
+    rv[~valid] = -1
+    return rv
+
+
+def split_colocated(agreement, sensors, fp_len, interval=6):
+    """Split the pairwise similarities into colocated and non-colocated ones.
+
+    :param agreement: The agreement matrices, see agreement_matrices
+    :param sensors: The sensor numbers (ints) in the order of the matrices
+    :param fp_len: The fingerprint length
+    :param interval: The colocation interval, see is_colocated_interval
+    :return: A tuple (colocated, non_colocated) of arrays of similarities
+        in percent, one value per timeslot and pair of sensors
+    """
+    first, second = np.triu_indices(len(sensors), k=1)
+    colo = np.array([is_colocated_interval(sensors[i], sensors[j], interval)
+                     for i, j in zip(first, second)], dtype=bool)
+    values = agreement[:, first, second]
+    perc = values * 100.0 / fp_len
+    valid = values >= 0
+    return perc[valid & colo[None, :]], perc[valid & ~colo[None, :]]
+
+
+# ------------------------
+# Main evaluation function
+# ------------------------
+def compute(streams, fp_len, ranges=None):
+    """Compute the agreement matrices of several sensors.
+
+    :return: A tuple (slots, agreement), see align and agreement_matrices
+    """
+    slots, packed, present = align(streams, fp_len, ranges)
+    return slots, agreement_matrices(packed, present, fp_len)
+
+
+def process_sensors(sensors, files, slotsize, fp_len, delta_rel=THRES_REL,
+                    delta_abs=THRES_ABS, ranges=None, name=None):
+    """Compute and save the agreement matrices of all sensors.
+
+    The change bits of every sensor are loaded from its compact result file
+    if it exists, and computed from the luminosity data otherwise. The
+    result is saved as a numpy archive with the timeslots (in microseconds
+    since the epoch), the sensor names, the agreement matrices and the
+    metadata (as json). Results restricted to time ranges should be given a
+    (subscenario) name, which becomes part of the result path.
+    """
+    streams = []
+    for sensor, filename in zip(sensors, files):
+        path = compact_path(sensor, slotsize, delta_rel, delta_abs)
+        if isfile(path):
+            streams.append(load_compact(path)[1])
+        else:
+            streams.append(stream_from_lux(filename, slotsize, delta_rel,
+                                           delta_abs))
+
+    params = {
+        "chunk_len": slotsize,
+        "fp_len": fp_len,
+        "delta_rel": delta_rel,
+        "delta_abs": delta_abs
+    }
+    if name is not None:
+        params["subscenario"] = name
+    metadata = create_metadata(files, SCRIPT, params=params)
+    if ranges:
+        metadata["ranges"] = [[start.strftime("%Y-%m-%d %H:%M:%S"),
+                               end.strftime("%Y-%m-%d %H:%M:%S")]
+                              for start, end in ranges]
+    slots, agreement = compute(streams, fp_len, ranges)
+    metadata["processing_end"] = \
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+
+    path = derive_result_path("all", "lux", SCRIPT, params=params,
+                              extension=".npz")
+    np.savez_compressed(path, slots=slots, sensors=np.array(sensors),
+                        agreement=agreement, metadata=dumps(metadata))
+    return path
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(description="Compute the pairwise bit "
+                                "agreement of the luminosity fingerprints of "
+                                "all sensors.")
+    arg_parser.add_argument("--slotsize", type=int, default=60)
+    arg_parser.add_argument("--fp-len", type=int, default=128)
+    arg_parser.add_argument("--range", nargs=2, action="append",
+                            metavar=("START", "END"),
+                            help="only use timeslots between START and END "
+                            "(can be given several times, e.g. for a "
+                            "subscenario)")
+    arg_parser.add_argument("--name", help="name of the subscenario given "
+                            "by --range, used in the result path")
+    args = arg_parser.parse_args()
+
+    lux_files = sorted(glob("Sensor-*/sensors/luxData.*clean"))
+    ranges = [(parser.parse(start), parser.parse(end))
+              for start, end in args.range or []]
+    print(process_sensors([f[0:9] for f in lux_files], lux_files,
+                          args.slotsize, args.fp_len, ranges=ranges,
+                          name=args.name))
+
+
+# ----------
+# Unit tests
+# ----------
+def test_agreement_matrices():
+    start = 1502402400000000
+    streams = [FingerprintStream(start + np.arange(6) * 5000000,
+                                 [1, 0, 1, 1, 0, 1]),
+               FingerprintStream(start + np.arange(1, 6) * 5000000,
+                                 [0, 1, 1, 0, 0]),
+               FingerprintStream(start + np.arange(6) * 5000000,
+                                 [0, 1, 0, 0, 1, 0])]
+    slots, agreement = compute(streams, 3)
+    assert list(slots) == list(start + np.arange(2, 6) * 5000000)
+    # Sensor 2 has its first complete fingerprint in slot 3
+    assert agreement[0, 0, 1] == -1
+    assert agreement[0, 0, 2] == 0
+    assert list(agreement[:, 0, 0]) == [3, 3, 3, 3]
+    for t in range(1, 4):
+        fps = [stream.fingerprint(int(np.searchsorted(stream.slots,
+                                                      slots[t])), 3)
+               for stream in streams]
+        for i in range(3):
+            for j in range(3):
+                assert agreement[t, i, j] == \
+                    sum(a == b for a, b in zip(fps[i], fps[j]))
+
+    colo, ncolo = split_colocated(agreement, [1, 2, 7], 3)
+    assert len(colo) == 3 and len(ncolo) == 7
+    # Sensors 1 and 3 never agree
+    assert ncolo.min() == 0.0
+
+    slots, agreement = compute(streams, 3, ranges=[(
+        datetime(2017, 8, 10, 22, 0, 14), datetime(2017, 8, 10, 22, 0, 20))])
+    assert len(slots) == 2
+
+
+def test_compact_path(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    start = 1502402400000000
+    bits = np.array([1, 0, 1], dtype=bool)
+    save_compact("Sensor-01", {}, 10, start + np.arange(3) * 10000000, bits,
+                 0.2, 5)
+    stream = load_compact(compact_path("Sensor-01", 10, 0.2, 5))[1]
+    assert np.array_equal(stream.bits, bits)
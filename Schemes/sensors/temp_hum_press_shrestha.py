@@ -8,18 +8,52 @@ Uses ML
 """
 
 
-from datetime import datetime
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from functools import partial
 from dateutil import parser
 from glob import glob
 from json import dumps
 from multiprocessing import Pool, cpu_count
 from itertools import combinations
-from util import create_metadata, derive_result_path
+from os.path import isfile
+from util import create_metadata, create_run_context, derive_result_path, \
+    export_stores, hash_file, init_run_context, parse_timestamps, \
+    result_dir, result_path, save_stores, select_tasks, store_result, \
+    time_strings
+import numpy as np
+import os
+import sys
 import traceback
 
 
 SCRIPT = __file__[:-3]
 
+# Maximum time difference (in microseconds) between synced samples
+SYNC_TOLERANCE = 200000
+
+# Initial number of samples checked at once when following a synced run
+# (doubled while the run continues, up to SYNC_CHUNK_MAX)
+SYNC_CHUNK = 64
+SYNC_CHUNK_MAX = 65536
+
+# Features (as used in the result paths) and the names of their data files
+FEATURES = {
+    "temp": "tmpData",
+    "hum": "humData",
+    "press": "barData"
+}
+
+# Spacing of the common time grid of the all-pairs mode (in microseconds)
+GRID_STEP = 100000
+
+# Number of sensors per group in the all-pairs mode: a task computes the
+# pairs between two groups, so it resamples at most twice as many sensors
+GRID_GROUP = 4
+
+# Extension of the altitude cache files, saved next to the barometric data
+ALTITUDE_EXTENSION = ".altitude.npz"
+
 
 class Measurement:
     """Measurement class - contains individual measurements."""
@@ -64,211 +98,573 @@ def read_results(filename):
     return rv
 
 
-def acceptable_difference(element1, element2):
-    td = element1.time - element2.time
-    if td.days < 0:
-        td = element2.time - element1.time
-    return td.days == 0 and td.seconds == 0 and td.microseconds < 200000
+def read_results_columnar(filename):
+    """Read in results like read_results, but into numpy arrays.
 
+    :return: A tuple (values, time) of the values (float64) and their
+        timestamps in microseconds since the epoch (int64)
+    """
+    values = []
+    times = []
+    with open(filename, 'r') as fo:
+        for line in fo:
+            # Parse out value and timestamp
+            try:
+                value, timestring = line.strip().split(" ")
+            except ValueError:
+                print("[WARN] Error while parsing line in file %s, skipping" % filename)
+                continue
+            values.append(float(value))
+            times.append(timestring)
+    return np.array(values, dtype=np.float64), parse_timestamps(times)
 
-def sync_populations(pop1, pop2, sensor1="", sensor2=""):
-    """Determine the offset between population 1 and 2."""
-    # Establish initial sync
+
+def _sync_walk(time1, time2):
+    # Pairwise walk over both populations, see sync_times. Only used for
+    # timestamps that are not sorted, where the walk cannot be vectorized.
     p1_ctr = 0
     p2_ctr = 0
-    while not acceptable_difference(pop1[p1_ctr], pop2[p2_ctr]):
-        td = pop1[p1_ctr].time - pop2[p2_ctr].time
-        if td.days < 0:
-            p1_ctr += 1
-        else:
-            p2_ctr += 1
-
-    # Track number of skipped samples
-    skipped_samples = p1_ctr + p2_ctr
-    # Prepare output
     rv_1 = []
     rv_2 = []
-
-    # Track if the sync deteriorated or not
-    deteriorate = False
-
-    # Create pairs
-    while p1_ctr < len(pop1) and p2_ctr < len(pop2):
-        # Check if the sync is still good
-        if acceptable_difference(pop1[p1_ctr], pop2[p2_ctr]):
-            # If the sync was bad before, log recovery
-            if deteriorate:
-                # print("Sync reestablished:", pop1[p1_ctr].time, pop2[p2_ctr].time)
-                deteriorate = False
-            # The two elements have an acceptable difference, save them
-            rv_1.append(pop1[p1_ctr])
-            rv_2.append(pop2[p2_ctr])
-            # Increase indices
+    while p1_ctr < len(time1) and p2_ctr < len(time2):
+        if abs(time1[p1_ctr] - time2[p2_ctr]) < SYNC_TOLERANCE:
+            rv_1.append(p1_ctr)
+            rv_2.append(p2_ctr)
             p1_ctr += 1
             p2_ctr += 1
+        elif time1[p1_ctr] < time2[p2_ctr]:
+            p1_ctr += 1
         else:
-            # Check if the sync was bad before, log if it is newly bad
-            if not deteriorate:
-                # print("Sync deteriorated:", pop1[p1_ctr].time, pop2[p2_ctr].time)
-                deteriorate = True
-            # The difference is unacceptably high, we need to reconcile
-            # Find the earlier timestamp and increment the index of that list
-            if pop1[p1_ctr].time < pop2[p2_ctr].time:
-                p1_ctr += 1
-            else:
-                p2_ctr += 1
-            skipped_samples += 1
+            p2_ctr += 1
+    if not rv_1:
+        raise IndexError("No initial sync between the populations")
+    skipped_samples = p1_ctr + p2_ctr - 2 * len(rv_1)
+    return (np.array(rv_1, dtype=np.int64), np.array(rv_2, dtype=np.int64),
+            skipped_samples)
+
+
+def sync_times(time1, time2):
+    """Determine which samples of population 1 and 2 are synced up.
+
+    Both populations are walked in parallel: two samples are paired if their
+    timestamps differ by less than SYNC_TOLERANCE, otherwise the earlier one
+    is skipped. For sorted timestamps, runs of skipped samples are passed
+    with searchsorted and runs of synced samples are compared block-wise,
+    which gives the same pairs as the sample-by-sample walk.
+    :param time1: The timestamps of population 1 (int64, microseconds)
+    :param time2: The timestamps of population 2 (int64, microseconds)
+    :return: A tuple (idx1, idx2, skipped_samples) of the indices of the
+        paired samples in both populations, and the number of samples that
+        were skipped before the end of one population was reached
+    :raises IndexError: If no two samples can be synced up
+    """
+    time1 = np.asarray(time1, dtype=np.int64)
+    time2 = np.asarray(time2, dtype=np.int64)
+    if (np.diff(time1) < 0).any() or (np.diff(time2) < 0).any():
+        return _sync_walk(time1, time2)
+
+    runs = []
+    p1_ctr = 0
+    p2_ctr = 0
+    while p1_ctr < len(time1) and p2_ctr < len(time2):
+        td = time1[p1_ctr] - time2[p2_ctr]
+        if td <= -SYNC_TOLERANCE:
+            # Skip all samples of population 1 that are too early
+            p1_ctr = int(np.searchsorted(time1, time2[p2_ctr] - SYNC_TOLERANCE,
+                                         side="right"))
+            continue
+        if td >= SYNC_TOLERANCE:
+            # Skip all samples of population 2 that are too early
+            p2_ctr = int(np.searchsorted(time2, time1[p1_ctr] - SYNC_TOLERANCE,
+                                         side="right"))
+            continue
+
+        # Follow the run of synced samples until the sync deteriorates
+        limit = min(len(time1) - p1_ctr, len(time2) - p2_ctr)
+        length = 1
+        chunk = SYNC_CHUNK
+        while length < limit:
+            end = min(length + chunk, limit)
+            bad = np.flatnonzero(
+                np.abs(time1[p1_ctr + length:p1_ctr + end] -
+                       time2[p2_ctr + length:p2_ctr + end]) >= SYNC_TOLERANCE)
+            if len(bad) > 0:
+                length += int(bad[0])
+                break
+            length = end
+            chunk = min(chunk * 2, SYNC_CHUNK_MAX)
+        runs.append((p1_ctr, p2_ctr, length))
+        p1_ctr += length
+        p2_ctr += length
+
+    if not runs:
+        raise IndexError("No initial sync between the populations")
+    idx1 = np.concatenate([np.arange(p1, p1 + n) for p1, _, n in runs])
+    idx2 = np.concatenate([np.arange(p2, p2 + n) for _, p2, n in runs])
+    skipped_samples = p1_ctr + p2_ctr - 2 * len(idx1)
+    return idx1, idx2, skipped_samples
+
+
+def sync_populations(pop1, pop2, sensor1="", sensor2=""):
+    """Determine the offset between population 1 and 2.
+
+    :return: A tuple of the two synced-up lists of Measurements, see
+        sync_times
+    :raises IndexError: If no sync is possible
+    """
+    if not pop1 or not pop2:
+        raise IndexError("Empty population")
+    # Timestamps relative to the first sample, which also works for
+    # timezone-aware datetimes
+    ref = pop1[0].time
+    time1 = [(m.time - ref) // timedelta(microseconds=1) for m in pop1]
+    time2 = [(m.time - ref) // timedelta(microseconds=1) for m in pop2]
+    idx1, idx2, skipped_samples = sync_times(time1, time2)
 
-    # We have now created two populations that are perfectly synced up.
-    # Return them.
     print("[INFO] Skipped", skipped_samples, "samples. %s %s" %
           (sensor1, sensor2))
-    return (rv_1, rv_2)
+    return ([pop1[i] for i in idx1], [pop2[i] for i in idx2])
 
 
 def convert_meters(pressure):
     # Convert pressure value to height in meters according to formula (1)
-    # from the paper
+    # from the paper (works for floats and numpy arrays)
     return (1 - (pressure / 1013.25) ** 0.190284) * 145336.45 * 0.3048
 
 
+def read_altitudes(filename):
+    """Read in barometric data and convert the pressures to altitudes.
+
+    The altitudes are cached next to the data file (with ALTITUDE_EXTENSION),
+    together with the SHA1 hash of the data file. The cache is only used
+    while the hash matches, so every sensor is converted once instead of once
+    per pair.
+    :return: A tuple (altitudes, time), see read_results_columnar
+    """
+    digest = hash_file(filename)
+    cache = filename + ALTITUDE_EXTENSION
+    if isfile(cache):
+        try:
+            with np.load(cache) as data:
+                if str(data["sha1"]) == digest:
+                    return data["altitude"], data["time"]
+        except Exception:
+            print("[WARN] Unreadable altitude cache", cache, "- recomputing")
+
+    values, time = read_results_columnar(filename)
+    altitude = convert_meters(values)
+    # Write to a temporary file first, other pairs may read the cache
+    # concurrently
+    tmp = "%s.%d.tmp" % (cache, os.getpid())
+    try:
+        with open(tmp, "wb") as fo:
+            np.savez(fo, sha1=digest, altitude=altitude, time=time)
+        os.replace(tmp, cache)
+    except OSError as e:
+        print("[WARN] Could not cache altitudes of", filename, ":", e)
+    return altitude, time
+
+
+def read_feature(filename, feature):
+    """Read in the data of a feature (see FEATURES), with the pressures
+    converted to altitudes."""
+    if feature == "press":
+        return read_altitudes(filename)
+    return read_results_columnar(filename)
+
+
+def resample(values, time, start, n_points, step=GRID_STEP, tolerance=None):
+    """Resample a population onto a time grid.
+
+    Every grid point takes the value of the nearest sample, if that sample is
+    less than tolerance away from the grid point.
+    :param values: The values of the population (float64)
+    :param time: Their timestamps (int64, microseconds since the epoch)
+    :param start: The first grid point (microseconds since the epoch)
+    :param n_points: The number of grid points
+    :param step: The spacing of the grid points (microseconds)
+    :param tolerance: The maximum distance of a sample from a grid point
+        (microseconds), defaults to half a step
+    :return: A tuple (grid, present) of the resampled values (NaN where no
+        sample is near) and the mask of the grid points that have a sample
+    """
+    if tolerance is None:
+        tolerance = step // 2
+    grid = np.full(n_points, np.nan)
+    present = np.zeros(n_points, dtype=bool)
+    if len(time) == 0:
+        return grid, present
+    order = np.argsort(time, kind="mergesort")
+    time = time[order]
+
+    # Nearest sample of every grid point (the earlier one on ties)
+    points = start + np.arange(n_points, dtype=np.int64) * step
+    after = np.minimum(np.searchsorted(time, points), len(time) - 1)
+    before = np.maximum(after - 1, 0)
+    take_before = np.abs(time[before] - points) <= np.abs(time[after] - points)
+    nearest = np.where(take_before, before, after)
+
+    present[:] = np.abs(time[nearest] - points) < tolerance
+    grid[present] = values[order[nearest[present]]]
+    return grid, present
+
+
 # ---------------------
 # Statistical functions
 # ---------------------
-def difference(element1, element2):
-    return abs(element1.value - element2.value)
+def grid_difference(grid, present, i, j):
+    """Compute the differences between two sensors on the time grid.
+
+    :param grid: The resampled values (N x T, one row per sensor), see
+        resample
+    :param present: The mask (N x T) of the available values
+    :param i: The index of the first sensor
+    :param j: The index of the second sensor
+    :return: A tuple (idx, diff) of the grid points where both values are
+        available and the absolute differences at these points
+    """
+    idx = np.nonzero(present[i] & present[j])[0]
+    return idx, np.abs(grid[i, idx] - grid[j, idx])
 
 
 # ------------------------
 # Main evaluation function
 # ------------------------
+def synced_differences(pop1, pop2, sync):
+    """Compute the differences between two synced-up populations.
+
+    :param pop1: A tuple (values, time) of population 1, see
+        read_results_columnar
+    :param pop2: A tuple (values, time) of population 2
+    :param sync: A tuple (idx1, idx2) of the paired samples, see sync_times
+    :return: A dictionary of the differences, keyed by the timestamps of
+        population 1
+    """
+    idx1, idx2 = sync
+    return dict(zip(time_strings(pop1[1][idx1]),
+                    np.abs(pop1[0][idx1] - pop2[0][idx2]).tolist()))
+
+
 def compute(file1, file2, bar=False):
     try:
-        # Read results
-        pop1 = read_results(file1)
-        pop2 = read_results(file2)
-        assert pop1 is not None
-        assert pop2 is not None
+        # Read results (air pressures as altitudes)
+        feature = "press" if bar else None
+        pop1 = read_feature(file1, feature)
+        pop2 = read_feature(file2, feature)
 
-        # Split into timeslots
+        # Sync up the populations
         try:
-            pop1, pop2 = sync_populations(pop1, pop2, file1, file2)
+            idx1, idx2, skipped_samples = sync_times(pop1[1], pop2[1])
         except IndexError as e:
             print("[ERR ] No sync possible for ", file1, "-", file2, ":", e)
             return {"error": "No sync possible"}
+        print("[INFO] Skipped", skipped_samples, "samples. %s %s" %
+              (file1, file2))
 
         # Process results
-        rv = {}
-        for i in range(min(len(pop1), len(pop2))):
-            if bar:
-                pop1[i].value = convert_meters(pop1[i].value)
-                pop2[i].value = convert_meters(pop2[i].value)
-            if not acceptable_difference(pop1[i], pop2[i]):
-                print("[WARN] Unacceptable time difference at position", i,
-                      "for files", file1, file2, "- proceeding anyways")
-
-            tstr = pop1[i].time.strftime("%Y-%m-%d %H:%M:%S.%f")
-            rv[tstr] = difference(pop1[i], pop2[i])
-
-        return rv
+        return synced_differences(pop1, pop2, (idx1, idx2))
     except Exception:
         traceback.print_exc()
 
 
-def process_temp(files_tuple):
-    pop1, pop2 = files_tuple
-    # Get sensor number from path
-    no1 = pop1[0:9]
-    no2 = pop2[0:9]
+def compute_pair(files1, files2):
+    """Compute the differences of all features of two sensors.
 
-    # Generate metadata
+    The populations of the features are synced up only once per distinct
+    pair of timestamp arrays. The RuuviTags record temperature, humidity and
+    air pressure with the same timestamps, so usually a single sync is
+    computed for all features.
+    :param files1: A dictionary mapping features (see FEATURES) to the data
+        files of sensor 1
+    :param files2: The same for sensor 2
+    :return: A dictionary mapping every feature that both sensors have to
+        its results, like compute
+    """
     rv = {}
-    rv["metadata"] = create_metadata([pop1, pop2], SCRIPT)
-
-    # Compute and save the features
-    print("[TEMP] Computing features for Sensors", no1, "and", no2)
-    rv["results"] = compute(pop1, pop2)
-
-    # Save timestamp of finished processing
-    rv["metadata"]["processing_end"] = \
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-
-    # Save result json to file
-    path = derive_result_path(no1, "temp", SCRIPT, no2)
-    with open(path, "w") as fo:
-        fo.write(dumps(rv, indent=4, sort_keys=True))
-
-
-def process_hum(files_tuple):
-    pop1, pop2 = files_tuple
-    # Get sensor number from path
-    no1 = pop1[0:9]
-    no2 = pop2[0:9]
-
-    # Generate metadata
-    rv = {}
-    rv["metadata"] = create_metadata([pop1, pop2], SCRIPT)
-
-    # Compute and save the features
-    print("[HUM ] Computing features for Sensors", no1, "and", no2)
-    rv["results"] = compute(pop1, pop2)
-
-    # Save timestamp of finished processing
-    rv["metadata"]["processing_end"] = \
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-
-    # Save result json to file
-    path = derive_result_path(no1, "hum", SCRIPT, no2)
-    with open(path, "w") as fo:
-        fo.write(dumps(rv, indent=4, sort_keys=True))
+    # List of (time1, time2, sync) tuples of the already synced populations
+    syncs = []
+    for feature in FEATURES:
+        if feature not in files1 or feature not in files2:
+            continue
+        file1 = files1[feature]
+        file2 = files2[feature]
+        try:
+            # Read results
+            pop1 = read_feature(file1, feature)
+            pop2 = read_feature(file2, feature)
+
+            # Reuse the sync of another feature with the same timestamps
+            sync = None
+            for time1, time2, other in syncs:
+                if np.array_equal(time1, pop1[1]) and \
+                        np.array_equal(time2, pop2[1]):
+                    sync = other
+                    break
+            if sync is None:
+                try:
+                    idx1, idx2, skipped_samples = sync_times(pop1[1], pop2[1])
+                    sync = (idx1, idx2)
+                    print("[INFO] Skipped", skipped_samples, "samples. %s %s"
+                          % (file1, file2))
+                except IndexError as e:
+                    print("[ERR ] No sync possible for ", file1, "-", file2,
+                          ":", e)
+                    sync = False
+                syncs.append((pop1[1], pop2[1], sync))
+
+            # Process results
+            if sync is False:
+                rv[feature] = {"error": "No sync possible"}
+            else:
+                rv[feature] = synced_differences(pop1, pop2, sync)
+        except Exception:
+            traceback.print_exc()
+            rv[feature] = None
+    return rv
 
 
-def process_bar(files_tuple):
-    pop1, pop2 = files_tuple
+def process_pair(sensors_tuple, store=False):
+    files1, files2 = sensors_tuple
     # Get sensor number from path
-    no1 = pop1[0:9]
-    no2 = pop2[0:9]
+    no1 = next(iter(files1.values()))[0:9]
+    no2 = next(iter(files2.values()))[0:9]
 
-    # Generate metadata
+    # Generate metadata for every feature
     rv = {}
-    rv["metadata"] = create_metadata([pop1, pop2], SCRIPT)
-
-    # Compute and save the features
-    print("[BAR ] Computing features for Sensors", no1, "and", no2)
-    rv["results"] = compute(pop1, pop2, bar=True)
-
-    # Save timestamp of finished processing
-    rv["metadata"]["processing_end"] = \
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-
-    # Save result json to file
-    path = derive_result_path(no1, "press", SCRIPT, no2)
-    with open(path, "w") as fo:
-        fo.write(dumps(rv, indent=4, sort_keys=True))
+    for feature in FEATURES:
+        if feature in files1 and feature in files2:
+            rv[feature] = {"metadata": create_metadata(
+                [files1[feature], files2[feature]], SCRIPT)}
+
+    # Compute the features
+    print("[PAIR] Computing features for Sensors", no1, "and", no2)
+    results = compute_pair(files1, files2)
+
+    outputs = []
+    for feature in rv:
+        rv[feature]["results"] = results[feature]
+        # Save timestamp of finished processing
+        rv[feature]["metadata"]["processing_end"] = \
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        if store:
+            # Write a chunk of the ResultStore instead (see save_stores)
+            outputs.append(store_result(feature, SCRIPT, no1, no2,
+                                        rv[feature]))
+            continue
+
+        # Save result json to file
+        path = derive_result_path(no1, feature, SCRIPT, no2)
+        with open(path, "w") as fo:
+            fo.write(dumps(rv[feature], indent=4, sort_keys=True))
+    return outputs
+
+
+def find_sensor_files():
+    """Find the temperature, humidity and barometric data files of every
+    sensor (Sensor-*/sensors/, see FEATURES).
+
+    :return: A dictionary mapping every sensor (e.g. Sensor-01) to a
+        dictionary mapping the features to its data file
+    :raises ValueError: If a sensor has several data files for a feature
+    """
+    sensor_files = {}
+    for feature, pattern in FEATURES.items():
+        for data_file in sorted(glob("Sensor-*/sensors/%s*" % pattern)):
+            # Skip the altitude caches next to the barometric data
+            if ALTITUDE_EXTENSION in data_file:
+                continue
+            files = sensor_files.setdefault(data_file[0:9], {})
+            if feature in files:
+                raise ValueError("Several %s files for %s: %s and %s" % (
+                    feature, data_file[0:9], files[feature], data_file))
+            files[feature] = data_file
+    return sensor_files
+
+
+def pair_outputs(sensors_tuple):
+    """Return the result files of a pair of sensors, see select_tasks."""
+    files1, files2 = sensors_tuple
+    no1 = next(iter(files1.values()))[0:9]
+    no2 = next(iter(files2.values()))[0:9]
+    return [(result_path(no1, feature, SCRIPT, no2),
+             [files1[feature], files2[feature]], {})
+            for feature in FEATURES if feature in files1 and feature in files2]
+
+
+def grid_outputs(args):
+    """Return the result file of a pair of sensors in --grid mode, see
+    select_tasks."""
+    feature, files, step, (i, j) = args
+    params = {"grid": step // 1000}
+    return [(result_path(files[i][0:9], feature, SCRIPT, files[j][0:9],
+                         params), [files[i], files[j]], params)]
+
+
+def grid_tasks(tasks, group=GRID_GROUP):
+    """Group the selected pairs of grid_outputs into process_grid tasks.
+
+    The sensors are split into groups of consecutive sensors, and a task
+    computes the selected pairs between two groups (or within one group).
+    It thus only holds the grid of up to 2 x group sensors, and the tasks of
+    a feature run in parallel.
+    """
+    pairs = {}
+    for feature, files, step, (i, j) in tasks:
+        key = (feature, tuple(files), step, i // group, j // group)
+        pairs.setdefault(key, []).append((i, j))
+    return [(feature, list(files), step, selected)
+            for (feature, files, step, _, _), selected in pairs.items()]
+
+
+def compute_grid(files, feature, step=GRID_STEP, pairs=None):
+    """Compute the differences of a feature between pairs of sensors.
+
+    Instead of syncing up every pair of sensors, the population of every
+    sensor is resampled once onto a common time grid, and the differences of
+    a pair are computed from the resampled values of both sensors (see
+    grid_difference). The results are generated one pair at a time, so only
+    the grid and the result of one pair are held in memory. Only the sensors
+    of the given pairs are read; the grid points are multiples of the step,
+    so the results do not depend on the other sensors.
+    :param files: The data files of the sensors
+    :param feature: The feature (see FEATURES)
+    :param step: The spacing of the grid points (microseconds)
+    :param pairs: The index pairs (i, j), i < j, of the sensors to compute,
+        defaults to all pairs
+    :return: A generator of the tuples (i, j, result) of the index pairs,
+        i < j, of the sensors and their results, keyed by the grid timestamps
+    """
+    if pairs is None:
+        pairs = combinations(range(len(files)), 2)
+    pairs = list(pairs)
+    used = sorted(set(n for pair in pairs for n in pair))
+    row = {n: r for r, n in enumerate(used)}
+
+    pops = [read_feature(files[n], feature) for n in used]
+    times = [time for _, time in pops if len(time) > 0]
+    if not times:
+        for i, j in pairs:
+            yield i, j, {"error": "No sync possible"}
+        return
+    start = min(time.min() for time in times) // step * step
+    n_points = (max(time.max() for time in times) - start) // step + 1
+
+    # One row per sensor, so the values of a sensor are contiguous
+    grid = np.empty((len(used), n_points))
+    present = np.zeros((len(used), n_points), dtype=bool)
+    for n, (values, time) in enumerate(pops):
+        grid[n], present[n] = resample(values, time, start, n_points, step)
+    del pops
+
+    for i, j in pairs:
+        idx, diff = grid_difference(grid, present, row[i], row[j])
+        if len(idx) == 0:
+            yield i, j, {"error": "No sync possible"}
+            continue
+        yield i, j, dict(zip(time_strings(start + idx * step), diff.tolist()))
+
+
+def process_grid(args, store=False):
+    feature, files, step, pairs = args
+    params = {"grid": step // 1000}
+
+    # Generate metadata for every pair
+    metadata = {pair: create_metadata([files[pair[0]], files[pair[1]]],
+                                      SCRIPT, params=params)
+                for pair in pairs}
+
+    # Compute the features, saving every pair as soon as it is computed
+    print("[GRID] Computing", feature, "features for", len(pairs), "pairs")
+    outputs = []
+    for i, j, result in compute_grid(files, feature, step, pairs):
+        rv = {"metadata": metadata.pop((i, j)), "results": result}
+        # Save timestamp of finished processing
+        rv["metadata"]["processing_end"] = \
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
+        if store:
+            # Write a chunk of the ResultStore instead (see save_stores)
+            outputs.append(store_result(feature, SCRIPT, files[i][0:9],
+                                        files[j][0:9], rv, params))
+            continue
+
+        # Save result json to file
+        path = derive_result_path(files[i][0:9], feature, SCRIPT,
+                                  files[j][0:9], params=params)
+        with open(path, "w") as fo:
+            fo.write(dumps(rv, indent=4, sort_keys=True))
+    return outputs
 
 
 if __name__ == "__main__":
-    # Prepare variables to hold stuff
-    temp_files = []
-    hum_files = []
-    bar_files = []
-
-    # Find all accelerometer, gyroscope result files that are available
-    for temp_file in sorted(glob("Sensor-*/sensors/tmpData*")):
-        temp_files.append(temp_file)
-    for hum_file in sorted(glob("Sensor-*/sensors/humData*")):
-        hum_files.append(hum_file)
-    for bar_file in sorted(glob("Sensor-*/sensors/barData*")):
-        bar_files.append(bar_file)
-
-    pool = Pool(processes=cpu_count(), maxtasksperchild=1)
-
-    # Compute features for temperature data
-    pool.imap(process_temp, combinations(temp_files, 2))
-    # for humidity data
-    pool.imap(process_hum, combinations(hum_files, 2))
-    # and for barometric data
-    pool.imap(process_bar, combinations(bar_files, 2))
+    arg_parser = ArgumentParser(description="Compute the features of "
+                                "Shrestha et al. for all pairs of sensors.")
+    arg_parser.add_argument("--grid", action="store_true",
+                            help="resample all sensors onto a common time "
+                            "grid instead of syncing up every pair")
+    arg_parser.add_argument("--grid-step", type=int, default=100,
+                            help="spacing of the time grid in milliseconds")
+    arg_parser.add_argument("--force", action="store_true",
+                            help="also recompute results that are up to "
+                            "date")
+    arg_parser.add_argument("--store", action="store_true",
+                            help="save the results of all pairs in one "
+                            "columnar result store per feature")
+    arg_parser.add_argument("--export-store", action="store_true",
+                            help="export all result stores to per-pair json "
+                            "files")
+    args = arg_parser.parse_args()
+
+    if args.export_store:
+        export_stores(SCRIPT)
+        sys.exit(0)
+
+    # Find the temperature, humidity and barometric data files of every sensor
+    try:
+        sensor_files = find_sensor_files()
+    except ValueError as e:
+        arg_parser.error(str(e))
+
+    # Query the metadata shared by all results and create the result folders
+    # once for the whole run
+    params = {"grid": args.grid_step} if args.grid else {}
+    context = create_run_context(
+        result_dir(sensor, feature, SCRIPT, params)
+        for sensor in sorted(sensor_files)[:-1] for feature in FEATURES)
+    init_run_context(context)
+
+    # Skip the tasks whose results are all up to date
+    if args.grid:
+        # Only the pairs whose results are not up to date are computed
+        grid_files = {feature: [sensor_files[sensor][feature]
+                                for sensor in sorted(sensor_files)
+                                if feature in sensor_files[sensor]]
+                      for feature in FEATURES}
+        tasks = grid_tasks(select_tasks(
+            [(feature, files, args.grid_step * 1000, pair)
+             for feature, files in grid_files.items()
+             for pair in combinations(range(len(files)), 2)],
+            grid_outputs, force=args.force or args.store, name="pairs"))
+    else:
+        tasks = select_tasks(
+            combinations([sensor_files[sensor]
+                          for sensor in sorted(sensor_files)], 2),
+            pair_outputs, force=args.force or args.store, name="pairs")
+
+    pool = Pool(processes=cpu_count(), initializer=init_run_context,
+                initargs=(context,))
+
+    if args.grid:
+        # Compute the features of all pairs of sensors per kind of data
+        outputs = pool.imap(partial(process_grid, store=args.store), tasks)
+    else:
+        # Compute the features of all three kinds of data per pair of sensors
+        outputs = pool.imap(partial(process_pair, store=args.store), tasks)
+
+    # With --store, the tasks return the entries of the result store chunks
+    if args.store:
+        for path in save_stores((output for block in outputs
+                                 for output in block), SCRIPT):
+            print("[INFO] Saved", path)
 
     # Wait for processes to terminate
     pool.close()
@@ -346,4 +742,148 @@ def test_population_sync_alignment_switch_regression():
         sync_populations(pop1, pop2)
         assert True
     except IndexError:
-        assert False, "This statement should be unreachable"
\ No newline at end of file
+        assert False, "This statement should be unreachable"
+
+def test_sync_times_greedy():
+    # Compare with the sample-by-sample walk on sorted, jittered timestamps
+    # with gaps in both populations
+    rng = np.random.RandomState(0)
+    for _ in range(20):
+        time1 = np.cumsum(rng.choice([100000, 100000, 100000, 250000, 3000000],
+                                     size=500)) + rng.randint(0, 300000)
+        time2 = np.cumsum(rng.choice([100000, 100000, 180000, 700000],
+                                     size=400)) + rng.randint(0, 300000)
+        idx1, idx2, skipped = sync_times(time1, time2)
+        ref1, ref2, ref_skipped = _sync_walk(time1, time2)
+        assert list(idx1) == list(ref1)
+        assert list(idx2) == list(ref2)
+        assert skipped == ref_skipped
+        assert (np.abs(time1[idx1] - time2[idx2]) < SYNC_TOLERANCE).all()
+
+    try:
+        sync_times([0, 100000], [1000000, 1100000])
+        assert False, "This statement should be unreachable"
+    except IndexError:
+        assert True
+
+
+def test_compute_pair(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    # Temperature and humidity share their timestamps, pressure does not
+    lines1 = ["%d 2017-08-16T12:15:0%d.1" % (i, i) for i in range(5)]
+    lines2 = ["%d 2017-08-16T12:15:0%d.2" % (2 * i, i) for i in range(1, 6)]
+    files1 = {}
+    files2 = {}
+    for feature in FEATURES:
+        for no, files, lines in ((1, files1, lines1), (2, files2, lines2)):
+            path = tmpdir.join("%s-%d" % (feature, no))
+            path.write("\n".join(lines) + "\n")
+            files[feature] = str(path)
+    tmpdir.join("press-2").write("1000 2017-08-17T12:15:01.2\n")
+    files2["press"] = str(tmpdir.join("press-2"))
+
+    res = compute_pair(files1, files2)
+    assert res["temp"] == res["hum"] == compute(files1["temp"], files2["temp"])
+    assert res["temp"] == {"2017-08-16 12:15:01.100000": 1.0,
+                           "2017-08-16 12:15:02.100000": 2.0,
+                           "2017-08-16 12:15:03.100000": 3.0,
+                           "2017-08-16 12:15:04.100000": 4.0}
+    assert res["press"] == {"error": "No sync possible"}
+
+
+def test_read_altitudes(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    data = tmpdir.join("barData")
+    data.write("1013.25 2017-08-16T12:15:00.1\n900.5 2017-08-16T12:15:00.2\n")
+    altitude, time = read_altitudes(str(data))
+    assert tmpdir.join("barData" + ALTITUDE_EXTENSION).check()
+    assert altitude[0] == 0.0
+    assert altitude[1] == convert_meters(900.5)
+
+    # The cache is used while the data file is unchanged
+    cached, cached_time = read_altitudes(str(data))
+    assert list(cached) == list(altitude)
+    assert list(cached_time) == list(time)
+
+    # and recomputed once it changed
+    data.write("900.5 2017-08-16T12:15:00.1\n")
+    altitude, time = read_altitudes(str(data))
+    assert list(altitude) == [convert_meters(900.5)]
+
+
+def test_find_sensor_files(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    for sensor in ["Sensor-01", "Sensor-02"]:
+        data = tmpdir.mkdir(sensor).mkdir("sensors")
+        for pattern in FEATURES.values():
+            data.join(pattern).write("")
+    tmpdir.join("Sensor-01/sensors/barData" + ALTITUDE_EXTENSION).write("")
+    files = find_sensor_files()
+    assert sorted(files) == ["Sensor-01", "Sensor-02"]
+    assert files["Sensor-01"] == {"temp": "Sensor-01/sensors/tmpData",
+                                  "hum": "Sensor-01/sensors/humData",
+                                  "press": "Sensor-01/sensors/barData"}
+
+    tmpdir.join("Sensor-02/sensors/tmpData.old").write("")
+    try:
+        find_sensor_files()
+        assert False, "This statement should be unreachable"
+    except ValueError as e:
+        assert "Sensor-02/sensors/tmpData.old" in str(e)
+
+
+def test_resample():
+    time = np.array([0, 40000, 160000, 230000, 390000], dtype=np.int64) + \
+        1502885700000000
+    values = np.arange(5, dtype=np.float64)
+    grid, present = resample(values, time, 1502885700000000, 5)
+    # Grid point 0 takes the nearer sample, no sample is near grid point 3
+    assert list(present) == [True, False, True, False, True]
+    assert grid[0] == 0 and grid[2] == 3 and grid[4] == 4
+    assert np.isnan(grid[1]) and np.isnan(grid[3])
+
+
+def test_compute_grid(tmpdir):
+    files = []
+    for n, (offset, skip) in enumerate([(10000, 3), (30000, 5), (0, None)]):
+        lines = ["%d 2017-08-16T12:15:%02d.%06d" % (n * i, i // 10,
+                                                    i % 10 * 100000 + offset)
+                 for i in range(50) if i != skip]
+        path = tmpdir.join("tmpData-%d" % n)
+        path.write("\n".join(lines) + "\n")
+        files.append(str(path))
+
+    res = {(i, j): result for i, j, result in compute_grid(files, "temp")}
+    assert sorted(res) == [(0, 1), (0, 2), (1, 2)]
+    skips = [3, 5, None]
+    for (i, j), result in res.items():
+        # Samples are paired by their grid point. Unlike sync_populations,
+        # a missing sample does not shift the pairs of the following ones.
+        assert len(result) == 50 - len({skips[i], skips[j]} - {None})
+        for key, value in result.items():
+            k = int(key[17:19]) * 10 + int(key[20])
+            assert value == abs(i * k - j * k)
+    assert "2017-08-16 12:15:00.300000" not in res[(0, 1)]
+    assert "2017-08-16 12:15:00.300000" in res[(1, 2)]
+
+    # Restricted to some pairs, the results are the same
+    part = list(compute_grid(files, "temp", pairs=[(1, 2)]))
+    assert part == [(1, 2, res[(1, 2)])]
+
+
+def test_grid_tasks():
+    files = ["Sensor-01/sensors/tmpData", "Sensor-02/sensors/tmpData",
+             "Sensor-03/sensors/tmpData"]
+    tasks = [("temp", files, GRID_STEP, (0, 2)),
+             ("hum", files, GRID_STEP, (0, 1)),
+             ("temp", files, GRID_STEP, (1, 2))]
+    assert grid_tasks(tasks) == [("temp", files, GRID_STEP, [(0, 2), (1, 2)]),
+                                 ("hum", files, GRID_STEP, [(0, 1)])]
+    # One sensor per group: the temp pairs go into separate tasks
+    assert grid_tasks(tasks, group=2) == grid_tasks(tasks)
+    assert grid_tasks(tasks, group=1) == [
+        ("temp", files, GRID_STEP, [(0, 2)]),
+        ("hum", files, GRID_STEP, [(0, 1)]),
+        ("temp", files, GRID_STEP, [(1, 2)])]
+    assert grid_outputs(tasks[0])[0][0] == result_path(
+        "Sensor-01", "temp", SCRIPT, "Sensor-03", {"grid": 100})
@@ -5,28 +5,118 @@ Fabien Benureau and Nicolas Rougier, 'Re-run, Repeat, Reproduce, Reuse,
 Replicate: Transforming Code into Scientific Contributions',
 arXiv:1708.08205"""
 
+from glob import glob
 from hashlib import sha1
 import subprocess
-from datetime import datetime
+from datetime import datetime, timedelta
+from dateutil import parser
+from json import dumps, loads
+from multiprocessing.pool import ThreadPool
+import numpy as np
 import sys
 import platform
 import os
+import shutil
+
+
+# Reference point for integer timestamps (microseconds since the epoch)
+EPOCH = datetime(1970, 1, 1)
+
+# File caching the hashes of the input files, keyed by path, inode, size and
+# modification time. It is kept next to the results (relative to the working
+# directory, like the results folder, see result_dir).
+HASH_CACHE = os.path.join("results", ".hash_cache.json")
+
+# Read size when hashing files, and number of files hashed in parallel
+HASH_BLOCK = 1 << 20
+HASH_THREADS = 4
+
+# Metadata shared by all results of a run, see create_run_context
+_RUN_CONTEXT = {}
+
+# Extension (folder) of columnar result stores, see ResultStore
+STORE_EXTENSION = ".store"
+
+# Suffix of the folder next to a result store holding the columns of the
+# pairs until the store is saved, see ResultStore.write_chunk
+CHUNK_EXTENSION = ".chunks"
+
+# Kinds of the values in a result store column
+KIND_FLOAT = 0
+KIND_INT = 1
+KIND_NONE = 2
+KIND_ABSENT = 3
+
+# Number of set bits of every byte value
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)],
+                          dtype=np.uint8)
 
 
 def _calculate_sha1(file):
     hash_sha1 = sha1()
     with open(file, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        for chunk in iter(lambda: f.read(HASH_BLOCK), b""):
             hash_sha1.update(chunk)
     return hash_sha1.hexdigest()
 
 
+def _file_key(file):
+    # Files whose key did not change since they were hashed are not re-read
+    st = os.stat(file)
+    return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def _load_hash_cache():
+    try:
+        with open(HASH_CACHE, "r") as fo:
+            return loads(fo.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def _store_hash_cache(entries):
+    # Merge with the entries other processes stored in the meantime and
+    # replace the cache atomically
+    cache = _load_hash_cache()
+    cache.update(entries)
+    tmp = "%s.%d.tmp" % (HASH_CACHE, os.getpid())
+    try:
+        os.makedirs(os.path.dirname(HASH_CACHE), exist_ok=True)
+        with open(tmp, "w") as fo:
+            fo.write(dumps(cache))
+        os.replace(tmp, HASH_CACHE)
+    except OSError as e:
+        print("[WARN] Could not write hash cache:", e)
+
+
+def hash_file(file):
+    """Return the SHA1 hash (hex digest) of a file."""
+    return _hash_files([file])[file]
+
+
 def _hash_files(files):
-    # Hash files and save to metadata
+    # Hash files and save to metadata. Hashes of unchanged files are taken
+    # from the cache, the other files are hashed in parallel.
+    cache = _load_hash_cache()
     hashes = {}
+    keys = {}
     for file in files:
-        hashes[file] = _calculate_sha1(file)
-    return hashes
+        path = os.path.abspath(file)
+        key = _file_key(file)
+        entry = cache.get(path)
+        if entry is not None and entry[:3] == key:
+            hashes[file] = entry[3]
+        else:
+            keys[file] = (path, key)
+
+    if keys:
+        missing = list(keys)
+        with ThreadPool(min(len(missing), HASH_THREADS)) as pool:
+            digests = pool.map(_calculate_sha1, missing)
+        hashes.update(zip(missing, digests))
+        _store_hash_cache({keys[file][0]: keys[file][1] + [digest]
+                           for file, digest in zip(missing, digests)})
+    return {file: hashes[file] for file in files}
 
 
 def _git_revision():
@@ -46,6 +136,44 @@ def _ensure_path_exists(path):
         os.makedirs(path)
 
 
+def _system():
+    return platform.python_implementation() + sys.version
+
+
+def create_run_context(directories=()):
+    """Collect the metadata that is the same for all results of a run.
+
+    Creating the metadata of a result queries git and the platform. To do
+    that only once per run, the run context is created in the main process
+    and passed to the worker processes with init_run_context (e.g. as the
+    initializer of the Pool). The result directories of the run are created
+    up front as well.
+    :param directories: The result directories that will be written to, see
+        result_dir
+    :return: The run context (a picklable dictionary)
+    """
+    revision = _git_revision()
+    directories = sorted(set(directories))
+    for path in directories:
+        _ensure_path_exists(path)
+    return {
+        "generator_version": revision,
+        "dirty": revision.endswith("~dirty"),
+        "system": _system(),
+        "directories": directories,
+    }
+
+
+def init_run_context(context):
+    """Use a run context (see create_run_context) in the current process.
+
+    Afterwards, create_metadata and derive_result_path use the context
+    instead of querying git and the file system."""
+    _RUN_CONTEXT.clear()
+    _RUN_CONTEXT.update(context)
+    _RUN_CONTEXT["directories"] = set(context.get("directories", ()))
+
+
 def create_metadata(files, script_name, params={}):
     """Create a dictionary containing metadata about a result.
 
@@ -60,13 +188,14 @@ def create_metadata(files, script_name, params={}):
         # Name of generating script
         "generator_script": script_name,
         # Generator version number / git revision
-        "generator_version": _git_revision(),
+        "generator_version": _RUN_CONTEXT.get("generator_version") or
+        _git_revision(),
         # Data files
         "source_files": _hash_files(files),
         # Parameters
         "parameters": params,
         # System architecture
-        "system": platform.python_implementation() + sys.version,
+        "system": _RUN_CONTEXT.get("system") or _system(),
         # Creation date of file
         "created_on": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         # Start of processing
@@ -74,7 +203,30 @@ def create_metadata(files, script_name, params={}):
     }
 
 
-def derive_result_path(sensor, feature, script, sensor2=None, params={}):
+def result_dir(sensor, feature, script, params={}):
+    """Return the folder of a result, see derive_result_path."""
+    path = "results/{}/{}/{}/".format(sensor, feature, script)
+
+    for param in sorted(params.keys()):
+        if param == "chunk_len":
+            path += str(params[param]) + "sec/"
+            continue
+        path += param + "-" + str(params[param]) + "/"
+    return path
+
+
+def result_path(sensor, feature, script, sensor2=None, params={},
+                extension=".json"):
+    """Return the path of a result like derive_result_path, without creating
+    any folders."""
+    path = result_dir(sensor, feature, script, params)
+    if sensor2 is not None:
+        return path + sensor2 + extension
+    return path + "result" + extension
+
+
+def derive_result_path(sensor, feature, script, sensor2=None, params={},
+                       extension=".json"):
     """Derive the path under which a result should be saved.
 
     This code generates a path to the json file under which a result from
@@ -86,35 +238,534 @@ def derive_result_path(sensor, feature, script, sensor2=None, params={}):
     :param params: A dictionary of additional relevant parameters that should
         be incorporated into the result path (e.g. different epoch lengths,
         thresholds, ...)
+    :param extension: The file extension, for result formats other than the
+        default json
     :return: The path to the file, with the guarantee that the folder
         structure exists.
     """
     # Derive folder structure
-    path = "results/{}/{}/{}/".format(sensor, feature, script)
-
-    for param in sorted(params.keys()):
-        if param == "chunk_len":
-            path += str(params[param]) + "sec/"
-            continue
-        path += param + "-" + str(params[param]) + "/"
+    path = result_dir(sensor, feature, script, params)
 
-    # Ensure that the folders exist
-    _ensure_path_exists(path)
+    # Ensure that the folders exist and warn if the file exists, unless the
+    # folder was created for the run already (the results that are
+    # recomputed have been reported by select_tasks then)
+    checked = path not in _RUN_CONTEXT.get("directories", ())
+    if checked:
+        _ensure_path_exists(path)
 
     # Add filename
-    if sensor2 is not None:
-        path += sensor2 + ".json"
-    else:
-        path += "result.json"
+    path = result_path(sensor, feature, script, sensor2, params, extension)
 
     # Warn if file exists
-    if os.path.isfile(path):
+    if checked and os.path.isfile(path):
         print("[WARN] Output file", path, "already exists, OVERWRITING.")
 
     # Return result
     return path
 
 
+def read_metadata(path):
+    """Read the metadata of a result file, or None if it cannot be read.
+
+    The results are saved with sorted keys, so the metadata comes first and
+    is parsed without reading the (possibly large) results."""
+    try:
+        lines = []
+        with open(path, "r") as fo:
+            if fo.readline().strip() != "{":
+                raise ValueError
+            for line in fo:
+                lines.append(line)
+                if line.rstrip() in ("    },", "    }"):
+                    break
+        return loads("{" + "".join(lines).rstrip().rstrip(",") + "}")[
+            "metadata"]
+    except (OSError, ValueError, KeyError):
+        try:
+            with open(path, "r") as fo:
+                return loads(fo.read())["metadata"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def is_up_to_date(path, files, params={}):
+    """Determine if a result file is up to date.
+
+    A result is up to date if it was generated by the current (clean) git
+    revision, from input files with the same hashes and with the same
+    parameters. Results of uncommitted changes are never up to date.
+    :param path: The result file, see result_path
+    :param files: The input files the result would be computed from
+    :param params: The parameters the result would be computed with
+    :return: True if the result does not need to be recomputed
+    """
+    metadata = read_metadata(path)
+    if metadata is None:
+        return False
+    version = _RUN_CONTEXT.get("generator_version") or _git_revision()
+    if version.endswith("~dirty") or \
+            metadata.get("generator_version") != version:
+        return False
+    if metadata.get("parameters") != loads(dumps(params)):
+        return False
+    return metadata.get("source_files") == _hash_files(files)
+
+
+def select_tasks(tasks, outputs, force=False, name="tasks"):
+    """Select the tasks whose results are not up to date.
+
+    :param tasks: A list of tasks (e.g. pairs of files)
+    :param outputs: A function mapping a task to a list of (path, files,
+        params) tuples of its result files, see is_up_to_date
+    :param force: If True, all tasks are selected
+    :param name: The name of the tasks in the printed summary
+    :return: The list of tasks that have to be computed
+    """
+    tasks = list(tasks)
+    if force:
+        selected = tasks
+    else:
+        selected = [task for task in tasks
+                    if not all(is_up_to_date(*output)
+                               for output in outputs(task))]
+    print("[INFO] Skipping", len(tasks) - len(selected), "up-to-date", name +
+          ", computing", len(selected), name)
+    return selected
+
+
+def to_epoch_us(dt):
+    """Convert a (naive) datetime into integer microseconds since the epoch."""
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def from_epoch_us(us):
+    """Convert integer microseconds since the epoch back into a datetime."""
+    return EPOCH + timedelta(microseconds=int(us))
+
+
+def parse_timestamps(timestrings):
+    """Parse a list of ISO 8601 timestamps into an int64 array of microseconds
+    since the epoch.
+
+    The timestamps written by the capture scripts are parsed in one
+    vectorized call. If that fails (e.g. because of a different format), every
+    distinct string is parsed with dateutil instead.
+    :param timestrings: A list of timestamp strings
+    :return: A numpy array (int64) of microseconds since the epoch
+    """
+    try:
+        return np.array(timestrings, dtype="datetime64[us]").astype(np.int64)
+    except ValueError:
+        cache = {}
+        rv = np.empty(len(timestrings), dtype=np.int64)
+        for i, timestring in enumerate(timestrings):
+            if timestring not in cache:
+                cache[timestring] = to_epoch_us(parser.parse(timestring))
+            rv[i] = cache[timestring]
+        return rv
+
+
+def slot_strings(slots):
+    """Format an array of timeslots (microseconds since epoch) as strings."""
+    seconds = slots.astype("datetime64[us]").astype("datetime64[s]")
+    return [s.replace("T", " ") for s in np.datetime_as_string(seconds)]
+
+
+def time_strings(time):
+    """Format an array of timestamps (microseconds since epoch) as strings
+    with microseconds, like strftime("%Y-%m-%d %H:%M:%S.%f")."""
+    stamps = np.asarray(time).astype("datetime64[us]")
+    return [s.replace("T", " ") for s in np.datetime_as_string(stamps)]
+
+
+def popcount(words):
+    """Count the set bits along the last axis of an array of uint64 words."""
+    if hasattr(np, "bitwise_count"):
+        counts = np.bitwise_count(words)
+    else:
+        # NumPy < 2.0: look up the bit count of every byte
+        counts = POPCOUNT_TABLE[np.ascontiguousarray(words).view(np.uint8)]
+    return counts.sum(axis=-1, dtype=np.int64)
+
+
+def _columnar(results):
+    # Convert the results of a pair into columns (time, errors, columns,
+    # time unit), or return None if they do not fit into columns
+    if not isinstance(results, dict):
+        return None
+    keys = list(results)
+    try:
+        time = parse_timestamps(keys)
+    except (ValueError, OverflowError):
+        return None
+    values = list(results.values())
+    if all(isinstance(v, dict) for v in values):
+        rows = values
+    elif all(isinstance(v, float) for v in values):
+        # One value per timestamp (e.g. the Shrestha features)
+        column = np.array(values, dtype=np.float64)
+        return (time, [None] * len(values),
+                {"value": (column, np.zeros(len(values), dtype=np.int8))},
+                "us" if any("." in k for k in keys) else "s")
+    else:
+        return None
+
+    errors = [row.get("error") for row in rows]
+    if not all(e is None or isinstance(e, str) for e in errors):
+        return None
+    columns = {}
+    names = sorted({name for row in rows for name in row if name != "error"})
+    for name in names:
+        column = np.zeros(len(rows), dtype=np.float64)
+        kinds = np.full(len(rows), KIND_ABSENT, dtype=np.int8)
+        for r, row in enumerate(rows):
+            if name not in row:
+                continue
+            value = row[name]
+            if value is None:
+                kinds[r] = KIND_NONE
+            elif isinstance(value, float):
+                kinds[r] = KIND_FLOAT
+                column[r] = value
+            elif isinstance(value, int) and not isinstance(value, bool):
+                kinds[r] = KIND_INT
+                column[r] = value
+            else:
+                return None
+        columns[name] = (column, kinds)
+    return time, errors, columns, "us" if any("." in k for k in keys) else "s"
+
+
+def decode_results(time, error, columns, errors, time_unit):
+    """Convert the columns of the rows of a pair of sensors back into its
+    results, in the format of the json files.
+
+    :param time: The timestamps of the rows (microseconds since the epoch)
+    :param error: The error codes of the rows (index into errors, -1 if none)
+    :param columns: A dictionary mapping the metric names to tuples (values,
+        kinds) of the rows
+    :param errors: The error messages
+    :param time_unit: The precision of the timestamps, "us" or "s"
+    :return: The results
+    """
+    time = np.asarray(time)
+    keys = time_strings(time) if time_unit == "us" else slot_strings(time)
+    scalar = list(columns) == ["value"]
+    columns = {name: (np.asarray(values).tolist(), np.asarray(kinds).tolist())
+               for name, (values, kinds) in columns.items()}
+    error = np.asarray(error).tolist()
+    rv = {}
+    for r, key in enumerate(keys):
+        row = {}
+        if error[r] >= 0:
+            row["error"] = errors[error[r]]
+        for name, (values, kinds) in columns.items():
+            if kinds[r] == KIND_FLOAT:
+                row[name] = values[r]
+            elif kinds[r] == KIND_INT:
+                row[name] = int(values[r])
+            elif kinds[r] == KIND_NONE:
+                row[name] = None
+        rv[key] = row["value"] if scalar and "value" in row else row
+    return rv
+
+
+class ResultStore:
+    """Columnar store of the results of all pairs of sensors.
+
+    Instead of one json file per pair of sensors, the results of one feature
+    and parameter set are saved in one folder (see STORE_EXTENSION) with a
+    .npy file per column, which can be memory mapped:
+    * time: the timestamps of the results (int64, microseconds since epoch)
+    * pair: the index of the pair of sensors of every result (int32)
+    * error: the index of the error message of a result, -1 if none (int16)
+    * <name>: the values of a metric (float64). If not all values are
+      floats, <name>.kind holds their kinds (KIND_INT, KIND_NONE for null
+      and KIND_ABSENT if the result has no such value).
+    The rows of a pair are consecutive. index.json holds the pairs with
+    their metadata and row range, the error messages and the column names.
+    Results that do not fit into columns (e.g. {"error": ...} for a whole
+    pair) are kept in index.json as they are.
+
+    Until the store is saved, the columns of every added pair are kept in a
+    chunk folder next to the store (see write_chunk), so the results of all
+    pairs never have to be held in memory.
+    """
+
+    def __init__(self, feature, script, params={}):
+        """Create an empty store for a feature, script and parameters (as
+        in derive_result_path)."""
+        self.feature = feature
+        self.script = script
+        self.params = params
+        self.pairs = []
+        self.errors = []
+        self.columns = {}
+        self.kinds = {}
+        self.time = np.zeros(0, dtype=np.int64)
+        self.pair = np.zeros(0, dtype=np.int32)
+        self.error = np.zeros(0, dtype=np.int16)
+
+    def chunk_path(self, sensor1, sensor2):
+        """Return the chunk folder of a pair of sensors, see write_chunk."""
+        return os.path.join(result_path("all", self.feature, self.script,
+                                        params=self.params,
+                                        extension=STORE_EXTENSION) +
+                            CHUNK_EXTENSION, sensor1 + "-" + sensor2)
+
+    def write_chunk(self, sensor1, sensor2, rv):
+        """Write the result (a dict with metadata and results, as saved in the
+        json files) of a pair of sensors into its chunk folder.
+
+        The worker processes call this instead of returning the results, so
+        only the index entry of the pair is passed to the main process.
+        :return: The index entry of the pair, see add_entry
+        """
+        entry = {"sensors": [sensor1, sensor2], "metadata": rv["metadata"]}
+        part = _columnar(rv["results"])
+        if part is None:
+            entry["results"] = rv["results"]
+            return entry
+        time, messages, columns, entry["time_unit"] = part
+        errors = sorted(set(m for m in messages if m is not None))
+        codes = {message: code for code, message in enumerate(errors)}
+        path = self.chunk_path(sensor1, sensor2)
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "time.npy"), time)
+        np.save(os.path.join(path, "error.npy"),
+                np.array([codes.get(m, -1) for m in messages],
+                         dtype=np.int16))
+        for name, (column, kinds) in columns.items():
+            np.save(os.path.join(path, name + ".npy"), column)
+            np.save(os.path.join(path, name + ".kind.npy"), kinds)
+        entry.update(chunk=path, rows=len(time), columns=sorted(columns),
+                     errors=errors)
+        return entry
+
+    def add_entry(self, entry):
+        """Add the index entry of a pair, as returned by write_chunk."""
+        self.pairs.append(entry)
+
+    def add(self, sensor1, sensor2, rv):
+        """Add the result (a dict with metadata and results, as saved in the
+        json files) of a pair of sensors."""
+        self.add_entry(self.write_chunk(sensor1, sensor2, rv))
+
+    def save(self, path=None):
+        """Save the store, by default to the path derived for sensor "all"
+        (see derive_result_path). An existing store is replaced.
+
+        The columns are created at their full length on disk and filled one
+        chunk at a time, then the chunk folders are removed.
+        :return: The path of the store
+        """
+        if path is None:
+            path = derive_result_path("all", self.feature, self.script,
+                                      params=self.params,
+                                      extension=STORE_EXTENSION)
+        chunks = [entry for entry in self.pairs if "chunk" in entry]
+        n_old = len(self.time)
+        n_rows = n_old + sum(entry["rows"] for entry in chunks)
+        names = sorted(set(self.columns).union(
+            *[entry["columns"] for entry in chunks]))
+        tmp = "%s.%d.tmp" % (path.rstrip("/"), os.getpid())
+        _ensure_path_exists(tmp)
+
+        def column(name, dtype):
+            return np.lib.format.open_memmap(
+                os.path.join(tmp, name + ".npy"), mode="w+", dtype=dtype,
+                shape=(n_rows,))
+
+        time = column("time", np.int64)
+        pair = column("pair", np.int32)
+        error = column("error", np.int16)
+        values = {name: column(name, np.float64) for name in names}
+        kinds = {name: column(name + ".kind", np.int8) for name in names}
+        mixed = {}
+        time[:n_old] = self.time
+        pair[:n_old] = self.pair
+        error[:n_old] = self.error
+        for name in names:
+            if name in self.columns:
+                values[name][:n_old] = self.columns[name]
+                kinds[name][:n_old] = self.kinds[name]
+                mixed[name] = bool((self.kinds[name] != KIND_FLOAT).any())
+            else:
+                values[name][:n_old] = 0
+                kinds[name][:n_old] = KIND_ABSENT
+                mixed[name] = n_old > 0
+
+        errors = list(self.errors)
+        codes = {message: code for code, message in enumerate(errors)}
+        pairs = []
+        offset = n_old
+        for index, entry in enumerate(self.pairs):
+            if "chunk" not in entry:
+                pairs.append(entry)
+                continue
+            for message in entry["errors"]:
+                if message not in codes:
+                    codes[message] = len(errors)
+                    errors.append(message)
+            # Code -1 (no error) maps onto the last element
+            lookup = np.array([codes[m] for m in entry["errors"]] + [-1],
+                              dtype=np.int16)
+            rows = slice(offset, offset + entry["rows"])
+            chunk = entry["chunk"]
+            time[rows] = np.load(os.path.join(chunk, "time.npy"))
+            error[rows] = lookup[np.load(os.path.join(chunk, "error.npy"))]
+            pair[rows] = index
+            for name in names:
+                if name not in entry["columns"]:
+                    values[name][rows] = 0
+                    kinds[name][rows] = KIND_ABSENT
+                    mixed[name] = mixed[name] or entry["rows"] > 0
+                    continue
+                values[name][rows] = np.load(os.path.join(chunk,
+                                                          name + ".npy"))
+                kind = np.load(os.path.join(chunk, name + ".kind.npy"))
+                kinds[name][rows] = kind
+                mixed[name] = mixed[name] or bool((kind != KIND_FLOAT).any())
+            pairs.append(dict({key: value for key, value in entry.items()
+                               if key not in ("chunk", "rows", "columns",
+                                              "errors")},
+                              start=rows.start, end=rows.stop))
+            offset = rows.stop
+
+        for array in [time, pair, error] + list(values.values()) + \
+                list(kinds.values()):
+            array.flush()
+        del time, pair, error, values, kinds
+        for name in names:
+            if not mixed[name]:
+                os.remove(os.path.join(tmp, name + ".kind.npy"))
+        index = {
+            "format": "result-store",
+            "feature": self.feature,
+            "script": self.script,
+            "parameters": self.params,
+            "columns": names,
+            "errors": errors,
+            "pairs": pairs,
+        }
+        with open(os.path.join(tmp, "index.json"), "w") as fo:
+            fo.write(dumps(index, indent=4, sort_keys=True))
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.replace(tmp, path)
+
+        for entry in chunks:
+            shutil.rmtree(entry["chunk"], ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(entry["chunk"]))
+            except OSError:
+                pass
+        self.pairs = pairs
+        self.errors = errors
+        self._load_columns(path, names)
+        return path
+
+    def _load_columns(self, path, names, mmap=True):
+        mode = "r" if mmap else None
+        self.time = np.load(os.path.join(path, "time.npy"), mmap_mode=mode)
+        self.pair = np.load(os.path.join(path, "pair.npy"), mmap_mode=mode)
+        self.error = np.load(os.path.join(path, "error.npy"), mmap_mode=mode)
+        self.columns = {}
+        self.kinds = {}
+        for name in names:
+            self.columns[name] = np.load(os.path.join(path, name + ".npy"),
+                                         mmap_mode=mode)
+            kind = os.path.join(path, name + ".kind.npy")
+            if os.path.isfile(kind):
+                self.kinds[name] = np.load(kind, mmap_mode=mode)
+            else:
+                self.kinds[name] = np.zeros(len(self.time), dtype=np.int8)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load a store, with the columns memory mapped by default."""
+        with open(os.path.join(path, "index.json"), "r") as fo:
+            index = loads(fo.read())
+        store = cls(index["feature"], index["script"], index["parameters"])
+        store.pairs = index["pairs"]
+        store.errors = index["errors"]
+        store._load_columns(path, index["columns"], mmap)
+        return store
+
+    def pair_index(self, sensor1, sensor2):
+        """Return the index of a pair of sensors, or None if not stored."""
+        for index, entry in enumerate(self.pairs):
+            if entry["sensors"] == [sensor1, sensor2]:
+                return index
+        return None
+
+    def results(self, index):
+        """Return the results of a pair in the format of the json files."""
+        entry = self.pairs[index]
+        if "chunk" in entry:
+            def load(name):
+                return np.load(os.path.join(entry["chunk"], name + ".npy"))
+            return decode_results(
+                load("time"), load("error"),
+                {name: (load(name), load(name + ".kind"))
+                 for name in entry["columns"]},
+                entry["errors"], entry["time_unit"])
+        if "start" not in entry:
+            return entry.get("results")
+        rows = slice(entry["start"], entry["end"])
+        return decode_results(
+            self.time[rows], self.error[rows],
+            {name: (self.columns[name][rows], self.kinds[name][rows])
+             for name in self.columns},
+            self.errors, entry["time_unit"])
+
+    def export(self):
+        """Write the results of every pair to its json file (see
+        derive_result_path), as saved without the store."""
+        for index, entry in enumerate(self.pairs):
+            rv = {"metadata": entry["metadata"],
+                  "results": self.results(index)}
+            path = derive_result_path(entry["sensors"][0], self.feature,
+                                      self.script, entry["sensors"][1],
+                                      params=self.params)
+            with open(path, "w") as fo:
+                fo.write(dumps(rv, indent=4, sort_keys=True))
+
+
+def store_result(feature, script, sensor1, sensor2, rv, params={}):
+    """Write the result of a pair of sensors into a chunk of the ResultStore
+    of its feature and parameters (see ResultStore.write_chunk).
+
+    :return: A tuple (feature, params, entry) for save_stores
+    """
+    store = ResultStore(feature, script, params)
+    return feature, params, store.write_chunk(sensor1, sensor2, rv)
+
+
+def save_stores(outputs, script):
+    """Save results into one ResultStore per feature and parameter set.
+
+    :param outputs: An iterable of (feature, params, entry) tuples, see
+        store_result
+    :param script: The name of the calling script
+    :return: The paths of the stores
+    """
+    stores = {}
+    for feature, params, entry in outputs:
+        key = (feature, dumps(params, sort_keys=True))
+        if key not in stores:
+            stores[key] = ResultStore(feature, script, params)
+        stores[key].add_entry(entry)
+    return [store.save() for store in stores.values()]
+
+
+def export_stores(script):
+    """Export all result stores of a script to per-pair json files."""
+    for path in sorted(glob("results/all/*/{}/**/*{}".format(
+            script, STORE_EXTENSION), recursive=True)):
+        ResultStore.load(path).export()
+
+
 def is_colocated_interval(sensor1, sensor2, interval=6):
     """Determine if two sensors are considered colocated, based on their IDs.
 
@@ -148,6 +799,23 @@ def test_colo_interval_6():
     assert is_colocated_interval(13, 14, interval=6)
 
 
+def test_epoch_us_roundtrip():
+    dt = datetime(2017, 8, 10, 21, 57, 25, 716306)
+    assert from_epoch_us(to_epoch_us(dt)) == dt
+    assert to_epoch_us(EPOCH) == 0
+
+
+def test_parse_timestamps():
+    res = parse_timestamps(["2017-08-10T21:57:25.716306",
+                            "2017-08-10T21:57:36"])
+    assert res.dtype == np.int64
+    assert res[0] == to_epoch_us(datetime(2017, 8, 10, 21, 57, 25, 716306))
+    assert res[1] == to_epoch_us(datetime(2017, 8, 10, 21, 57, 36))
+    # Formats numpy does not understand are handled by dateutil
+    res = parse_timestamps(["Aug 10 2017 21:57:36", "Aug 10 2017 21:57:36"])
+    assert list(res) == [to_epoch_us(datetime(2017, 8, 10, 21, 57, 36))] * 2
+
+
 def test_colo_interval_8():
     assert is_colocated_interval(1, 6, interval=8)
     assert is_colocated_interval(1, 7, interval=8)
@@ -155,3 +823,156 @@ def test_colo_interval_8():
     assert is_colocated_interval(7, 6, interval=8)
     assert is_colocated_interval(13, 14, interval=8)
     assert not is_colocated_interval(8, 9, interval=8)
+
+
+def test_popcount():
+    words = np.array([[2 ** 64 - 1, 0], [5, 2 ** 63]], dtype=np.uint64)
+    assert list(popcount(words)) == [64, 3]
+    assert list(POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=1)) == [64, 3]
+    assert popcount(words[:, None, :] ^ words[None, :, :]).tolist() == \
+        [[0, 63], [63, 0]]
+
+
+def test_hash_files_cache(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join("a").write("abc")
+    tmpdir.join("b").write("def")
+    hashes = _hash_files(["a", "b"])
+    assert hashes == {"a": sha1(b"abc").hexdigest(),
+                      "b": sha1(b"def").hexdigest()}
+    assert tmpdir.join(HASH_CACHE).check()
+
+    # Unchanged files are not hashed again
+    cache = _load_hash_cache()
+    cache[str(tmpdir.join("a"))][3] = "cached"
+    tmpdir.join(HASH_CACHE).write(dumps(cache))
+    assert hash_file("a") == "cached"
+
+    # Changed files are
+    tmpdir.join("a").write("abcd")
+    assert hash_file("a") == sha1(b"abcd").hexdigest()
+
+
+def test_run_context(tmpdir, monkeypatch, capsys):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(sys.modules[__name__], "_git_revision",
+                        lambda: "git+0123~dirty")
+    path = result_dir("Sensor-01", "temp", "script", {"chunk_len": 10,
+                                                      "step": 5})
+    assert path == "results/Sensor-01/temp/script/10sec/step-5/"
+    context = create_run_context([path])
+    assert context["dirty"]
+    assert tmpdir.join(path).check(dir=True)
+
+    try:
+        init_run_context(context)
+        # No git queries with a run context
+        monkeypatch.setattr(sys.modules[__name__], "_git_revision", None)
+        assert create_metadata([], "script")["generator_version"] == \
+            "git+0123~dirty"
+        # and no file system queries for the folders of the run
+        tmpdir.join(path + "Sensor-02.json").write("{}")
+        capsys.readouterr()
+        assert derive_result_path("Sensor-01", "temp", "script", "Sensor-02",
+                                  {"chunk_len": 10, "step": 5}) == \
+            path + "Sensor-02.json"
+        assert "OVERWRITING" not in capsys.readouterr().out
+    finally:
+        init_run_context({})
+
+
+def test_incremental(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(sys.modules[__name__], "_git_revision",
+                        lambda: "git+0123")
+    tmpdir.join("a").write("abc")
+    path = derive_result_path("Sensor-01", "temp", "script", "Sensor-02",
+                              {"chunk_len": 10})
+    assert path == result_path("Sensor-01", "temp", "script", "Sensor-02",
+                               {"chunk_len": 10})
+    with open(path, "w") as fo:
+        fo.write(dumps({"metadata": create_metadata(["a"], "script",
+                                                    {"chunk_len": 10}),
+                        "results": {"2017-08-16 12:15:00": {"x": 1}}},
+                       indent=4, sort_keys=True))
+    assert read_metadata(path)["parameters"] == {"chunk_len": 10}
+    assert is_up_to_date(path, ["a"], {"chunk_len": 10})
+    assert not is_up_to_date(path, ["a"], {"chunk_len": 30})
+    assert not is_up_to_date(path + ".missing", ["a"], {"chunk_len": 10})
+
+    tasks = [(path, ["a"], {"chunk_len": 10}), (path, ["a"], {})]
+    assert select_tasks(tasks, lambda task: [task]) == tasks[1:]
+    assert select_tasks(tasks, lambda task: [task], force=True) == tasks
+
+    # New code or data
+    monkeypatch.setattr(sys.modules[__name__], "_git_revision",
+                        lambda: "git+0123~dirty")
+    assert not is_up_to_date(path, ["a"], {"chunk_len": 10})
+    monkeypatch.setattr(sys.modules[__name__], "_git_revision",
+                        lambda: "git+0123")
+    tmpdir.join("a").write("abcd")
+    assert not is_up_to_date(path, ["a"], {"chunk_len": 10})
+
+
+def test_result_store(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(sys.modules[__name__], "_git_revision",
+                        lambda: "git+0123")
+    metadata = create_metadata([], "script", {"chunk_len": 10})
+    rv1 = {"metadata": metadata, "results": {
+        "2017-08-10 21:57:30": {"jaccard": 0.5, "ranks": None, "n": 3},
+        "2017-08-10 21:57:40": {"error": "Scan error"},
+        "2017-08-10 21:57:50": {}}}
+    rv2 = {"metadata": metadata, "results": {
+        "2017-08-10 21:57:30": {"jaccard": 1.0, "ranks": 2.5, "n": 4}}}
+    rv3 = {"metadata": metadata, "results": {"error": "No sync possible"}}
+    outputs = [store_result("wifi", "script", "Sensor-01", "Sensor-02", rv1,
+                            {"chunk_len": 10}),
+               store_result("wifi", "script", "Sensor-01", "Sensor-03", rv2,
+                            {"chunk_len": 10}),
+               store_result("wifi", "script", "Sensor-02", "Sensor-03", rv3,
+                            {"chunk_len": 10})]
+    # Only the small index entries are passed on, the columns are in chunks
+    assert "results" not in outputs[0][2]
+    chunks = "results/all/wifi/script/10sec/result" + STORE_EXTENSION + \
+        CHUNK_EXTENSION
+    assert sorted(os.listdir(chunks)) == ["Sensor-01-Sensor-02",
+                                          "Sensor-01-Sensor-03"]
+    unsaved = ResultStore("wifi", "script", {"chunk_len": 10})
+    unsaved.add_entry(outputs[0][2])
+    assert unsaved.results(0) == rv1["results"]
+
+    path = save_stores(outputs, "script")[0]
+    assert path == "results/all/wifi/script/10sec/result" + STORE_EXTENSION
+    assert not os.path.exists(chunks)
+    assert os.path.isfile(os.path.join(path, "n.kind.npy"))
+    assert not os.path.isfile(os.path.join(path, "time.kind.npy"))
+
+    store = ResultStore.load(path)
+    assert isinstance(store.time, np.memmap)
+    assert list(store.pair) == [0, 0, 0, 1]
+    assert list(store.columns["jaccard"][store.pair == 1]) == [1.0]
+    for n, rv in enumerate([rv1, rv2, rv3]):
+        assert store.results(n) == rv["results"]
+    assert store.pair_index("Sensor-01", "Sensor-03") == 1
+
+    # The export gives the same files as saving without the store
+    export_stores("script")
+    with open("results/Sensor-01/wifi/script/10sec/Sensor-02.json") as fo:
+        assert fo.read() == dumps(rv1, indent=4, sort_keys=True)
+
+    # Pairs added to a saved store are appended
+    store.add("Sensor-03", "Sensor-04", {"metadata": metadata, "results": {
+        "2017-08-10 21:57:30": {"jaccard": 0.0, "other": 1.5}}})
+    store = ResultStore.load(store.save())
+    assert list(store.pair) == [0, 0, 0, 1, 3]
+    for n, rv in enumerate([rv1, rv2, rv3]):
+        assert store.results(n) == rv["results"]
+    assert store.results(3) == {
+        "2017-08-10 21:57:30": {"jaccard": 0.0, "other": 1.5}}
+
+    scalar = ResultStore("temp", "script")
+    scalar.add("Sensor-01", "Sensor-02", {"metadata": metadata, "results": {
+        "2018-01-22 12:00:00.138987": 0.25}})
+    assert ResultStore.load(scalar.save()).results(0) == \
+        {"2018-01-22 12:00:00.138987": 0.25}